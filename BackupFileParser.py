@@ -13,7 +13,13 @@
 # limitations under the License.
 
 from google.cloud import storage
-import jsonlines
+from google.api_core import exceptions
+import jsonlines, json, configparser
+import ClientRegistry as cr
+
+config = configparser.ConfigParser()
+config.read("tagengine.ini")
+BACKUP_READ_CHUNK_SIZE = int(config['DEFAULT'].get('BACKUP_READ_CHUNK_SIZE', 8388608)) # bytes per GCS read
 
 columns = 'columns'
 tags = 'tags'
@@ -24,106 +30,147 @@ snapshot_time = 'snapshotTime'
 class BackupFileParser:
 
     @staticmethod
-    def match_template_id(json_obj, source_template_id):
-    
-        tag_template = "'templateId': '{}'".format(source_template_id)
+    def match_tag(tag, source_template_id, source_template_project):
         
-        if tag_template in str(json_obj):
-            return True
-        else:
-            return False
+        # a tag which doesn't carry a projectId is matched on its templateId
+        return tag.get('templateId') == source_template_id and tag.get('projectId', source_template_project) == source_template_project
 
     
     @staticmethod
-    def match_template_id_project(json_obj, source_template_id, source_template_project):
+    def filter_tags(tag_list, source_template_id, source_template_project):
+        
+        return [tag for tag in tag_list if BackupFileParser.match_tag(tag, source_template_id, source_template_project)]
+
     
-        is_match = False
+    @staticmethod
+    def filter_entry(obj, source_template_id, source_template_project):
         
-        tag_template = "'templateId': '{}'".format(source_template_id)
-        project_id = "'projectId': '{}'".format(source_template_project)
+        # keeps the tags of the source template on the entry and on its columns, returns None when there aren't any 
+        entry_tags = BackupFileParser.filter_tags(obj.get(tags, []), source_template_id, source_template_project)
         
-        #print('tag_template: ', tag_template)
-        #print('project_id: ', project_id)
+        if len(entry_tags) > 0:
+            obj[tags] = entry_tags
+        else:
+            obj.pop(tags, None)
+        
+        column_objs = []
+        
+        for column_obj in obj.get(columns, []):
+            
+            column_tags = BackupFileParser.filter_tags(column_obj.get(tags, []), source_template_id, source_template_project)
+            
+            if len(column_tags) > 0:
+                column_obj[tags] = column_tags
+                column_objs.append(column_obj)
+        
+        if len(column_objs) > 0:
+            obj[columns] = column_objs
+        else:
+            obj.pop(columns, None)
         
-        if tag_template in str(json_obj) and project_id in str(json_obj):
-            is_match = True
+        for k in (create_time, update_time, snapshot_time):
+            obj.pop(k, None)
         
-        return is_match
+        if tags not in obj and columns not in obj:
+            return None
+        
+        return obj
 
     
     @staticmethod
-    def extract_tags(source_template_id, source_template_project, backup_file):
+    def iter_tags(source_template_id, source_template_project, backup_file):
         
-        gcs_client = storage.Client()
-        extracted_tags = [] # stores the result set
+        gcs_client = cr.get_client(cr.STORAGE)
 
-        # download the backup file from GCS
+        # the backup file is streamed from GCS in chunks, each entry is parsed once and yielded as soon as it's filtered
         bucket_name, filename = backup_file
-        bucket = gcs_client.get_bucket(bucket_name)
-        blob = bucket.get_blob(filename)
-        
-        tmp_file = '/tmp/' + filename
-        blob.download_to_filename(filename=tmp_file)
+        blob = gcs_client.bucket(bucket_name).blob(filename)
         
-        with jsonlines.open(tmp_file) as reader:
-    
-            index = 0
+        with blob.open('r', chunk_size=BACKUP_READ_CHUNK_SIZE) as f:
+            
+            for obj in jsonlines.Reader(f):
+                
+                obj = BackupFileParser.filter_entry(obj, source_template_id, source_template_project)
+                
+                if obj != None:
+                    yield obj
+
     
-            for obj in reader:
+    @staticmethod
+    def iter_entry_ranges(source_template_id, source_template_project, backup_file, entries_per_range):
         
-                if BackupFileParser.match_template_id(str(obj), source_template_id) == False:
-                    continue
-            
-                #print(str(index) + ': ' + str(obj))
-                unwanted_keys = [] 
+        gcs_client = cr.get_client(cr.STORAGE)
         
-                for k, v in obj.items():
-                    #print('** key: ', k, ', value: ', v)
+        # yields the byte ranges of the backup file which hold up to entries_per_range entries with tags from the source template
+        # the ranges are pinned to the generation of the file which was split, so that a task never reads a newer version of it
+        bucket_name, filename = backup_file
+        blob = gcs_client.bucket(bucket_name).get_blob(filename)
+        
+        # e.g. the file was deleted after the backup location was listed, which ends the enumeration of the job
+        if blob == None:
+            raise exceptions.NotFound('Backup file not found: gs://' + bucket_name + '/' + filename)
+        
+        entry_range = {'bucket': bucket_name, 'filename': filename, 'generation': blob.generation}
+        range_start = None
+        entry_count = 0
+        offset = 0
+        
+        with blob.open('rb', chunk_size=BACKUP_READ_CHUNK_SIZE) as f:
             
-                    if k == columns and BackupFileParser.match_template_id_project(v, source_template_id, source_template_project) == True:
-                        #print('$$$$ column ', v)
+            for line in f:
                 
-                        columns_copy = v.copy()
+                line_start = offset
+                offset += len(line)
                 
-                        for element in columns_copy:
-                            #print('$$$$$ element ', element)
-                            if BackupFileParser.match_template_id(element, source_template_id) == False:
-                               v.remove(element)
-            
-                    if k == columns and BackupFileParser.match_template_id_project(v, source_template_id, source_template_project) == False:
-                        #print('added ', k, ' to unwanted_keys')
-                        unwanted_keys.append(k)
-            
-                    if k == tags and BackupFileParser.match_template_id_project(v, source_template_id, source_template_project) == True:
+                if line.strip() == b'':
+                    continue
                 
-                        tags_copy = v.copy()
+                if BackupFileParser.filter_entry(json.loads(line), source_template_id, source_template_project) == None:
+                    continue
+                
+                if range_start == None:
+                    range_start = line_start
+                
+                entry_count += 1
                 
-                        for element in tags_copy:
-                            #print('$$$$ element ', element)
-                            # looking for elements with references to tag template
-                            if BackupFileParser.match_template_id(element, source_template_id) == False:
-                               v.remove(element)
-                       
-                        #print('#### we are left with: ', v)
-                    
-                    if k == tags and BackupFileParser.match_template_id_project(v, source_template_id, source_template_project) == False:
-                        #print('added ', k, ' to unwanted_keys')
-                        unwanted_keys.append(k)
-                    
-                    if k == create_time or k == update_time or k == snapshot_time:
-                        #print('added ', k, ' to unwanted_keys')
-                        unwanted_keys.append(k)
-        
-                #print('unwanted_keys: ', unwanted_keys)
-                for k in unwanted_keys:
-                    del obj[k]
-        
-                if BackupFileParser.match_template_id_project(obj, source_template_id, source_template_project):
-                    extracted_tags.append(obj)
+                if entry_count == entries_per_range:
+                    yield dict(entry_range, start_byte=range_start, end_byte=offset)
+                    range_start = None
+                    entry_count = 0
+        
+        if range_start != None:
+            yield dict(entry_range, start_byte=range_start, end_byte=offset)
+
+    
+    @staticmethod
+    def read_entry_range(source_template_id, source_template_project, entry_range):
+        
+        gcs_client = cr.get_client(cr.STORAGE)
+        
+        # entry_range comes from iter_entry_ranges, end_byte is exclusive
+        bucket = gcs_client.bucket(entry_range['bucket'])
+        blob = bucket.blob(entry_range['filename'], generation=entry_range['generation'])
+        data = blob.download_as_bytes(start=entry_range['start_byte'], end=entry_range['end_byte'] - 1)
+        
+        extracted_tags = []
+        
+        for line in data.splitlines():
+            
+            if line.strip() == b'':
+                continue
             
-                index = index + 1
+            obj = BackupFileParser.filter_entry(json.loads(line), source_template_id, source_template_project)
+            
+            if obj != None:
+                extracted_tags.append(obj)
         
         return extracted_tags
+
+    
+    @staticmethod
+    def extract_tags(source_template_id, source_template_project, backup_file):
+        
+        return list(BackupFileParser.iter_tags(source_template_id, source_template_project, backup_file))
     
 if __name__ == '__main__':
     
@@ -134,4 +181,3 @@ if __name__ == '__main__':
     bkp_file = ('catalog_metadata_exports', 'Exported_Metadata_Project_tag-engine-develop_2022-08-02T22-09-14Z_UTC.jsonl')
     extracted_tags = BackupFileParser.extract_tags('data_attribute', 'data-mesh-344315', bkp_file)
     print('extracted_tags: ', extracted_tags)
-        
\ No newline at end of file
@@ -13,25 +13,40 @@
 # limitations under the License.
 
 import json, datetime, time, configparser
-import decimal
+import decimal, threading, io
+import pyarrow
+from pyarrow import parquet
 
 from google.cloud import bigquery
 from google.cloud.exceptions import NotFound
 
 import TagEngineUtils as te
+import ClientRegistry as cr
 
 config = configparser.ConfigParser()
 config.read("tagengine.ini")
 BIGQUERY_REGION = config['DEFAULT']['BIGQUERY_REGION']
+HISTORY_BATCH_SIZE = int(config['DEFAULT'].get('HISTORY_BATCH_SIZE', 500)) # rows per insert
+HISTORY_FLUSH_INTERVAL = int(config['DEFAULT'].get('HISTORY_FLUSH_INTERVAL', 10)) # seconds
+HISTORY_CACHE_TTL = int(config['DEFAULT'].get('HISTORY_CACHE_TTL', 300)) # seconds
+
+# tag history tables, shared by all the requests handled by this instance
+history_tables = {} # table_name -> (expiration_time, table_id), table_id is None when tag history is disabled
+history_tables_lock = threading.Lock()
 
 class BigQueryUtils:
     
     def __init__(self, region=None):
         
         if region:
-            self.client = bigquery.Client(location=region)
+            self.client = cr.get_client(cr.BIGQUERY, location=region)
         else:
-            self.client = bigquery.Client(location=BIGQUERY_REGION)
+            self.client = cr.get_client(cr.BIGQUERY, location=BIGQUERY_REGION)
+        
+        # the tag history rows are buffered per object, so a task only ever flushes its own rows
+        self.history_rows = {} # table_id -> rows waiting to be inserted
+        self.history_buffered_time = None # time at which the oldest buffered row was added
+        self.history_lock = threading.Lock()
 
     # API method used by tag export function
     def create_report_tables(self, project, dataset):
@@ -63,63 +78,63 @@ class BigQueryUtils:
         else:
             return False
     
-    # API method used by tag export function to insert records
-    def insert_exported_records(self, target_table_id, records):    
+    # API method used by tag export function to load records
+    def load_exported_records(self, target_table_id, columns):    
     
-        print('*** insert_exported_records into', target_table_id)
+        # columns = {column name: list of values}, the records are loaded as a single Parquet file with one load job 
+        print('*** load_exported_records into', target_table_id)
         
         success = True
         
         if target_table_id.endswith('catalog_report_column_tags'):
             schema = self.get_report_column_schema()
-            rows_to_insert = records
             
         elif target_table_id.endswith('catalog_report_table_tags'):
             schema = self.get_report_table_schema()
-            rows_to_insert = records
         
         elif target_table_id.endswith('catalog_report_dataset_tags'):
             schema = self.get_report_dataset_schema()
-            rows_to_insert = records
+        
+        arrow_fields = []
+        
+        for schema_field in schema:
             
-        job_config = bigquery.LoadJobConfig(schema=schema, source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON)  
+            if schema_field.field_type == 'TIMESTAMP':
+                arrow_type = pyarrow.timestamp('us', tz='UTC')
+            else:
+                arrow_type = pyarrow.string()
+            
+            arrow_fields.append(pyarrow.field(schema_field.name, arrow_type, nullable=(schema_field.mode != 'REQUIRED')))
+        
+        arrow_table = pyarrow.Table.from_pydict(columns, schema=pyarrow.schema(arrow_fields))
+        
+        parquet_file = io.BytesIO()
+        parquet.write_table(arrow_table, parquet_file)
+        parquet_file.seek(0)
+        
+        job_config = bigquery.LoadJobConfig(source_format=bigquery.SourceFormat.PARQUET, write_disposition=bigquery.WriteDisposition.WRITE_APPEND)  
         table_ref = bigquery.table.TableReference.from_string(target_table_id)
 
         try:
-            job = self.client.load_table_from_json(rows_to_insert, table_ref, job_config=job_config)
-            print('Inserted record into reporting table')
-            print('job errors:', job.errors)
+            job = self.client.load_table_from_file(parquet_file, table_ref, job_config=job_config)
+            job.result()
+            print('Loaded', arrow_table.num_rows, 'records into reporting table')
         
         except Exception as e:
-            
-            print('Error occurred while writing record into report table ', e)
-            
-            if '404' in str(e):
-                print('Report table not ready to be written to. Sleeping for 5 seconds.')
-                time.sleep(5)
-                try:
-                    errors = self.client.insert_rows_json(target_table_id, rows_to_insert)
-                except Exception as e:
-                     print("Error occurred during report_table_insert: {}".format(e))
-                     success = False
+            print('Error occurred while loading records into report table ', e)
+            success = False
         
         return success
-        
+    
     # API method used by tag history function
     def copy_tag(self, table_name, table_fields, tagged_table, tagged_column, tagged_values):
         
         print("*** inside BigQueryUtils.copy_tag() ***")
-
-        exists, table_id, settings = self.history_table_exists(table_name)
         
-        if exists != True:
-            success, dataset_id = self.create_dataset(settings['bigquery_project'], settings['bigquery_dataset'])
-            #print('created_dataset:', success)
-            
-            if success:
-                table_id = self.create_history_table(dataset_id, table_name, table_fields)
-            else:
-                print('Error creating tag_history dataset')
+        table_id = self.get_history_table(table_name, table_fields)
+        
+        if table_id == None:
+            return False
 
         if tagged_column and tagged_column not in "":
             asset_name = ("{}/column/{}".format(tagged_table, tagged_column))
@@ -128,10 +143,36 @@ class BigQueryUtils:
             
         asset_name = asset_name.replace("datasets", "dataset").replace("tables", "table")
         print('asset_name: ', asset_name)
-                
-        success = self.insert_history_row(table_id, asset_name, tagged_values)  
+        
+        # the row is buffered, see flush_history 
+        row = self.build_history_row(asset_name, tagged_values)
+        success = self.buffer_history_row(table_id, row)
         
         return success
+    
+    
+    # API method used by tag history function, called once the tags of a task have been written 
+    def flush_history(self):
+        
+        with self.history_lock:
+            buffered_rows = self.history_rows
+            self.history_rows = {}
+            self.history_buffered_time = None
+        
+        success = True
+        
+        for table_id, rows in buffered_rows.items():
+            for batch_start in range(0, len(rows), HISTORY_BATCH_SIZE):
+                if self.insert_history_rows(table_id, rows[batch_start:batch_start + HISTORY_BATCH_SIZE]) == False:
+                    success = False
+        
+        return success
+    
+    
+    def has_history_rows(self):
+        
+        with self.history_lock:
+            return len(self.history_rows) > 0
         
 
 ############### Internal processing methods ###############
@@ -236,6 +277,63 @@ class BigQueryUtils:
         except Exception as e:
             print('Error occurred during report_table_truncate ', e)
                   
+    # used by tag history function
+    def get_history_table(self, table_name, table_fields):
+        
+        # the settings lookup and the table existence check are cached per instance for HISTORY_CACHE_TTL seconds
+        now = time.time()
+        
+        with history_tables_lock:
+            cached = history_tables.get(table_name)
+        
+        if cached != None and cached[0] > now:
+            return cached[1]
+        
+        history_table = self.history_table_exists(table_name)
+        
+        if history_table[0] == False and len(history_table) == 2:
+            print('Tag history is not enabled')
+            table_id = None
+        
+        else:
+            exists, table_id, settings = history_table
+            
+            if exists != True:
+                success, dataset_id = self.create_dataset(settings['bigquery_project'], settings['bigquery_dataset'])
+                #print('created_dataset:', success)
+                
+                if success:
+                    table_id = self.create_history_table(dataset_id, table_name, table_fields)
+                else:
+                    print('Error creating tag_history dataset')
+                    return None
+            
+            table_id = str(table_id)
+        
+        with history_tables_lock:
+            history_tables[table_name] = (now + HISTORY_CACHE_TTL, table_id)
+        
+        return table_id
+    
+    
+    # used by tag history function
+    def buffer_history_row(self, table_id, row):
+        
+        with self.history_lock:
+            self.history_rows.setdefault(table_id, []).append(row)
+            
+            if self.history_buffered_time == None:
+                self.history_buffered_time = time.time()
+            
+            buffered_count = sum(len(rows) for rows in self.history_rows.values())
+            flush_due = buffered_count >= HISTORY_BATCH_SIZE or time.time() - self.history_buffered_time >= HISTORY_FLUSH_INTERVAL
+        
+        if flush_due:
+            return self.flush_history()
+        
+        return True
+    
+    
     # used by tag history function
     def history_table_exists(self, table_name):
         
@@ -318,7 +416,12 @@ class BigQueryUtils:
         print('asset_name:', asset_name)
         print('tagged_values:', tagged_values)
         
-        success = True
+        row = self.build_history_row(asset_name, tagged_values)
+        
+        return self.insert_history_rows(table_id, [row,])
+    
+    
+    def build_history_row(self, asset_name, tagged_values):
         
         row = {'event_time': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f') + ' UTC', 'asset_name': asset_name}
         
@@ -336,15 +439,22 @@ class BigQueryUtils:
             else:
                 row[tagged_value['field_id']]= json.dumps(tagged_value['field_value'], default=str)
                 row[tagged_value['field_id']]= tagged_value['field_value']
+        
+        return row
     
-        #print('insert row: ' + str(row))
-        row_to_insert = [row,]
+    
+    # writes a batch of tag history records
+    def insert_history_rows(self, table_id, rows_to_insert):
+        
+        print('insert_history_rows:', len(rows_to_insert), 'rows into', table_id)
+        
+        success = True
 
         try:
-            status = self.client.insert_rows_json(table_id, row_to_insert) 
+            status = self.client.insert_rows_json(table_id, rows_to_insert) 
             
             if len(status) > 0: 
-                print('Inserted row into tag history table. Return status: ', status) 
+                print('Inserted rows into tag history table. Return status: ', status) 
         
         except Exception as e:
             print('Error while writing to tag history table:', e)
@@ -353,8 +463,8 @@ class BigQueryUtils:
                 print('Tag history table not ready to be written to. Sleeping for 5 seconds.')
                 time.sleep(5)
                 try:
-                    status = self.client.insert_rows_json(table_id, row_to_insert) 
-                    print('Retrying insert row into tag history table. Return status: ', status) 
+                    status = self.client.insert_rows_json(table_id, rows_to_insert) 
+                    print('Retrying insert rows into tag history table. Return status: ', status) 
                 except Exception as e:
                     print('Error occurred while writing to tag history table: {}'.format(e))
                     success = False
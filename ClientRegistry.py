@@ -0,0 +1,83 @@
+# Copyright 2020-2022 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+
+from google.cloud import datacatalog
+from google.cloud.datacatalog import DataCatalogClient
+from google.cloud import bigquery
+from google.cloud import storage
+from google.cloud import firestore
+from google.cloud import tasks_v2
+from google.cloud import resourcemanager_v3
+
+# the Google clients are thread-safe, one client per (service, project, location) is shared by all the modules of this instance 
+# so that the channel setup and the auth token fetch happen once per instance instead of once per task
+clients = {}
+clients_lock = threading.Lock()
+
+BIGQUERY = 'bigquery'
+STORAGE = 'storage'
+FIRESTORE = 'firestore'
+DATACATALOG = 'datacatalog'
+POLICY_TAG_MANAGER = 'policytagmanager'
+CLOUD_TASKS = 'cloudtasks'
+RESOURCE_MANAGER = 'resourcemanager'
+
+
+def get_client(service, project=None, location=None):
+    
+    # project and location are None for the clients which use the default project and location 
+    key = (service, project, location)
+    client = clients.get(key)
+    
+    if client != None:
+        return client
+    
+    with clients_lock:
+        client = clients.get(key)
+        
+        if client == None:
+            client = create_client(service, project, location)
+            clients[key] = client
+    
+    return client
+
+
+def create_client(service, project, location):
+    
+    print('creating client for', service, project, location)
+    
+    if service == BIGQUERY:
+        return bigquery.Client(project=project, location=location)
+    
+    if service == STORAGE:
+        return storage.Client(project=project)
+    
+    if service == FIRESTORE:
+        return firestore.Client(project=project)
+    
+    if service == DATACATALOG:
+        return DataCatalogClient()
+    
+    if service == POLICY_TAG_MANAGER:
+        return datacatalog.PolicyTagManagerClient()
+    
+    if service == CLOUD_TASKS:
+        return tasks_v2.CloudTasksClient()
+    
+    if service == RESOURCE_MANAGER:
+        return resourcemanager_v3.ProjectsClient()
+    
+    raise ValueError('Unknown service: ' + service)
@@ -13,43 +13,60 @@
 # limitations under the License.
 
 from google.cloud import storage
-import csv
+import csv, sys, configparser
+import ClientRegistry as cr
+
+config = configparser.ConfigParser()
+config.read("tagengine.ini")
+CSV_READ_CHUNK_SIZE = int(config['DEFAULT'].get('CSV_READ_CHUNK_SIZE', 8388608)) # bytes per GCS read
 
 class CsvParser:
 
     @staticmethod
     def extract_tags(csv_file):
         
-        gcs_client = storage.Client()
-        extracted_tags = [] # stores the result set
+        return list(CsvParser.read_tags(csv_file))
+    
+    
+    @staticmethod
+    def iter_tags(csv_files):
+        
+        # yields the tags of all the CSV files, one row at a time
+        for csv_file in csv_files:
+            yield from CsvParser.read_tags(csv_file)
+    
+    
+    @staticmethod
+    def read_tags(csv_file):
+        
+        gcs_client = cr.get_client(cr.STORAGE)
 
-        # download the CSV file from GCS
+        # the CSV file is streamed from GCS in chunks, only the current chunk is held in memory 
         bucket_name, filename = csv_file
-        bucket = gcs_client.get_bucket(bucket_name)
-        blob = bucket.get_blob(filename)
-        
-        tmp_file = '/tmp/' + filename
-        blob.download_to_filename(filename=tmp_file)
+        blob = gcs_client.bucket(bucket_name).blob(filename)
         
-        with open(tmp_file, 'r') as f:
+        with blob.open('r', chunk_size=CSV_READ_CHUNK_SIZE, newline='') as f:
             
             reader = csv.reader(f)
+            header = None
             
-            for i, row in enumerate(reader):
+            for row in reader:
                 
-                if i == 0:
-                    header = row 
-                else:
-                    tag_extract = {}
-                    
-                    for j, val in enumerate(row):
-                        
-                        if val != '':
-                            tag_extract[header[j]] = val.rstrip()
+                if header == None:
+                    # the keys are shared by the tags of every row and every file
+                    header = [sys.intern(key) for key in row]
+                    continue
+                
+                tag_extract = {}
+                
+                for key, val in zip(header, row):
                     
-                    extracted_tags.append(tag_extract)       
-        
-        return extracted_tags
+                    if val != '':
+                        tag_extract[key] = val.rstrip()
+                
+                # blank lines don't make a tag
+                if len(tag_extract) > 0:
+                    yield tag_extract
     
 if __name__ == '__main__':
     
@@ -63,4 +80,4 @@ if __name__ == '__main__':
     #csv_file = ('catalog_metadata_imports', 'finwire_column_tags.csv')
     #extracted_tags = BackupFileParser.extract_tags(csv_file)
     #print('extracted_tags: ', extracted_tags)
-        
\ No newline at end of file
+        
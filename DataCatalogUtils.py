@@ -12,8 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import requests, configparser, time
-from datetime import datetime, date
+import requests, configparser, time, re
+from datetime import datetime, date, timezone
 from datetime import time as dtime
 import pytz
 from operator import itemgetter
@@ -21,6 +21,9 @@ import pandas as pd
 from pyarrow import parquet
 import json
 import os
+import copy
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from google.protobuf.timestamp_pb2 import Timestamp
 from google.cloud import datacatalog
@@ -33,11 +36,31 @@ import Resources as res
 import TagEngineUtils as te
 import BigQueryUtils as bq
 import PubSubUtils as ps
+import QueryCache as qc
+import RateLimiter as rl
+import ClientRegistry as cr
 import constants
 
 config = configparser.ConfigParser()
 config.read("tagengine.ini")
 BIGQUERY_REGION = config['DEFAULT']['BIGQUERY_REGION']
+TEMPLATE_CACHE_TTL = int(config['DEFAULT'].get('TEMPLATE_CACHE_TTL', 600)) # seconds
+TAG_WRITE_WORKERS = int(config['DEFAULT'].get('TAG_WRITE_WORKERS', 8)) # concurrent tag writes per task
+FUSED_QUERY_SIZE = int(config['DEFAULT'].get('FUSED_QUERY_SIZE', 400)) # max subqueries per fused query
+
+# columns of the export report tables, see BigQueryUtils.get_report_*_schema
+export_column_names = {
+    'catalog_report_dataset_tags': ['project', 'dataset', 'tag_template', 'tag_field', 'tag_value', 'export_time'],
+    'catalog_report_table_tags': ['project', 'dataset', 'table', 'tag_template', 'tag_field', 'tag_value', 'export_time'],
+    'catalog_report_column_tags': ['project', 'dataset', 'table', 'column', 'tag_template', 'tag_field', 'tag_value', 'export_time'],
+}
+
+# comments, string literals, quoted identifiers, parentheses and words, in the order they appear in a query, see is_fusable
+query_token_pattern = re.compile(r"--[^\n]*|#[^\n]*|/\*.*?\*/|'(?:\\.|[^'\\])*'|\"(?:\\.|[^\"\\])*\"|`[^`]*`|[()]|\w+", re.DOTALL)
+
+# process-wide cache of parsed tag template fields: template_path -> (expiration time, fields)
+template_cache = {}
+template_cache_lock = threading.Lock()
 
 class DataCatalogUtils:
     
@@ -46,20 +69,91 @@ class DataCatalogUtils:
         self.template_project = template_project
         self.template_region = template_region
         
-        self.client = DataCatalogClient()
+        self.client = cr.get_client(cr.DATACATALOG)
+        self.store = te.TagEngineUtils()
+        self.tag_index = {} # entry name -> tags on the entry, see get_tag_index
+        self.template_fields = None # set by use_template_fields
+        self.query_cache = None # set by enable_query_cache
+        self.tag_history = None # set by get_tag_history
+        self.tag_stream = None # set by get_tag_stream
+        self.export_columns = {} # (target_project, target_dataset, target_region, report_table) -> columns, see flush_export
+        self.write_counters = {'tags_created': 0, 'tags_updated': 0, 'tags_skipped': 0}
+        self.write_counters_lock = threading.Lock()
         
         if template_id is not None and template_project is not None and template_region is not None:
             self.template_path = DataCatalogClient.tag_template_path(template_project, template_region, template_id)
     
+    def get_counters(self):
+        
+        # statistics which get recorded on the job, see JobManager.record_counters
+        with self.write_counters_lock:
+            counters = dict(self.write_counters)
+        
+        if self.query_cache != None:
+            counters.update(self.query_cache.get_counters())
+        
+        if self.tag_stream != None:
+            counters.update(self.tag_stream.get_counters())
+        
+        return counters
+    
+    
+    def increment_write_counter(self, counter_name):
+        
+        with self.write_counters_lock:
+            self.write_counters[counter_name] += 1
+    
+    
+    def get_tag_history(self):
+        
+        # the tag history rows buffered by this object are inserted by flush_tag_history
+        with self.write_counters_lock:
+            if self.tag_history == None:
+                self.tag_history = bq.BigQueryUtils()
+        
+        return self.tag_history
+    
+    
+    def flush_tag_history(self):
+        
+        if self.tag_history == None:
+            return True
+        
+        return self.tag_history.flush_history()
+    
+    
+    def get_tag_stream(self):
+        
+        # the messages published by this object are awaited by flush_tag_stream
+        with self.write_counters_lock:
+            if self.tag_stream == None:
+                self.tag_stream = ps.PubSubUtils()
+        
+        return self.tag_stream
+    
+    
+    def flush_tag_stream(self):
+        
+        # returns the number of tag stream messages which were lost
+        if self.tag_stream == None:
+            return 0
+        
+        return self.tag_stream.flush()
+    
+    
+    def enable_query_cache(self, job_uuid):
+        
+        # the results of the query expressions are reused by all the tasks of the job
+        self.query_cache = qc.QueryCache(job_uuid)
+        
+        
     def get_template(self, included_fields=None):
         
         fields = []
         
-        tag_template = self.client.get_tag_template(name=self.template_path)
-        
-        for field_id, field_value in tag_template.fields.items():
+        for template_field in self.get_template_fields():
             
-            field_id = str(field_id)
+            field_id = template_field['field_id']
             
             if included_fields:
                 match_found = False
@@ -82,62 +176,103 @@ class DataCatalogUtils:
                 if match_found == False:
                     continue
             
-            display_name = field_value.display_name
-            is_required = field_value.is_required
-            order = field_value.order
-     
-            #print("field_id: " + str(field_id))
-            #print("field_value: " + str(field_value))
-            #print("display_name: " + display_name)
-            #print("primitive_type: " + str(FieldType.primitive_type))
-            #print("is_required: " + str(is_required))
+            # copy the cached field, callers are free to modify the dicts they get back
+            field = dict(template_field)
             
-            enum_values = []
+            if 'enum_values' in template_field:
+                field['enum_values'] = list(template_field['enum_values'])
+                
+            if included_fields:
+                if assigned_value:
+                   field['field_value'] = assigned_value
+                if query_expression:
+                   field['query_expression'] = query_expression
+
+            fields.append(field)
+                          
+        return sorted(fields, key=itemgetter('order'), reverse=True)
+    
+    
+    def get_template_fields(self, refresh=False):
+        
+        # parsed template fields are cached per process and keyed by template path, 
+        # which saves a get_tag_template call on every tag write when tag history is on 
+        # refresh = True reads the template even when it's cached, and updates the cache
+        if self.template_fields != None:
+            return self.template_fields
+        
+        now = time.time()
+        
+        with template_cache_lock:
+            cached = template_cache.get(self.template_path)
+        
+        if cached != None and cached[0] > now and refresh == False:
+            return cached[1]
+        
+        tag_template = self.client.get_tag_template(name=self.template_path)
+        template_fields = DataCatalogUtils.parse_template_fields(tag_template)
+        
+        with template_cache_lock:
+            template_cache[self.template_path] = (now + TEMPLATE_CACHE_TTL, template_fields)
+        
+        return template_fields
+    
+    
+    def use_template_fields(self, template_fields):
+        
+        # fields which were parsed elsewhere, e.g. in a config snapshot, they're used by this object only
+        # and never written to the cache, so they can't outlive the cache TTL or an invalidation
+        self.template_fields = template_fields
+    
+    
+    @staticmethod
+    def parse_template_fields(tag_template):
+        
+        template_fields = []
+        
+        for field_id, field_value in tag_template.fields.items():
             
             field_type = None
+            primitive_type = field_value.type_.primitive_type
             
-            if field_value.type_.primitive_type == datacatalog.FieldType.PrimitiveType.DOUBLE:
+            if primitive_type == datacatalog.FieldType.PrimitiveType.DOUBLE:
                 field_type = "double"
-            if field_value.type_.primitive_type == datacatalog.FieldType.PrimitiveType.STRING:
+            if primitive_type == datacatalog.FieldType.PrimitiveType.STRING:
                 field_type = "string"
-            if field_value.type_.primitive_type == datacatalog.FieldType.PrimitiveType.BOOL:
+            if primitive_type == datacatalog.FieldType.PrimitiveType.BOOL:
                 field_type = "bool"
-            if field_value.type_.primitive_type == datacatalog.FieldType.PrimitiveType.TIMESTAMP:
+            if primitive_type == datacatalog.FieldType.PrimitiveType.TIMESTAMP:
                 field_type = "datetime"
-            if field_value.type_.primitive_type == datacatalog.FieldType.PrimitiveType.RICHTEXT:
+            if primitive_type == datacatalog.FieldType.PrimitiveType.RICHTEXT:
                 field_type = "richtext"
-            if field_value.type_.primitive_type == datacatalog.FieldType.PrimitiveType.PRIMITIVE_TYPE_UNSPECIFIED:
+            if primitive_type == datacatalog.FieldType.PrimitiveType.PRIMITIVE_TYPE_UNSPECIFIED:
                 field_type = "enum"
-                       
-                index = 0
-                enum_values_long = str(field_value.type_).split(":") 
-                for long_value in enum_values_long:
-                    if index > 0:
-                        enum_value = long_value.split('"')[1]
-                        #print("enum value: " + enum_value)
-                        enum_values.append(enum_value)
-                    index = index + 1
             
             # populate dict
             field = {}
-            field['field_id'] = field_id
-            field['display_name'] = display_name
+            field['field_id'] = str(field_id)
+            field['display_name'] = field_value.display_name
             field['field_type'] = field_type
-            field['is_required'] = is_required
-            field['order'] = order
+            field['is_required'] = field_value.is_required
+            field['order'] = field_value.order
             
             if field_type == "enum":
-                field['enum_values'] = enum_values
-                
-            if included_fields:
-                if assigned_value:
-                   field['field_value'] = assigned_value
-                if query_expression:
-                   field['query_expression'] = query_expression
-
-            fields.append(field)
-                          
-        return sorted(fields, key=itemgetter('order'), reverse=True)
+                field['enum_values'] = [enum_value.display_name for enum_value in field_value.type_.enum_type.allowed_values]
+            
+            template_fields.append(field)
+        
+        return template_fields
+    
+    
+    @staticmethod
+    def invalidate_template_cache(template_path=None):
+        
+        # drops a single template from the cache, or the entire cache when no template_path is given 
+        with template_cache_lock:
+            if template_path == None:
+                template_cache.clear()
+            else:
+                template_cache.pop(template_path, None)
     
         
     def check_if_exists(self, parent, column=None):
@@ -149,39 +284,18 @@ class DataCatalogUtils:
         tag_exists = False
         tag_id = ""
         
-        if column != None and column != "" and len(column) > 1:
+        if column == None:
+            column = ''
+        
+        if len(column) > 1:
             column = column.lower() # column is stored in lower case in the tag object
         
-        tag_list = self.client.list_tags(parent=parent, timeout=120)
+        tag_key = (self.template_project, self.template_region, self.template_id, column)
+        tag_instance = self.get_tag_index(parent).get(tag_key)
         
-        for tag_instance in tag_list:
-            
-            #print('tag_instance: ' + str(tag_instance))
-            #print('tag name: ' + str(tag_instance.name))
-            tagged_column = tag_instance.column
-            
-            #print('found tagged column: ' + tagged_column)            
-            tagged_template_project = tag_instance.template.split('/')[1]
-            tagged_template_location = tag_instance.template.split('/')[3]
-            tagged_template_id = tag_instance.template.split('/')[5]
-            
-            if column == '' or column == None:
-                # looking for a table-level tag
-                if tagged_template_id == self.template_id and tagged_template_project == self.template_project and \
-                    tagged_template_location == self.template_region and tagged_column == "":
-                    #print('DEBUG: table-level tag exists.')
-                    tag_exists = True
-                    tag_id = tag_instance.name
-                    #print('DEBUG: tag_id: ' + tag_id)
-                    break
-            else:
-                if column == tagged_column and tagged_template_id == self.template_id and tagged_template_project == self.template_project and \
-                    tagged_template_location == self.template_region:
-                    #print('DEBUG: column-level tag exists.')
-                    tag_exists = True
-                    tag_id = tag_instance.name
-                    #print('DEBUG: tag_id: ' + tag_id)
-                    break
+        if tag_instance != None:
+            tag_exists = True
+            tag_id = tag_instance.name
         
         #print('DEBUG: tag_exists: ' + str(tag_exists))
         #print('DEBUG: tag_id: ' + str(tag_id))
@@ -189,6 +303,86 @@ class DataCatalogUtils:
         return tag_exists, tag_id
     
     
+    def check_if_unchanged(self, parent, tag):
+        
+        # compares a tag update with the tag which is on the entry, as listed by get_tag_index,
+        # so that tags whose values haven't changed since the last run don't get written again
+        column = tag.column
+        
+        if len(column) > 1:
+            column = column.lower() # column is stored in lower case in the tag object
+        
+        tag_key = (self.template_project, self.template_region, self.template_id, column)
+        tag_instance = self.get_tag_index(parent).get(tag_key)
+        
+        if tag_instance == None or DataCatalogUtils.get_tag_values(tag) != DataCatalogUtils.get_tag_values(tag_instance):
+            return False
+        
+        print('tag is unchanged, skipping the update of', tag_instance.name)
+        self.increment_write_counter('tags_skipped')
+        
+        return True
+    
+    
+    @staticmethod
+    def get_tag_values(tag):
+        
+        # typed values of the tag fields, keyed by field id. The display names and order of the fields are ignored
+        tag_values = {}
+        
+        for field_id, tag_field in tag.fields.items():
+            
+            field_pb = datacatalog.TagField.pb(tag_field)
+            kind = field_pb.WhichOneof('kind')
+            
+            if kind == 'enum_value':
+                value = field_pb.enum_value.display_name
+            elif kind == 'timestamp_value':
+                value = (field_pb.timestamp_value.seconds, field_pb.timestamp_value.nanos)
+            elif kind != None:
+                value = getattr(field_pb, kind)
+            else:
+                value = None
+            
+            tag_values[field_id] = (kind, value)
+        
+        return tag_values
+    
+    
+    def get_tag_index(self, parent):
+        
+        # lists the tags on an entry once and keys them by (template_project, template_region, template_id, column), 
+        # so that the column-level lookups on a wide table don't each cost a list_tags round trip
+        if parent in self.tag_index:
+            return self.tag_index[parent]
+        
+        entry_index = {}
+        tag_list = self.client.list_tags(parent=parent, timeout=120)
+        
+        for tag_instance in tag_list:
+            self.index_tag(parent, tag_instance, entry_index)
+        
+        self.tag_index[parent] = entry_index
+        
+        return entry_index
+    
+    
+    def index_tag(self, parent, tag_instance, entry_index=None):
+        
+        # called after a create_tag so that the index stays in sync with the catalog
+        if entry_index == None:
+            
+            if parent not in self.tag_index:
+                return
+                
+            entry_index = self.tag_index[parent]
+        
+        # template format: projects/{project}/locations/{region}/tagTemplates/{template_id}
+        template_split = tag_instance.template.split('/')
+        tag_key = (template_split[1], template_split[3], template_split[5], tag_instance.column)
+        entry_index[tag_key] = tag_instance
+    
+    
     def apply_static_asset_config(self, fields, uri, config_uuid, template_uuid, tag_history, tag_stream, overwrite=False):
         
         print('*** apply_static_asset_config ***')
@@ -199,7 +393,7 @@ class DataCatalogUtils:
         print('tag_history: ', tag_history)
         
         # uri is either a BQ table/view path or GCS file path
-        store = te.TagEngineUtils()        
+        store = self.store        
         creation_status = constants.SUCCESS
         column = ''
         
@@ -265,8 +459,8 @@ class DataCatalogUtils:
         print('tag_history:', tag_history)
         print('tag_stream:', tag_stream)
         
-        store = te.TagEngineUtils()
-        bq_client = bigquery.Client(location=BIGQUERY_REGION)
+        store = self.store
+        bq_client = cr.get_client(cr.BIGQUERY, location=BIGQUERY_REGION)
         
         creation_status = constants.SUCCESS
         error_exists = False
@@ -287,17 +481,21 @@ class DataCatalogUtils:
         tag.template = self.template_path
         verified_field_count = 0
         
-        for field in fields:
+        # parse the query expressions and run as many of them as possible in a single query
+        query_strs = [self.parse_query_expression(uri, field['query_expression']) for field in fields]
+        fused_values = self.run_fused_query(bq_client, fields, query_strs, batch_mode)
+        
+        for index, field in enumerate(fields):
             field_id = field['field_id']
             field_type = field['field_type']
-            query_expression = field['query_expression']
-
-            # parse and run query in BQ
-            query_str = self.parse_query_expression(uri, query_expression)
+            query_str = query_strs[index]
             #print('returned query_str: ' + query_str)
             
             # note: field_values is of type list
-            field_values, error_exists = self.run_query(bq_client, query_str, field_type, batch_mode, store)
+            if index in fused_values:
+                field_values, error_exists = fused_values[index], False
+            else:
+                field_values, error_exists = self.run_query(bq_client, query_str, field_type, batch_mode, store)
             #print('field_values: ', field_values)
             #print('error_exists: ', error_exists)
     
@@ -337,9 +535,13 @@ class DataCatalogUtils:
             #print('tag request: ' + str(tag))
             tag.name = tag_id
             
+            # the values haven't changed since the last run, there's nothing to write or record
+            if self.check_if_unchanged(entry.name, tag):
+                return creation_status
+            
             try:
                 print('tag update request: ', tag)
-                response = self.client.update_tag(tag=tag)
+                response = self.update_tag(tag)
                 #print('response: ', response)
             except Exception as e:
                 print('Error occurred during tag update: ' + str(e))
@@ -350,7 +552,7 @@ class DataCatalogUtils:
 
             try:
                 print('tag create request: ', tag)
-                response = self.client.create_tag(parent=entry.name, tag=tag)
+                response = self.create_tag(entry.name, tag)
                 #print('response: ', response)
                 
             except Exception as e:
@@ -360,12 +562,12 @@ class DataCatalogUtils:
                 creation_status = constants.ERROR
             
         if creation_status == constants.SUCCESS and tag_history:
-            bqu = bq.BigQueryUtils()
+            bqu = self.get_tag_history()
             template_fields = self.get_template()
             bqu.copy_tag(self.template_id, template_fields, uri, None, fields)
             
         if creation_status == constants.SUCCESS and tag_stream:
-            psu = ps.PubSubUtils()
+            psu = self.get_tag_stream()
             psu.copy_tag(self.template_id, uri, None, fields)
                 
                                  
@@ -383,8 +585,8 @@ class DataCatalogUtils:
         #print('tag_history:', tag_history)
         #print('tag_stream:', tag_stream)
                 
-        store = te.TagEngineUtils()
-        bq_client = bigquery.Client(location=BIGQUERY_REGION)
+        store = self.store
+        bq_client = cr.get_client(cr.BIGQUERY, location=BIGQUERY_REGION)
         
         creation_status = constants.SUCCESS
         error_exists = False
@@ -412,18 +614,31 @@ class DataCatalogUtils:
         request.linked_resource=bigquery_resource
         entry = self.client.lookup_entry(request)
         
-        schema_columns = [] # columns in the entry's schema
+        schema_columns = set() # columns in the entry's schema
                 
         for column_schema in entry.schema.columns:
-            schema_columns.append(column_schema.column)
+            schema_columns.add(column_schema.column)
             
         #print('schema_columns:', schema_columns)
-
+        
+        # skip columns not found in the entry's schema
+        columns = [column for column in columns if column in schema_columns]
+        
+        # the field expressions of all the columns are fused into as few queries as possible, 
+        # instead of running one query per column per field
+        query_strs = []
+        
         for column in columns:
-            
-            # skip columns not found in the entry's schema
-            if column not in schema_columns:
-                continue
+            for field in fields:
+                query_strs.append(self.parse_query_expression(uri, field['query_expression'], column))
+        
+        fused_values = self.run_fused_query(bq_client, fields * len(columns), query_strs, batch_mode)
+
+        # the column tags are built first and then written concurrently
+        write_requests = []
+        column_fields = []
+        
+        for column_index, column in enumerate(columns):
             
             # check to see if a tag has already been created on this column
             tag_exists, tag_id = self.check_if_exists(entry.name, column)
@@ -436,16 +651,19 @@ class DataCatalogUtils:
             
             verified_field_count = 0
             
-            for field in fields:
+            for field_index, field in enumerate(fields):
                 field_id = field['field_id']
                 field_type = field['field_type']
-                query_expression = field['query_expression']
-
-                query_str = self.parse_query_expression(uri, query_expression, column)
+                
+                index = column_index * len(fields) + field_index
+                query_str = query_strs[index]
                 #print('returned query_str: ' + query_str)
             
                 # note: field_values is of type list
-                field_values, error_exists = self.run_query(bq_client, query_str, field_type, batch_mode, store)
+                if index in fused_values:
+                    field_values, error_exists = fused_values[index], False
+                else:
+                    field_values, error_exists = self.run_query(bq_client, query_str, field_type, batch_mode, store)
                 #print('field_values: ', field_values)
                 #print('error_exists: ', error_exists)
     
@@ -477,48 +695,26 @@ class DataCatalogUtils:
                 creation_status = constants.ERROR
             
             if verified_field_count == 0:
-                # tag is empty due to errors, skip tag creation
-                return constants.ERROR
-            
-            # we are ready to create or update the tag 
-                       
-            if tag_exists == True:
-                #print('updating tag')
-                #print('tag request: ' + str(tag))
-                tag.name = tag_id
+                # tag is empty due to errors, skip tag creation for this and the remaining columns
+                creation_status = constants.ERROR
+                break
             
-                try:
-                    print('tag update request: ', tag)
-                    response = self.client.update_tag(tag=tag)
-                    #print('response: ', response)
-                except Exception as e:
-                    print('Error occurred during tag update: ' + str(e))
-                    msg = 'Error occurred during tag update: ' + str(e)
-                    store.write_tag_op_error(constants.TAG_UPDATED, config_uuid, 'DYNAMIC_COLUMN_TAG', msg)
-                    creation_status = constants.ERROR
-            else:
+            # the tag is ready to be created or updated, the fields get copied because they're reused for the next column
+            write_requests.append((tag, tag_exists, tag_id, entry.name))
+            column_fields.append((column, copy.deepcopy(fields)))
 
-                try:
-                    print('tag create request: ', tag)
-                    response = self.client.create_tag(parent=entry.name, tag=tag)
-                    #print('response: ', response)
-                
-                except Exception as e:
-                    print('Error occurred during tag create: ', e)
-                    msg = 'Error occurred during tag create: ' + str(e)
-                    store.write_tag_op_error(constants.TAG_CREATED, config_uuid, 'DYNAMIC_COLUMN_TAG', msg)
-                    creation_status = constants.ERROR
+        # outer loop ends here                
+        
+        write_statuses = self.write_tags(write_requests, config_uuid, 'DYNAMIC_COLUMN_TAG')
+        
+        for write_status, (column, tagged_fields) in zip(write_statuses, column_fields):
             
-            if creation_status == constants.SUCCESS and tag_history:
-                bqu = bq.BigQueryUtils()
-                template_fields = self.get_template()
-                bqu.copy_tag(self.template_id, template_fields, uri, column, fields)
+            if write_status == constants.ERROR:
+                creation_status = constants.ERROR
+                continue
             
-            if creation_status == constants.SUCCESS and tag_stream:
-                psu = ps.PubSubUtils()
-                psu.copy_tag(self.template_id, uri, column, fields)
-
-        # outer loop ends here                
+            if write_status != constants.SKIPPED and (tag_history or tag_stream):
+                self.record_tag(uri, column, tagged_fields, tag_history, tag_stream)
                                  
         return creation_status
 
@@ -529,8 +725,8 @@ class DataCatalogUtils:
         print('** apply_entry_config **')
         
         creation_status = constants.SUCCESS
-        store = te.TagEngineUtils()
-        gcs_client = storage.Client()
+        store = self.store
+        gcs_client = cr.get_client(cr.STORAGE)
         
         bucket_name, filename = uri
         bucket = gcs_client.get_bucket(bucket_name)
@@ -693,16 +889,16 @@ class DataCatalogUtils:
                     field['field_value'] = blob.media_link # field_value is used by the BQ exporter
 
             #print('tag request: ', tag)
-            created_tag = self.client.create_tag(parent=entry_name, tag=tag)
+            created_tag = self.create_tag(entry_name, tag)
             #print('created_tag: ', created_tag)
             
             if tag_history:
-                bqu = bq.BigQueryUtils()
+                bqu = self.get_tag_history()
                 template_fields = self.get_template()
                 bqu.copy_tag(self.template_id, template_fields, '/'.join(uri), None, fields)
             
             if tag_stream:
-                psu = ps.PubSubUtils()
+                psu = self.get_tag_stream()
                 psu.copy_tag(self.template_id, uri, column, fields)
                                     
         return creation_status
@@ -745,7 +941,7 @@ class DataCatalogUtils:
         #print('tag_stream: ', tag_stream)
  
         # uri is either a BQ table/view path or GCS file path
-        store = te.TagEngineUtils()        
+        store = self.store        
         creation_status = constants.SUCCESS
         
         is_gcs = False
@@ -812,7 +1008,7 @@ class DataCatalogUtils:
         #print('query_str: ', query_str)
 
         # run query against mapping table
-        bq_client = bigquery.Client(location=BIGQUERY_REGION)
+        bq_client = cr.get_client(cr.BIGQUERY, location=BIGQUERY_REGION)
         rows = bq_client.query(query_str).result()
         
         tag = datacatalog.Tag()
@@ -843,44 +1039,26 @@ class DataCatalogUtils:
             # tag already exists and overwrite is True
             tag.name = tag_id
             
+            # the values haven't changed since the last run, there's nothing to write or record
+            if self.check_if_unchanged(entry.name, tag):
+                return creation_status
+            
             try:
                 print('tag update: ', tag)
-                response = self.client.update_tag(tag=tag)
+                response = self.update_tag(tag)
             except Exception as e:
                 msg = 'Error occurred during tag update: ' + str(e)
                 store.write_tag_op_error(constants.TAG_UPDATED, config_uuid, 'GLOSSARY_ASSET_TAG', msg)
-                
-                # sleep and retry the tag update
-                if 'Quota exceeded for quota metric' or '503 The service is currently unavailable' in str(e):
-                    print('sleep for 3 minutes due to ' + str(e))
-                    time.sleep(180)
-                    
-                    try:
-                        response = self.client.update_tag(tag=tag)
-                    except Exception as e:
-                        msg = 'Error occurred during tag update after sleep: ' + str(e)
-                        store.write_tag_op_error(constants.TAG_UPDATED, config_uuid, 'GLOSSARY_ASSET_TAG', msg)
         else:
             try:
                 print('tag create: ', tag)
-                response = self.client.create_tag(parent=entry.name, tag=tag)
+                response = self.create_tag(entry.name, tag)
             except Exception as e:
                 msg = 'Error occurred during tag create: ' + str(e) + '. Failed tag request = ' + str(tag)
                 store.write_tag_op_error(constants.TAG_CREATED, config_uuid, 'GLOSSARY_ASSET_TAG', msg)
-                
-                # sleep and retry write
-                if 'Quota exceeded for quota metric' or '503 The service is currently unavailable' in str(e):
-                    print('sleep for 3 minutes due to ' + str(e))
-                    time.sleep(180)
-                    
-                    try:
-                        response = self.client.create_tag(parent=entry.name, tag=tag)
-                    except Exception as e:
-                        msg = 'Error occurred during tag create after sleep: ' + str(e)
-                        store.write_tag_op_error(constants.TAG_CREATED, config_uuid, 'GLOSSARY_ASSET_TAG', msg)
                     
         if tag_history:
-            bqu = bq.BigQueryUtils()
+            bqu = self.get_tag_history()
             template_fields = self.get_template()
             if is_gcs:
                 bqu.copy_tag(self.template_id, template_fields, '/'.join(uri), None, fields)
@@ -888,9 +1066,9 @@ class DataCatalogUtils:
                 bqu.copy_tag(self.template_id, template_fields, uri, None, fields)
         
         if tag_stream:
-            psu = ps.PubSubUtils()
+            psu = self.get_tag_stream()
             if is_gcs:
-                bqu.copy_tag(self.template_id, '/'.join(uri), None, fields)
+                psu.copy_tag(self.template_id, '/'.join(uri), None, fields)
             if is_bq:
                 psu.copy_tag(self.template_id, uri, None, fields)
            
@@ -913,7 +1091,7 @@ class DataCatalogUtils:
         print('template_uuid: ', template_uuid)
         
         if create_policy_tags:
-            ptm_client = datacatalog.PolicyTagManagerClient()
+            ptm_client = cr.get_client(cr.POLICY_TAG_MANAGER)
             
             request = datacatalog.ListPolicyTagsRequest(
                 parent=taxonomy_id
@@ -937,7 +1115,7 @@ class DataCatalogUtils:
                                      # so that we can create the policy tags on the various sensitive fields
  
         # uri is a BQ table path 
-        store = te.TagEngineUtils()        
+        store = self.store        
         creation_status = constants.SUCCESS
         column = ''
         
@@ -979,7 +1157,7 @@ class DataCatalogUtils:
         
         #print('dlp_sql: ', dlp_sql)
         
-        bq_client = bigquery.Client(location=BIGQUERY_REGION)
+        bq_client = cr.get_client(cr.BIGQUERY, location=BIGQUERY_REGION)
         
         try:
             dlp_rows = bq_client.query(dlp_sql).result()
@@ -1078,12 +1256,16 @@ class DataCatalogUtils:
     
         print('classification_result: ', classification_result)
         
-        tag = datacatalog.Tag()
-        tag.template = self.template_path
+        # the column tags are built first and then written concurrently
+        write_requests = []
+        column_fields = []
         
         # each element represents a field which needs to be tagged
         for infotype_field in infotype_fields:
             
+            tag = datacatalog.Tag()
+            tag.template = self.template_path
+            
             for field in fields:
                 if 'sensitive_field' in field['field_id']:
                     bool_field = datacatalog.TagField()
@@ -1113,78 +1295,32 @@ class DataCatalogUtils:
             except Exception as e:
                 print('Error during check_if_exists: ', e)
                 creation_status = constants.ERROR
-                return creation_status   
+                continue
             
-            # tag already exists    
-            if tag_exists:
-                
-                if overwrite == False:
-                    # skip this sensitive column because it is already tagged
-                    continue
-                
-                tag.name = tag_id
+            # skip this sensitive column because it is already tagged
+            if tag_exists and overwrite == False:
+                continue
             
-                try:
-                    print('tag update request: ', tag)
-                    response = self.client.update_tag(tag=tag)
-                
-                    #print('response: ', response)
-                    
-                except Exception as e:
-                    msg = 'Error occurred during tag update: ' + str(e) + '. Failed tag request = ' + str(tag)
-                    store.write_tag_op_error(constants.TAG_UPDATED, config_uuid, 'SENSITIVE_TAG', msg)
-                
-                    # sleep and retry the tag update
-                    if 'Quota exceeded for quota metric' or '503 The service is currently unavailable' in str(e):
-                        print('sleep for 3 minutes due to ' + str(e))
-                        time.sleep(180)
-                    
-                        try:
-                            response = self.client.update_tag(tag=tag)
-                        except Exception as e:
-                            msg = 'Error occurred during tag update after sleep: ' + str(e)
-                            print(msg)
-                            store.write_tag_op_error(constants.TAG_UPDATED, config_uuid, 'SENSITIVE_TAG', msg)
-            else:
-                try:
-                    print('tag create request: ', tag)
-                    response = self.client.create_tag(parent=entry.name, tag=tag)
-
-                except Exception as e:
-                    msg = 'Error occurred during tag create: ' + str(e) + '. Failed tag request = ' + str(tag)
-                    print(msg)
-                    store.write_tag_op_error(constants.TAG_CREATED, config_uuid, 'SENSITIVE_TAG', msg)
-                
-                    # sleep and retry write
-                    if 'Quota exceeded for quota metric' or '503 The service is currently unavailable' in str(e):
-                        print('sleep for 3 minutes due to ' + str(e))
-                        time.sleep(180)
-                    
-                        try:
-                            response = self.client.create_tag(parent=entry.name, tag=tag)
-                        except Exception as e:
-                            msg = 'Error occurred during tag create after sleep: ' + str(e)
-                            print(msg)
-                            store.write_tag_op_error(constants.TAG_CREATED, config_uuid, 'SENSITIVE_TAG', msg)
-                    else:
-                        # could not create the tag, could be due to a column mismatch
-                        creation_status = constants.ERROR
+            write_requests.append((tag, tag_exists, tag_id, entry.name))
+            column_fields.append((infotype_field, copy.deepcopy(fields)))
+        
+        write_statuses = self.write_tags(write_requests, config_uuid, 'SENSITIVE_TAG')
+        
+        for write_status, (infotype_field, tagged_fields) in zip(write_statuses, column_fields):
+            
+            if write_status == constants.ERROR:
+                # could not create the tag, could be due to a column mismatch
+                creation_status = constants.ERROR
+                continue
                     
-            if creation_status == constants.SUCCESS and create_policy_tags and classification_result != 'Public_Information':
+            if create_policy_tags and classification_result != 'Public_Information':
                 # add the column name and policy tag name to a list
                 for policy_tag_name, policy_tag_category in policy_tag_names:
                     if policy_tag_category == classification_result:
                         policy_tag_requests.append((infotype_field, policy_tag_name))
                     
-                            
-            if creation_status == constants.SUCCESS and tag_history:
-                bqu = bq.BigQueryUtils()
-                template_fields = self.get_template()
-                bqu.copy_tag(self.template_id, template_fields, uri, infotype_field, fields)
-        
-            if creation_status == constants.SUCCESS and tag_stream:
-                psu = ps.PubSubUtils()
-                psu.copy_tag(self.template_id, uri, infotype_field, fields)
+            if write_status != constants.SKIPPED and (tag_history or tag_stream):
+                self.record_tag(uri, infotype_field, tagged_fields, tag_history, tag_stream)
         
                 
         # Once we have created the regular tags, we can create/update the policy tags
@@ -1200,7 +1336,7 @@ class DataCatalogUtils:
         
         success = True
         
-        bq_client = bigquery.Client(location=BIGQUERY_REGION)
+        bq_client = cr.get_client(cr.BIGQUERY, location=BIGQUERY_REGION)
         table = bq_client.get_table(table_id) 
         schema = table.schema
 
@@ -1243,12 +1379,7 @@ class DataCatalogUtils:
         print('target_region:', target_region)
         print('uri:', uri)
         
-        column_tag_records = []
-        table_tag_records = []
-        dataset_tag_records = []
-        
         export_status = constants.SUCCESS
-        bqu = bq.BigQueryUtils(target_region)
         
         if isinstance(uri, str) == False:
             print('Error: url ' + str(url) + ' is not of type string.')
@@ -1258,11 +1389,12 @@ class DataCatalogUtils:
         tagged_project = uri.split('/')[0]
         tagged_dataset = uri.split('/')[2]
         
+        # the report table of the tags on the asset itself, the column tags go to catalog_report_column_tags
         if '/tables/' in uri:
-            target_table_id = 'catalog_report_table_tags'
+            asset_report_table = 'catalog_report_table_tags'
             tagged_table = uri.split('/')[4]
         else:
-            target_table_id = 'catalog_report_dataset_tags'
+            asset_report_table = 'catalog_report_dataset_tags'
             tagged_table = None
             
         bigquery_resource = '//bigquery.googleapis.com/projects/' + uri
@@ -1279,80 +1411,100 @@ class DataCatalogUtils:
             return export_status
 
         tag_list = self.client.list_tags(parent=entry.name, timeout=120)
+        export_time = datetime.now(timezone.utc)
     
         for tag in tag_list:
             print('tag.template:', tag.template)
             print('tag.column:', tag.column)
             
-            # get tag template fields
-            self.template_id = tag.template.split('/')[5]
-            self.template_project = tag.template.split('/')[1]
-            self.template_region = tag.template.split('/')[3]
-            self.template_path = tag.template
-            template_fields = self.get_template()
+            template_id = tag.template.split('/')[5]
             
             if tag.column and len(tag.column) > 1:
                 tagged_column = tag.column
-                target_table_id = 'catalog_report_column_tags'
+                report_table = 'catalog_report_column_tags'
             else:
-                tagged_column = None
-                target_table_id = 'catalog_report_table_tags'
+                report_table = asset_report_table
             
-            for template_field in template_fields:
-    
-                #print('template_field:', template_field)
-                field_id = template_field['field_id']
-                
-                if field_id not in tag.fields:
-                    continue
-                    
-                tagged_field = tag.fields[field_id]
-                tagged_field_str = str(tagged_field)
-                tagged_field_split = tagged_field_str.split('\n')
-                #print('tagged_field_split:', tagged_field_split)
-                
-                split_index = 0
+            # the rows are buffered per report table and loaded by flush_export
+            columns = self.get_export_columns(target_project, target_dataset, target_region, report_table)
+            
+            for field_id, field_value in self.get_export_values(tag).items():
                 
-                for split in tagged_field_split:
-                    if '_value:' in split:
-                        start_index = split.index(':', 0) + 1
-                        #print('start_index:', start_index)
-                        field_value = split[start_index:].strip().replace('"', '').replace('<br>', ',')
-                        print('extracted field_value:', field_value)
-                        break
-                    elif 'enum_value' in split:
-                        field_value = tagged_field_split[split_index+1].replace('display_name:', '').replace('"', '').strip()
-                        print('extracted field_value:', field_value)
-                        break
-                    
-                    split_index += 1                    
-                    
-                # format record to be written
-                current_ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S") + " UTC"
+                columns['project'].append(tagged_project)
+                columns['dataset'].append(tagged_dataset)
                 
-                if target_table_id in 'catalog_report_column_tags':
-                    column_tag_records.append({"project": tagged_project, "dataset": tagged_dataset, "table": tagged_table, "column": tagged_column, "tag_template": self.template_id, "tag_field": field_id, "tag_value": field_value, "export_time": current_ts})
+                if report_table != 'catalog_report_dataset_tags':
+                    columns['table'].append(tagged_table)
                 
-                elif target_table_id in 'catalog_report_table_tags':
-                    table_tag_records.append({"project": tagged_project, "dataset": tagged_dataset, "table": tagged_table, "tag_template": self.template_id, "tag_field": field_id, "tag_value": field_value, "export_time": current_ts})
+                if report_table == 'catalog_report_column_tags':
+                    columns['column'].append(tagged_column)
                 
-                elif target_table_id in 'catalog_report_dataset_tags':
-                    dataset_tag_records.append({"project": tagged_project, "dataset": tagged_dataset, "tag_template": self.template_id, "tag_field": field_id, "tag_value": field_value, "export_time": current_ts})
-                      
-        # write exported records to BQ
-        if len(dataset_tag_records) > 0:
-            target_table_id = target_project + '.' + target_dataset + '.catalog_report_dataset_tags'
-            success = bqu.insert_exported_records(target_table_id, dataset_tag_records)
-        
-        if len(table_tag_records) > 0:
-            target_table_id = target_project + '.' + target_dataset + '.catalog_report_table_tags'
-            success = bqu.insert_exported_records(target_table_id, table_tag_records)
-                    
-        if len(column_tag_records) > 0:
-            target_table_id = target_project + '.' + target_dataset + '.catalog_report_column_tags'
-            success = bqu.insert_exported_records(target_table_id, column_tag_records)
+                columns['tag_template'].append(template_id)
+                columns['tag_field'].append(field_id)
+                columns['tag_value'].append(field_value)
+                columns['export_time'].append(export_time)
                      
         return export_status
+    
+    
+    @staticmethod
+    def get_export_values(tag):
+        
+        # the values of the tag fields formatted as the report tables' tag_value strings, read from the typed fields
+        export_values = {}
+        
+        for field_id, tag_field in tag.fields.items():
+            
+            field_pb = datacatalog.TagField.pb(tag_field)
+            kind = field_pb.WhichOneof('kind')
+            
+            if kind == 'enum_value':
+                field_value = field_pb.enum_value.display_name
+            elif kind == 'timestamp_value':
+                field_value = field_pb.timestamp_value.ToJsonString()
+            elif kind == 'bool_value':
+                field_value = str(field_pb.bool_value).lower()
+            elif kind == 'double_value':
+                field_value = str(field_pb.double_value)
+            elif kind == 'string_value' or kind == 'richtext_value':
+                field_value = getattr(field_pb, kind).replace('<br>', ',')
+            else:
+                continue
+            
+            export_values[field_id] = field_value
+        
+        return export_values
+    
+    
+    def get_export_columns(self, target_project, target_dataset, target_region, report_table):
+        
+        key = (target_project, target_dataset, target_region, report_table)
+        
+        if key not in self.export_columns:
+            self.export_columns[key] = {column_name: [] for column_name in export_column_names[report_table]}
+        
+        return self.export_columns[key]
+    
+    
+    def flush_export(self):
+        
+        # loads the rows exported by this object, with one load job per report table
+        success = True
+        
+        for (target_project, target_dataset, target_region, report_table), columns in self.export_columns.items():
+            
+            if len(columns['tag_value']) == 0:
+                continue
+            
+            bqu = bq.BigQueryUtils(target_region)
+            target_table_id = target_project + '.' + target_dataset + '.' + report_table
+            
+            if bqu.load_exported_records(target_table_id, columns) == False:
+                success = False
+        
+        self.export_columns = {}
+        
+        return success
         
             
     def apply_import_config(self, config_uuid, tag_dict, tag_history, tag_stream, overwrite=False):
@@ -1437,6 +1589,10 @@ class DataCatalogUtils:
               
         creation_status = constants.SUCCESS
         
+        # the tags of the whole extract are built first and then written concurrently
+        write_requests = []
+        tagged_assets = []
+        
         for json_obj in tag_extract:
             #print('json_obj: ', json_obj)
         
@@ -1451,66 +1607,68 @@ class DataCatalogUtils:
             entry_name = 'projects/' + project_id + '/locations/' + location_id + '/entryGroups/' + entry_group + '/entries/' + entry_id
             print('entry_name: ', entry_name)
     
+            # a failed lookup only skips its own entry, the tags built for the other entries in the extract are still written
             try:
                 entry = self.client.get_entry(name=entry_name)
                 
             except Exception as e:
                 print("Error: couldn't find the entry: ", e)
                 creation_status = constants.ERROR
-                return creation_status
+                continue
+            
+            asset_tags = [] # (column_name, fields) 
             
             if 'columns' in json_obj:
-                # column-level tag
-                json_columns = json_obj['columns']
-                #print('json_columns: ', json_columns)
-                
-                for column_obj in json_columns:
-                
-                    column_name = column_obj['name'].split(':')[1]
-                    column_tags = column_obj['tags']
-                    fields = column_tags[0]['fields']
-                                     
-                    try:    
-                        tag_exists, tag_id = self.check_if_exists(parent=entry.name, column=column_name)
-        
-                    except Exception as e:
-                        print('Error during check_if_exists: ', e)
-                        creation_status = constants.ERROR
-                        return creation_status
-
-                    if tag_exists and overwrite == False:
-                        print('Tag already exists and overwrite flag is False')
-                        creation_status = constants.SUCCESS
-                        return creation_status
-            
-                    # create or update column-level tag
-                    uri = entry.linked_resource.replace('//bigquery.googleapis.com/projects/', '') + '/column/' + column_name
-                    creation_status = self.create_update_tag(fields, tag_exists, tag_id, config_uuid, 'RESTORE_TAG', tag_history, tag_stream, \
-                                                             entry, uri, column_name)
+                # column-level tags
+                for column_obj in json_obj['columns']:
+                    asset_tags.append((column_obj['name'].split(':')[1], column_obj['tags'][0]['fields']))
             
             if 'tags' in json_obj:
                 # table-level tag
-                json_tags = json_obj['tags'] 
-                fields = json_tags[0]['fields']
-                #print('fields: ', fields)  
+                asset_tags.append(('', json_obj['tags'][0]['fields']))
+            
+            for column_name, fields in asset_tags:
                 
                 try:    
-                    tag_exists, tag_id = self.check_if_exists(parent=entry.name, column='')
+                    tag_exists, tag_id = self.check_if_exists(parent=entry.name, column=column_name)
     
                 except Exception as e:
                     print('Error during check_if_exists: ', e)
                     creation_status = constants.ERROR
-                    return creation_status
+                    continue
 
                 if tag_exists and overwrite == False:
                     print('Tag already exists and overwrite flag is False')
-                    creation_status = constants.SUCCESS
-                    return creation_status
+                    continue
                 
-                # create or update table-level tag
-                uri = entry.linked_resource.replace('//bigquery.googleapis.com/projects/', '')
-                creation_status = self.create_update_tag(fields, tag_exists, tag_id, config_uuid, 'RESTORE_TAG', tag_history, \
-                                                         tag_stream, entry, uri)                     
+                tag = self.build_tag(fields, tag_history, column_name)
+                
+                # export file can have invalid tags, skip tag creation if that's the case
+                if tag == None:
+                    creation_status = constants.ERROR
+                    continue
+                
+                if column_name != '':
+                    uri = entry.linked_resource.replace('//bigquery.googleapis.com/projects/', '') + '/column/' + column_name
+                else:
+                    uri = entry.linked_resource.replace('//bigquery.googleapis.com/projects/', '')
+                
+                write_requests.append((tag, tag_exists, tag_id, entry.name))
+                tagged_assets.append((uri, column_name, fields))
+        
+        write_statuses = self.write_tags(write_requests, config_uuid, 'RESTORE_TAG')
+        
+        for write_status, (uri, column_name, fields) in zip(write_statuses, tagged_assets):
+            
+            if write_status == constants.ERROR:
+                creation_status = constants.ERROR
+                continue
+            
+            if write_status == constants.SKIPPED:
+                continue
+            
+            if self.record_tag(uri, column_name, fields, tag_history, tag_stream) == constants.ERROR:
+                creation_status = constants.ERROR
                     
         return creation_status
         
@@ -1520,9 +1678,30 @@ class DataCatalogUtils:
         print('create_update_tag')
         print('tag_history:', tag_history)
         
-        creation_status = constants.SUCCESS
+        tag = self.build_tag(fields, tag_history, column_name)
+        
+        # export file can have invalid tags, skip tag creation if that's the case 
+        if tag == None:
+            creation_status = constants.ERROR
+            return creation_status
+        
+        creation_status = self.write_tags([(tag, tag_exists, tag_id, entry.name)], config_uuid, config_type)[0]
+        
+        if creation_status == constants.ERROR:
+            return creation_status
+        
+        # nothing to record for an unchanged tag
+        if creation_status == constants.SKIPPED:
+            return constants.SUCCESS
+        
+        return self.record_tag(uri, column_name, fields, tag_history, tag_stream)
+    
+    
+    def build_tag(self, fields, tag_history, column_name=''):
+        
+        # builds the tag request from fields in the tag engine format or in the export file format, 
+        # returns None when none of the fields are valid
         valid_field = False
-        store = te.TagEngineUtils() 
         tag = datacatalog.Tag()
         tag.template = self.template_path
 
@@ -1606,60 +1785,103 @@ class DataCatalogUtils:
                 tag.fields[field_id] = datetime_field
                 field['field_value'] = timestamp  # store this value back in the field, so it can be exported
     
-        # export file can have invalid tags, skip tag creation if that's the case 
         if valid_field == False:
-            creation_status = constants.ERROR
-            return creation_status
+            return None
         
-        if column_name != '':
+        if column_name != '' and column_name != None:
             tag.column = column_name
             #print('tag.column == ' + column)   
+        
+        return tag
+    
+    
+    def write_tags(self, write_requests, config_uuid, config_type):
+        
+        # write_requests = list of (tag, tag_exists, tag_id, entry_name)
+        # the creates and updates are submitted from a bounded thread pool, the errors are written to the tag op log 
+        # in the order of the requests once all the writes are done, returns a creation status per request
+        # (constants.SKIPPED for an update which would not change the tag)
+        if len(write_requests) <= 1:
+            results = [self.write_tag(*write_request) for write_request in write_requests]
+        else:
+            with ThreadPoolExecutor(max_workers=TAG_WRITE_WORKERS) as executor:
+                results = list(executor.map(lambda write_request: self.write_tag(*write_request), write_requests))
+        
+        store = self.store
+        statuses = []
+        
+        for creation_status, errors in results:
+            
+            for tag_op, msg in errors:
+                store.write_tag_op_error(tag_op, config_uuid, config_type, msg)
+            
+            statuses.append(creation_status)
+        
+        return statuses
+    
+    
+    def create_tag(self, parent, tag):
+        
+        # all the tag writes go through the instance's rate limiter, transient errors are retried with backoff 
+        response = rl.datacatalog_write_retry.call(self.client.create_tag, parent=parent, tag=tag)
+        self.index_tag(parent, response)
+        self.increment_write_counter('tags_created')
+        
+        return response
+    
+    
+    def update_tag(self, tag):
+        
+        # tag name format: {entry name}/tags/{tag id}
+        response = rl.datacatalog_write_retry.call(self.client.update_tag, tag=tag)
+        self.index_tag(tag.name.split('/tags/')[0], response)
+        self.increment_write_counter('tags_updated')
+        
+        return response
     
+    
+    def write_tag(self, tag, tag_exists, tag_id, entry_name):
+        
+        # creates or updates a single tag, returns the creation status and the errors which occurred
+        # runs on the write_tags thread pool, so the errors get returned rather than written from here
+        errors = []
+        
         if tag_exists == True:
             tag.name = tag_id
-
-            try:
-                print('tag update: ', tag)
-                response = self.client.update_tag(tag=tag)
-            except Exception as e:
-                msg = 'Error occurred during tag update: ' + str(e)
-                store.write_tag_op_error(constants.TAG_UPDATED, config_uuid, config_type, msg)
-                
-                # sleep and retry the tag update
-                if 'Quota exceeded for quota metric' or '503 The service is currently unavailable' in str(e):
-                    print('sleep for 3 minutes due to ' + str(e))
-                    time.sleep(180)
-        
-                    try:
-                        response = self.client.update_tag(tag=tag)
-                    except Exception as e:
-                        msg = 'Error occurred during tag update after sleep: ' + str(e)
-                        store.write_tag_op_error(constants.TAG_UPDATED, config_uuid, config_type, msg)
-                        creation_status = constants.ERROR
-                        return creation_status
+            tag_op = constants.TAG_UPDATED
+            op_name = 'update'
+            
+            if self.check_if_unchanged(entry_name, tag):
+                return constants.SKIPPED, errors
         else:
-            try:
-                print('tag create: ', tag)
-                response = self.client.create_tag(parent=entry.name, tag=tag)
-            except Exception as e:
-                msg = 'Error occurred during tag create: ' + str(e) + '. Failed tag request = ' + str(tag)
-                store.write_tag_op_error(constants.TAG_CREATED, config_uuid, config_type, msg)
+            tag_op = constants.TAG_CREATED
+            op_name = 'create'
+        
+        try:
+            print('tag ' + op_name + ': ', tag)
+            
+            if tag_exists == True:
+                response = self.update_tag(tag)
+            else:
+                response = self.create_tag(entry_name, tag)
+            
+            return constants.SUCCESS, errors
+        
+        except Exception as e:
+            msg = 'Error occurred during tag ' + op_name + ': ' + str(e) + '. Failed tag request = ' + str(tag)
+            print(msg)
+            errors.append((tag_op, msg))
+        
+        return constants.ERROR, errors
+    
     
-                # sleep and retry write
-                if 'Quota exceeded for quota metric' or '503 The service is currently unavailable' in str(e):
-                    print('sleep for 3 minutes due to ' + str(e))
-                    time.sleep(180)
+    def record_tag(self, uri, column_name, fields, tag_history, tag_stream):
         
-                    try:
-                        response = self.client.create_tag(parent=entry.name, tag=tag)
-                    except Exception as e:
-                        msg = 'Error occurred during tag create after sleep: ' + str(e)
-                        store.write_tag_op_error(constants.TAG_CREATED, config_uuid, config_type, msg)
-                        creation_status = constants.ERROR
-                        return creation_status
+        # copies a tag which was written to the tag history table and to the tag stream
+        creation_status = constants.SUCCESS
         
         if tag_history:
-            bqu = bq.BigQueryUtils()
+            bqu = self.get_tag_history()
             template_fields = self.get_template()
             success = bqu.copy_tag(self.template_id, template_fields, uri, column_name, fields)
             
@@ -1668,7 +1890,7 @@ class DataCatalogUtils:
                 creation_status = constants.ERROR
 
         if tag_stream:
-            psu = ps.PubSubUtils()
+            psu = self.get_tag_stream()
             psu.copy_tag(self.template_id, uri, column_name, fields)
        
         return creation_status
@@ -1798,34 +2020,180 @@ class DataCatalogUtils:
         return query_str
     
     
+    def execute_query(self, bq_client, query_str, batch_mode):
+        
+        if batch_mode:
+            
+            batch_config = bigquery.QueryJobConfig(
+                # run at batch priority which won't count toward concurrent rate limit
+                priority=bigquery.QueryPriority.BATCH
+            )
+            
+            query_job = bq_client.query(query_str, job_config=batch_config)
+            job = bq_client.get_job(query_job.job_id, location=query_job.location)
+        
+            while job.state == 'RUNNING':
+                time.sleep(2)
+        
+            rows = job.result()
+        
+        else:
+            #print('query_str:', query_str)
+            rows = bq_client.query(query_str).result()
+            #print('rows:', rows)
+        
+        return rows
+    
+    
+    def run_fused_query(self, bq_client, fields, query_strs, batch_mode):
+        
+        # combines the query expressions of several fields into a single query, one scalar subquery per field, 
+        # which saves the job startup latency of running a query per field
+        # returns {field index: field_values} for the fields which got a value back from the fused query, 
+        # the remaining fields are expected to go through run_query
+        fused_values = {}
+        subqueries = []
+        
+        for index, (field, query_str) in enumerate(zip(fields, query_strs)):
+            
+            # richtext fields need all the rows, they always go through run_query
+            if field['field_type'] == 'richtext' or DataCatalogUtils.is_fusable(query_str) == False:
+                continue
+            
+            if self.query_cache != None:
+                cached_values = self.query_cache.get(query_str, False)
+                
+                if cached_values != None:
+                    fused_values[index] = cached_values
+                    continue
+            
+            subqueries.append((index, query_str))
+        
+        # large fusions (e.g. every field of every column in a table) are split up to stay within the query limits
+        for chunk_start in range(0, len(subqueries), FUSED_QUERY_SIZE):
+            
+            chunk = subqueries[chunk_start:chunk_start + FUSED_QUERY_SIZE]
+            
+            # nothing to gain from fusing a single query
+            if len(chunk) < 2:
+                continue
+            
+            fused_values.update(self.run_fused_chunk(bq_client, chunk, batch_mode))
+        
+        return fused_values
+    
+    
+    def run_fused_chunk(self, bq_client, subqueries, batch_mode):
+        
+        # each subquery gets its own column in a single row, so every field value keeps its own type
+        fused_values = {}
+        select_list = []
+        
+        for index, query_str in subqueries:
+            select_list.append('(SELECT * FROM (' + query_str.strip().rstrip(';') + ') LIMIT 1) AS f' + str(index))
+        
+        fused_query_str = 'SELECT ' + ', '.join(select_list)
+        #print('fused_query_str:', fused_query_str)
+        
+        try:
+            rows = list(self.execute_query(bq_client, fused_query_str, batch_mode))
+        
+        except Exception as e:
+
+            # e.g. one of the expressions returns more than one column, a single expression falls back to run_query
+            if len(subqueries) < 2:
+                print('Fused query failed, falling back to run_query. Error: ' + str(e))
+                return fused_values
+
+            # bisect the chunk, so that a bad expression only sends itself back to run_query
+            # instead of every other expression in the chunk
+            print('Fused query of ' + str(len(subqueries)) + ' expressions failed, splitting it in two. Error: ' + str(e))
+
+            middle = len(subqueries) // 2
+            fused_values.update(self.run_fused_chunk(bq_client, subqueries[:middle], batch_mode))
+            fused_values.update(self.run_fused_chunk(bq_client, subqueries[middle:], batch_mode))
+
+            return fused_values
+        
+        for index, query_str in subqueries:
+            
+            field_value = rows[0]['f' + str(index)]
+            
+            # an empty result can't be told apart from a null value, run_query handles both cases 
+            if field_value is None:
+                continue
+            
+            fused_values[index] = [field_value]
+            
+            if self.query_cache != None:
+                self.query_cache.put(query_str, False, [field_value])
+        
+        return fused_values
+    
+    
+    @staticmethod
+    def is_fusable(query_str):
+        
+        # only a single select statement can be used as a subquery, scripts and multiple statements can't 
+        query_str = query_str.strip().rstrip(';')
+        
+        if ';' in query_str:
+            return False
+        
+        if query_str.lower().startswith(('select', 'with', '(')) == False:
+            return False
+        
+        # an expression wrapped in parentheses is looked at without them
+        while query_str.startswith('(') and query_str.endswith(')') and DataCatalogUtils.top_level_words(query_str) == []:
+            query_str = query_str[1:-1].strip()
+        
+        # the order of a subquery isn't guaranteed to survive the LIMIT 1 of the fused query, 
+        # so an ordered expression has to go through run_query to get its first row
+        top_level_words = DataCatalogUtils.top_level_words(query_str)
+        
+        for word, next_word in zip(top_level_words, top_level_words[1:]):
+            if word == 'order' and next_word == 'by':
+                return False
+        
+        return True
+    
+    
+    @staticmethod
+    def top_level_words(query_str):
+        
+        # the lowercased words of a query which aren't inside parentheses, literals or comments
+        words = []
+        depth = 0
+        
+        for token in query_token_pattern.findall(query_str):
+            
+            if token == '(':
+                depth += 1
+            elif token == ')':
+                depth -= 1
+            elif depth == 0 and (token[0].isalnum() or token[0] == '_'):
+                words.append(token.lower())
+        
+        return words
+    
+    
     def run_query(self, bq_client, query_str, field_type, batch_mode, store):
         
         #print('*** enter run_query ***')
         
         field_values = []
         error_exists = False
+        all_rows = field_type == 'richtext'
+        
+        if self.query_cache != None:
+            cached_values = self.query_cache.get(query_str, all_rows)
             
-        try:
-            
-            if batch_mode:
-                
-                batch_config = bigquery.QueryJobConfig(
-                    # run at batch priority which won't count toward concurrent rate limit
-                    priority=bigquery.QueryPriority.BATCH
-                )
-                
-                query_job = bq_client.query(query_str, job_config=batch_config)
-                job = bq_client.get_job(query_job.job_id, location=query_job.location)
-            
-                while job.state == 'RUNNING':
-                    time.sleep(2)
+            if cached_values != None:
+                return cached_values, error_exists
             
-                rows = job.result()
+        try:
             
-            else:
-                #print('query_str:', query_str)
-                rows = bq_client.query(query_str).result()
-                #print('rows:', rows)
+            rows = self.execute_query(bq_client, query_str, batch_mode)
             
             # if query expression is well-formed, there should only be a single row returned with a single field_value
             # However, user may mistakenly run a query that returns a list of rows. In that case, grab only the top row.  
@@ -1835,8 +2203,8 @@ class DataCatalogUtils:
                 row_count = row_count + 1
                 field_values.append(row[0])
             
-                if field_type != 'richtext' and row_count == 1:
-                    return field_values, error_exists
+                if all_rows == False and row_count == 1:
+                    break
         
             # check row_count
             if row_count == 0:
@@ -1844,6 +2212,9 @@ class DataCatalogUtils:
                 #error_exists = True
                 print('query_str returned nothing, writing error entry')
                 store.write_tag_value_error('sql returned nothing: ' + query_str)
+            
+            elif self.query_cache != None:
+                self.query_cache.put(query_str, all_rows, field_values)
         
         except Exception as e:
             error_exists = True
@@ -2025,7 +2396,7 @@ class DataCatalogUtils:
             
                 try:
                     print('tag update request: ', target_tag)
-                    response = self.client.update_tag(tag=target_tag)
+                    response = self.update_tag(target_tag)
                 except Exception as e:
                     success = False
                     print('Error occurred during tag update: ', e)
@@ -2033,7 +2404,7 @@ class DataCatalogUtils:
             else:
                 try:
                     print('tag create request: ', target_tag)
-                    response = self.client.create_tag(parent=target_entry.name, tag=target_tag)
+                    response = self.create_tag(target_entry.name, target_tag)
                 except Exception as e:
                     success = False
                     print('Error occurred during tag create: ', e)
@@ -2048,7 +2419,7 @@ class DataCatalogUtils:
     
         success = True
     
-        bq_client = bigquery.Client(location=BIGQUERY_REGION)
+        bq_client = cr.get_client(cr.BIGQUERY, location=BIGQUERY_REGION)
 
         source_table_id = source_project + '.' + source_dataset + '.' + source_table
         target_table_id = target_project + '.' + target_dataset + '.' + target_table
@@ -2156,7 +2527,7 @@ class DataCatalogUtils:
             # update the tag
             try:
                 print('tag update request: ', target_tag)
-                response = self.client.update_tag(tag=target_tag)
+                response = self.update_tag(target_tag)
             except Exception as e:
                 success = False
                 print('Error occurred during tag update: ', e)
@@ -0,0 +1,623 @@
+# Copyright 2020-2022 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import uuid, json, copy, re, sqlite3, threading, configparser, datetime
+from contextlib import contextmanager
+
+from google.api_core import exceptions
+from google.cloud import firestore
+
+import ClientRegistry as cr
+
+config = configparser.ConfigParser()
+config.read("tagengine.ini")
+CONFIG_STORE = config['DEFAULT'].get('CONFIG_STORE', 'FIRESTORE') # store used by TagEngineUtils: FIRESTORE, MEMORY or SQLITE
+JOB_STORE = config['DEFAULT'].get('JOB_STORE', 'FIRESTORE') # store used by JobManager and TaskManager: FIRESTORE, MEMORY or SQLITE
+SQLITE_STORE_PATH = config['DEFAULT'].get('SQLITE_STORE_PATH', 'tagengine.db')
+
+# the memory and SQLite stores are shared by all the modules of this instance, like the Firestore client
+stores = {}
+stores_lock = threading.Lock()
+
+
+def get_store(backend):
+
+    if backend == 'FIRESTORE':
+        return cr.get_client(cr.FIRESTORE)
+
+    with stores_lock:
+        if backend not in stores:
+
+            if backend == 'MEMORY':
+                stores[backend] = MemoryStore()
+            elif backend == 'SQLITE':
+                stores[backend] = SqliteStore(SQLITE_STORE_PATH)
+            else:
+                raise ValueError('Unknown store backend: ' + backend)
+
+        return stores[backend]
+
+
+class DocumentStore:
+    """Base class for the stores which stand in for the Firestore client
+
+    The stores implement the subset of the Firestore API which Tag Engine uses, with the same semantics:
+    collections and subcollections, get, set (with merge), update, create, delete, add, batched writes,
+    where, order_by, limit, stream and firestore.Increment.
+
+    The backends implement _get, _put, _delete and _scan, hold their reads under lock and make _transaction atomic.
+    """
+
+    def collection(self, *collection_path):
+
+        return CollectionReference(self, '/'.join(collection_path))
+
+
+    def document(self, *document_path):
+
+        collection_path, doc_id = '/'.join(document_path).rsplit('/', 1)
+        return DocumentReference(self, collection_path, doc_id)
+
+
+    def batch(self):
+
+        return WriteBatch(self)
+
+
+    def _commit(self, writes):
+
+        # writes = list of (op, document reference, fields, merge), they're either all applied or none of them is
+        with self._transaction():
+
+            documents = {}
+
+            for op, doc_ref, fields, merge in writes:
+
+                key = (doc_ref._collection_path, doc_ref.id)
+
+                if key not in documents:
+                    documents[key] = self._get(*key)
+
+                data = documents[key]
+
+                if op == 'create' and data != None:
+                    raise exceptions.Conflict('Document already exists: ' + doc_ref.path)
+
+                if op == 'update' and data == None:
+                    raise exceptions.NotFound('No document to update: ' + doc_ref.path)
+
+                if op == 'delete':
+                    documents[key] = None
+                elif op == 'update':
+                    documents[key] = update_fields(data, fields)
+                elif merge:
+                    documents[key] = merge_fields(data or {}, fields)
+                else:
+                    documents[key] = merge_fields({}, fields)
+
+            for (collection_path, doc_id), data in documents.items():
+
+                if data == None:
+                    self._delete(collection_path, doc_id)
+                else:
+                    self._put(collection_path, doc_id, data)
+
+
+    def _query(self, collection_path, filters, orders, limit):
+
+        # the backends can use the equality filters to narrow down the scan, all the filters get applied here
+        equality_filters = [(field_path, value) for field_path, op, value in filters if op == '==']
+
+        with self.lock:
+            documents = sorted(self._scan(collection_path, equality_filters), key=lambda document: document[0])
+
+        documents = [(doc_id, data) for doc_id, data in documents if all(matches(data, f) for f in filters)]
+
+        for field_path, direction in reversed(orders):
+            documents = [(doc_id, data) for doc_id, data in documents if has_field(data, field_path)]
+            documents.sort(key=lambda document: sort_key(get_field(document[1], field_path)), reverse=(direction == 'DESCENDING'))
+
+        if limit != None:
+            documents = documents[:limit]
+
+        return documents
+
+
+class MemoryStore(DocumentStore):
+    """Document store which keeps the documents in a dict, for local runs and benchmarks"""
+
+    def __init__(self):
+
+        self.collections = {} # collection path -> {doc_id: document}
+        self.lock = threading.RLock()
+
+
+    @contextmanager
+    def _transaction(self):
+
+        with self.lock:
+            yield
+
+
+    def _get(self, collection_path, doc_id):
+
+        data = self.collections.get(collection_path, {}).get(doc_id)
+        return copy.deepcopy(data)
+
+
+    def _put(self, collection_path, doc_id, data):
+
+        self.collections.setdefault(collection_path, {})[doc_id] = copy.deepcopy(data)
+
+
+    def _delete(self, collection_path, doc_id):
+
+        self.collections.get(collection_path, {}).pop(doc_id, None)
+
+
+    def _scan(self, collection_path, equality_filters):
+
+        return [(doc_id, copy.deepcopy(data)) for doc_id, data in self.collections.get(collection_path, {}).items()]
+
+
+class SqliteStore(DocumentStore):
+    """Document store which keeps the documents as JSON in a SQLite table
+
+    The equality filters of a query are evaluated by SQLite, on an expression index which
+    gets created the first time a field is queried.
+
+    path = the SQLite database file
+    """
+    field_name_pattern = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+    def __init__(self, path):
+
+        self.lock = threading.RLock()
+        self.indexed_fields = set()
+
+        self.connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS documents (collection TEXT NOT NULL, doc_id TEXT NOT NULL, data TEXT NOT NULL, '
+                                'PRIMARY KEY (collection, doc_id))')
+
+
+    @contextmanager
+    def _transaction(self):
+
+        # BEGIN IMMEDIATE also serializes the writes of other processes which share the database file
+        with self.lock:
+
+            if self.connection.in_transaction:
+                yield
+                return
+
+            self.connection.execute('BEGIN IMMEDIATE')
+
+            try:
+                yield
+            except Exception:
+                self.connection.execute('ROLLBACK')
+                raise
+
+            self.connection.execute('COMMIT')
+
+
+    def _get(self, collection_path, doc_id):
+
+        row = self.connection.execute('SELECT data FROM documents WHERE collection = ? AND doc_id = ?', (collection_path, doc_id)).fetchone()
+
+        if row == None:
+            return None
+
+        return decode_document(row[0])
+
+
+    def _put(self, collection_path, doc_id, data):
+
+        self.connection.execute('INSERT OR REPLACE INTO documents (collection, doc_id, data) VALUES (?, ?, ?)', \
+                                (collection_path, doc_id, encode_document(data)))
+
+
+    def _delete(self, collection_path, doc_id):
+
+        self.connection.execute('DELETE FROM documents WHERE collection = ? AND doc_id = ?', (collection_path, doc_id))
+
+
+    def _scan(self, collection_path, equality_filters):
+
+        sql = 'SELECT doc_id, data FROM documents WHERE collection = ?'
+        params = [collection_path]
+
+        for field_path, value in equality_filters:
+
+            # only the top level fields with scalar values are pushed down, the rest is filtered by the caller
+            if self.field_name_pattern.match(field_path) == None or type(value) not in (str, int, float, bool):
+                continue
+
+            field_expr = "json_extract(data, '$.{}')".format(field_path)
+            self._create_index(field_path, field_expr)
+
+            sql += ' AND {} = ?'.format(field_expr)
+            params.append(value)
+
+        return [(doc_id, decode_document(data)) for doc_id, data in self.connection.execute(sql, params)]
+
+
+    def _create_index(self, field_path, field_expr):
+
+        if field_path in self.indexed_fields:
+            return
+
+        self.connection.execute('CREATE INDEX IF NOT EXISTS idx_{} ON documents (collection, {})'.format(field_path, field_expr))
+        self.indexed_fields.add(field_path)
+
+
+class CollectionReference:
+
+    def __init__(self, store, path):
+
+        self._store = store
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+
+    def document(self, document_id=None):
+
+        if document_id == None:
+            document_id = uuid.uuid4().hex[:20]
+
+        return DocumentReference(self._store, self.path, document_id)
+
+
+    def add(self, document_data, document_id=None):
+
+        doc_ref = self.document(document_id)
+        doc_ref.create(document_data)
+
+        return datetime.datetime.now(datetime.timezone.utc), doc_ref
+
+
+    def where(self, field_path, op_string, value):
+
+        return Query(self).where(field_path, op_string, value)
+
+
+    def order_by(self, field_path, direction='ASCENDING'):
+
+        return Query(self).order_by(field_path, direction)
+
+
+    def limit(self, count):
+
+        return Query(self).limit(count)
+
+
+    def stream(self):
+
+        return Query(self).stream()
+
+
+    def get(self):
+
+        return Query(self).get()
+
+
+class Query:
+
+    def __init__(self, collection, filters=(), orders=(), limit=None):
+
+        self._collection = collection
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit
+
+
+    def where(self, field_path, op_string, value):
+
+        if op_string not in operators:
+            raise ValueError('Unsupported operator: ' + op_string)
+
+        return Query(self._collection, self._filters + ((field_path, op_string, normalize_value(value)),), self._orders, self._limit)
+
+
+    def order_by(self, field_path, direction='ASCENDING'):
+
+        return Query(self._collection, self._filters, self._orders + ((field_path, direction),), self._limit)
+
+
+    def limit(self, count):
+
+        return Query(self._collection, self._filters, self._orders, count)
+
+
+    def stream(self):
+
+        documents = self._collection._store._query(self._collection.path, self._filters, self._orders, self._limit)
+
+        for doc_id, data in documents:
+            yield DocumentSnapshot(self._collection.document(doc_id), data)
+
+
+    def get(self):
+
+        return list(self.stream())
+
+
+class DocumentReference:
+
+    def __init__(self, store, collection_path, document_id):
+
+        self._store = store
+        self._collection_path = collection_path
+        self.id = document_id
+        self.path = collection_path + '/' + document_id
+
+
+    def collection(self, collection_id):
+
+        return CollectionReference(self._store, self.path + '/' + collection_id)
+
+
+    def get(self):
+
+        with self._store.lock:
+            data = self._store._get(self._collection_path, self.id)
+
+        return DocumentSnapshot(self, data)
+
+
+    def set(self, document_data, merge=False):
+
+        self._store._commit([('set', self, document_data, merge)])
+
+
+    def update(self, field_updates):
+
+        self._store._commit([('update', self, field_updates, False)])
+
+
+    def create(self, document_data):
+
+        self._store._commit([('create', self, document_data, False)])
+
+
+    def delete(self):
+
+        self._store._commit([('delete', self, None, False)])
+
+
+class DocumentSnapshot:
+
+    def __init__(self, reference, data):
+
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data != None
+        self._data = data
+
+
+    def to_dict(self):
+
+        return copy.deepcopy(self._data)
+
+
+    def get(self, field_path):
+
+        if not has_field(self._data, field_path):
+            raise KeyError(field_path)
+
+        return copy.deepcopy(get_field(self._data, field_path))
+
+
+class WriteBatch:
+
+    def __init__(self, store):
+
+        self._store = store
+        self._writes = []
+
+
+    def set(self, reference, document_data, merge=False):
+
+        self._writes.append(('set', reference, document_data, merge))
+
+
+    def update(self, reference, field_updates):
+
+        self._writes.append(('update', reference, field_updates, False))
+
+
+    def create(self, reference, document_data):
+
+        self._writes.append(('create', reference, document_data, False))
+
+
+    def delete(self, reference):
+
+        self._writes.append(('delete', reference, None, False))
+
+
+    def commit(self):
+
+        writes = self._writes
+        self._writes = []
+        self._store._commit(writes)
+
+
+############### Internal processing methods ###############
+
+def normalize_value(value):
+
+    # values are stored the way Firestore returns them: timestamps are timezone aware and in UTC, tuples are arrays
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo == None:
+            return value.replace(tzinfo=datetime.timezone.utc)
+        return value.astimezone(datetime.timezone.utc)
+
+    if isinstance(value, dict):
+        return {key: normalize_value(item) for key, item in value.items()}
+
+    if isinstance(value, (list, tuple)):
+        return [normalize_value(item) for item in value]
+
+    return value
+
+
+def apply_value(current, value):
+
+    # firestore.Increment adds to a numeric field, and sets the field when it isn't numeric
+    if isinstance(value, firestore.Increment):
+        if type(current) in (int, float):
+            return current + value.value
+        return value.value
+
+    return normalize_value(value)
+
+
+def merge_fields(data, fields):
+
+    # set() replaces the document, set(merge=True) merges the nested maps into the document
+    for key, value in fields.items():
+
+        if isinstance(value, dict) and isinstance(data.get(key), dict):
+            data[key] = merge_fields(data[key], value)
+        else:
+            data[key] = apply_value(data.get(key), value)
+
+    return data
+
+
+def update_fields(data, field_updates):
+
+    # update() replaces the fields it names, dotted field paths name nested fields
+    for field_path, value in field_updates.items():
+
+        keys = field_path.split('.')
+        parent = data
+
+        for key in keys[:-1]:
+            if not isinstance(parent.get(key), dict):
+                parent[key] = {}
+            parent = parent[key]
+
+        parent[keys[-1]] = apply_value(parent.get(keys[-1]), value)
+
+    return data
+
+
+def has_field(data, field_path):
+
+    for key in field_path.split('.'):
+        if not isinstance(data, dict) or key not in data:
+            return False
+        data = data[key]
+
+    return True
+
+
+def get_field(data, field_path):
+
+    for key in field_path.split('.'):
+        data = data[key]
+
+    return data
+
+
+def compare(op):
+
+    # values of different types never match a range filter, as in Firestore
+    def comparison(field_value, value):
+        try:
+            return op(field_value, value)
+        except TypeError:
+            return False
+
+    return comparison
+
+
+operators = {
+    '==': lambda field_value, value: field_value == value,
+    '!=': lambda field_value, value: field_value != value and field_value != None,
+    '<': compare(lambda field_value, value: field_value < value),
+    '<=': compare(lambda field_value, value: field_value <= value),
+    '>': compare(lambda field_value, value: field_value > value),
+    '>=': compare(lambda field_value, value: field_value >= value),
+    'in': lambda field_value, value: field_value in value,
+    'not-in': lambda field_value, value: field_value not in value and field_value != None,
+    'array_contains': lambda field_value, value: isinstance(field_value, list) and value in field_value,
+    'array_contains_any': lambda field_value, value: isinstance(field_value, list) and any(item in field_value for item in value),
+}
+
+
+def matches(data, query_filter):
+
+    # the documents which don't have the field never match, whatever the operator
+    field_path, op_string, value = query_filter
+
+    if not has_field(data, field_path):
+        return False
+
+    return operators[op_string](get_field(data, field_path), value)
+
+
+def sort_key(value):
+
+    # Firestore orders the values of different types by type: null, booleans, numbers, timestamps, strings, arrays, maps
+    if value == None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (1, value)
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, datetime.datetime):
+        return (3, value)
+    if isinstance(value, str):
+        return (4, value)
+    if isinstance(value, list):
+        return (5, json.dumps(value, default=str, sort_keys=True))
+
+    return (6, json.dumps(value, default=str, sort_keys=True))
+
+
+def encode_value(value):
+
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.isoformat()}
+
+    if isinstance(value, datetime.date):
+        return {'__date__': value.isoformat()}
+
+    raise TypeError('Unsupported value type: ' + type(value).__name__)
+
+
+def decode_value(value):
+
+    if '__datetime__' in value and len(value) == 1:
+        return datetime.datetime.fromisoformat(value['__datetime__'])
+
+    if '__date__' in value and len(value) == 1:
+        return datetime.date.fromisoformat(value['__date__'])
+
+    return value
+
+
+def encode_document(data):
+
+    return json.dumps(data, default=encode_value, separators=(',', ':'))
+
+
+def decode_document(text):
+
+    return json.loads(text, object_hook=decode_value)
@@ -12,10 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import uuid, datetime, json, configparser
+import uuid, datetime, json, configparser, random
 import constants
+from google.api_core import exceptions
 from google.cloud import firestore
 from google.cloud import tasks_v2
+import ClientRegistry as cr
+import DocumentStore as ds
+
+config = configparser.ConfigParser()
+config.read("tagengine.ini")
+JOB_COUNTER_SHARDS = int(config['DEFAULT'].get('JOB_COUNTER_SHARDS', 10))
 
 
 class JobManager:
@@ -38,7 +45,7 @@ class JobManager:
         self.queue_name = queue_name
         self.app_engine_uri = app_engine_uri
         
-        self.db = firestore.Client()
+        self.db = ds.get_store(ds.JOB_STORE)
 
 
 ##################### API METHODS #################
@@ -74,15 +81,43 @@ class JobManager:
         print('record_num_tasks')
         
 
+    def record_task_outcome(self, job_uuid, status):
+        
+        # task outcomes are counted on one of several counter shards under the job,
+        # which keeps the write rate on any single document low on large jobs
+        if status == 'COMPLETED':
+            counter_field = 'tasks_completed'
+        else:
+            counter_field = 'tasks_failed'
+        
+        self._increment_counter(job_uuid, counter_field)
+    
+    
+    def record_counters(self, job_uuid, counters):
+        
+        # adds task level statistics (e.g. query_cache_hits) to the job's counters, counters = {name: increment}
+        counters = {name: value for name, value in counters.items() if value != 0}
+        
+        if len(counters) == 0:
+            return
+        
+        counter_ref = self._get_counter_ref(job_uuid)
+        counter_ref.set({name: firestore.Increment(value) for name, value in counters.items()}, merge=True)
+    
+    
     def calculate_job_completion(self, job_uuid):
         
         print('*** enter calculate_job_completion ***')
         
+        # is_success and is_failed are only returned to the one caller which finalizes the job,
+        # so that the job completion logic runs exactly once per job
         is_success = False
         is_failed = False
+        pct_complete = 0
         
-        tasks_completed = self._get_tasks_completed(job_uuid)
-        tasks_failed = self._get_tasks_failed(job_uuid)
+        counters = self._get_counters(job_uuid)
+        tasks_completed = counters.get('tasks_completed', 0)
+        tasks_failed = counters.get('tasks_failed', 0)
                 
         tasks_ran = tasks_completed + tasks_failed
         
@@ -94,51 +129,62 @@ class JobManager:
             job_dict = job.to_dict()
             task_count = job_dict['task_count']
             
+            # the task count is recorded once all the tasks have been created
+            if task_count == 0:
+                pct_complete = 0
+            
             # job running
-            if job_dict['task_count'] > tasks_ran:
-                job_ref.update({
-                    'tasks_ran': tasks_completed + tasks_failed,
-                    'tasks_completed': tasks_completed,
-                })
-                
+            elif task_count > tasks_ran:
                 pct_complete = round(tasks_ran / task_count * 100, 2)
             
             # job completed
-            if job_dict['task_count'] <= tasks_ran:
+            else:
+                pct_complete = 100
                 
-                if job_dict['tasks_failed'] > 0:
+                if self._finalize_job(job_uuid):
                     
-                    is_failed = True
+                    if tasks_failed > 0:
+                        is_failed = True
+                        job_status = 'COMPLETED WITH ERRORS'
+                    else:
+                        is_success = True
+                        job_status = 'COMPLETED'
                     
-                    job_ref.update({
-                        'tasks_ran': tasks_completed + tasks_failed,
+                    # the final counts, including the task level statistics, get copied to the job record
+                    job_record = dict(counters)
+                    job_record.update({
+                        'tasks_ran': tasks_ran,
                         'tasks_completed': tasks_completed,
-                        'job_status': 'COMPLETED WITH ERRORS',
+                        'tasks_failed': tasks_failed,
+                        'job_status': job_status,
                         'completion_time': datetime.datetime.utcnow()
                     })
-                
-                else:
                     
-                    is_success = True
-                    
-                    job_ref.update({
-                        'tasks_ran': tasks_completed + tasks_failed,
-                        'tasks_completed': tasks_completed,
-                        'job_status': 'COMPLETED',
-                        'completion_time': datetime.datetime.utcnow()
-                    })
-                
-                pct_complete = 100     
+                    job_ref.update(job_record)
 
         return is_success, is_failed, pct_complete
                   
 
+    def update_job_completed(self, job_uuid):
+        
+        # used for the jobs which have no tasks, calculate_job_completion never gets called on those
+        job_ref = self.db.collection('jobs').document(job_uuid)
+        job_ref.update({
+            'tasks_ran': 0,
+            'tasks_completed': 0,
+            'tasks_failed': 0,
+            'job_status': 'COMPLETED',
+            'completion_time': datetime.datetime.utcnow()
+        })
+    
+    
     def update_job_failed(self, job_uuid):
         
         print('*** enter update_job_failed ***')
         
-        tasks_completed = self._get_tasks_completed(job_uuid)
-        tasks_failed = self._get_tasks_failed(job_uuid)
+        counters = self._get_counters(job_uuid)
+        tasks_completed = counters.get('tasks_completed', 0)
+        tasks_failed = counters.get('tasks_failed', 0)
         
         tasks_ran = tasks_completed + tasks_failed
                 
@@ -170,6 +216,15 @@ class JobManager:
 
         if job.exists:
             job_dict = job.to_dict()
+            
+            # the job record only gets the final task counts, the live counts come from the counter shards
+            if job_dict['job_status'] in ('PENDING', 'RUNNING'):
+                counters = self._get_counters(job_uuid)
+                job_dict.update(counters)
+                job_dict['tasks_completed'] = counters.get('tasks_completed', 0)
+                job_dict['tasks_failed'] = counters.get('tasks_failed', 0)
+                job_dict['tasks_ran'] = job_dict['tasks_completed'] + job_dict['tasks_failed']
+                
             return job_dict
                 
 
@@ -204,7 +259,7 @@ class JobManager:
         
         print('*** enter _create_cloud_task ***')
 
-        client = tasks_v2.CloudTasksClient()
+        client = cr.get_client(cr.CLOUD_TASKS)
         parent = client.queue_path(self.tag_engine_project, self.queue_region, self.queue_name)
         
         task = {
@@ -237,28 +292,43 @@ class JobManager:
             return job_dict['task_count']
         
 
-    def _get_tasks_completed(self, job_uuid):
+    def _get_counter_ref(self, job_uuid):
+        
+        shard_id = str(random.randint(0, JOB_COUNTER_SHARDS - 1))
+        return self.db.collection('jobs').document(job_uuid).collection('counters').document(shard_id)
         
-        tasks_completed = 0
+    
+    def _increment_counter(self, job_uuid, counter_field):
+        
+        counter_ref = self._get_counter_ref(job_uuid)
+        counter_ref.set({counter_field: firestore.Increment(1)}, merge=True)
+        
+    
+    def _get_counters(self, job_uuid):
+        
+        # reads at most JOB_COUNTER_SHARDS documents, no matter how many tasks the job has
+        counters = {}
+        
+        counter_shards = self.db.collection('jobs').document(job_uuid).collection('counters').stream()
+        
+        for counter_shard in counter_shards:
+            for field, value in counter_shard.to_dict().items():
+                counters[field] = counters.get(field, 0) + value
+        
+        return counters
+        
+    
+    def _finalize_job(self, job_uuid):
         
-        shards = self.db.collection('shards').where('job_uuid', '==', job_uuid).stream()
+        # create() fails if the document already exists, so only one task gets to finalize the job
+        finished_ref = self.db.collection('jobs').document(job_uuid).collection('events').document('finished')
         
-        for shard in shards:
-            tasks_completed += shard.to_dict().get('tasks_completed', 0) 
+        try:
+            finished_ref.create({'finished_time': datetime.datetime.utcnow()})
+            return True
         
-        return tasks_completed
-   
-      
-    def _get_tasks_failed(self, job_uuid):
-       
-       tasks_failed = 0
-       
-       shards = self.db.collection('shards').where('job_uuid', '==', job_uuid).stream()
-       
-       for shard in shards:
-           tasks_failed += shard.to_dict().get('tasks_failed', 0) 
-       
-       return tasks_failed
+        except exceptions.Conflict:
+            return False
                
         
 if __name__ == '__main__':
@@ -0,0 +1,376 @@
+# Copyright 2020-2022 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import uuid, hashlib, datetime, json, configparser, itertools, threading, copy
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+config = configparser.ConfigParser()
+config.read("tagengine.ini")
+LOCAL_WORKERS = int(config['DEFAULT'].get('LOCAL_WORKERS', 8)) # 0 = run the job in the request which created it
+
+
+class LocalExecutor:
+    """Class for running the split work and task handlers in-process, in place of Cloud Tasks
+
+    The work items go through an in-process work queue instead of a Cloud Tasks queue.
+    The payloads are passed through JSON, so that the handlers see exactly what they'd get from Cloud Tasks.
+
+    workers = the number of threads which run the handlers,
+              0 runs the handlers in the thread which submitted the work, so that a job completes within one request
+    """
+    def __init__(self, workers=LOCAL_WORKERS):
+
+        self.workers = workers
+        self.handlers = {} # app_engine_uri -> handler(payload)
+        self.local = threading.local()
+
+        if workers > 0:
+            self.pool = ThreadPoolExecutor(max_workers=workers)
+        else:
+            self.pool = None
+
+
+    def register_handler(self, app_engine_uri, handler):
+
+        self.handlers[app_engine_uri] = handler
+
+
+    def submit(self, app_engine_uri, payload):
+
+        payload = json.loads(json.dumps(payload))
+
+        if self.pool != None:
+            self.pool.submit(self._run_handler, app_engine_uri, payload)
+            return True
+
+        # the work submitted by a running handler is queued, and then drained by the outermost submit
+        if getattr(self.local, 'queue', None) != None:
+            self.local.queue.append((app_engine_uri, payload))
+            return True
+
+        self.local.queue = deque([(app_engine_uri, payload)])
+
+        try:
+            while len(self.local.queue) > 0:
+                self._run_handler(*self.local.queue.popleft())
+        finally:
+            self.local.queue = None
+
+        return True
+
+
+    def _run_handler(self, app_engine_uri, payload):
+
+        handler = self.handlers.get(app_engine_uri)
+
+        if handler == None:
+            print('Error: no handler registered for', app_engine_uri)
+            return
+
+        try:
+            handler(payload)
+        except Exception as e:
+            print('Error occurred while running', app_engine_uri, 'with payload', payload, '. Error:', e)
+
+
+class LocalJobManager:
+    """Class for managing jobs in memory, it has the same interface as JobManager
+
+    executor = LocalExecutor which runs the split work handler
+    app_engine_uri = split work handler uri (e.g. /_split_work)
+    """
+    def __init__(self, executor, app_engine_uri):
+
+        self.executor = executor
+        self.app_engine_uri = app_engine_uri
+
+        self.jobs = {} # job_uuid -> job record
+        self.counters = {} # job_uuid -> counters
+        self.lock = threading.Lock()
+
+
+##################### API METHODS #################
+
+    def create_job(self, config_uuid, config_type):
+
+        print('*** enter create_job ***')
+        print('config_uuid: ', config_uuid, ', config_type: ', config_type)
+
+        job_uuid = uuid.uuid1().hex
+
+        with self.lock:
+            self.jobs[job_uuid] = {
+                'job_uuid': job_uuid,
+                'config_uuid': config_uuid,
+                'config_type': config_type,
+                'job_status':  'PENDING',
+                'task_count': 0,
+                'tasks_ran': 0,
+                'tasks_completed': 0,
+                'tasks_failed': 0,
+                'creation_time': datetime.datetime.utcnow()
+            }
+            self.counters[job_uuid] = {}
+
+        self.executor.submit(self.app_engine_uri, {'job_uuid': job_uuid, 'config_uuid': config_uuid, 'config_type': config_type})
+
+        return job_uuid
+
+
+    def update_job_running(self, job_uuid):
+
+        with self.lock:
+            self.jobs[job_uuid]['job_status'] = 'RUNNING'
+
+        print('Set job running.')
+
+
+    def record_num_tasks(self, job_uuid, num_tasks):
+
+        with self.lock:
+            self.jobs[job_uuid]['task_count'] = num_tasks
+
+
+    def record_task_outcome(self, job_uuid, status):
+
+        if status == 'COMPLETED':
+            counter_field = 'tasks_completed'
+        else:
+            counter_field = 'tasks_failed'
+
+        self.record_counters(job_uuid, {counter_field: 1})
+
+
+    def record_counters(self, job_uuid, counters):
+
+        with self.lock:
+            job_counters = self.counters[job_uuid]
+
+            for name, value in counters.items():
+                job_counters[name] = job_counters.get(name, 0) + value
+
+
+    def calculate_job_completion(self, job_uuid):
+
+        # same contract as JobManager.calculate_job_completion, only the caller which finalizes the job gets is_success or is_failed
+        is_success = False
+        is_failed = False
+        pct_complete = 0
+
+        with self.lock:
+            job = self.jobs.get(job_uuid)
+
+            if job == None:
+                return is_success, is_failed, pct_complete
+
+            counters = self.counters[job_uuid]
+            tasks_completed = counters.get('tasks_completed', 0)
+            tasks_failed = counters.get('tasks_failed', 0)
+            tasks_ran = tasks_completed + tasks_failed
+            task_count = job['task_count']
+
+            if task_count == 0:
+                pct_complete = 0
+
+            elif task_count > tasks_ran:
+                pct_complete = round(tasks_ran / task_count * 100, 2)
+
+            else:
+                pct_complete = 100
+
+                if job.get('finalized') != True:
+                    job['finalized'] = True
+
+                    if tasks_failed > 0:
+                        is_failed = True
+                        job_status = 'COMPLETED WITH ERRORS'
+                    else:
+                        is_success = True
+                        job_status = 'COMPLETED'
+
+                    job.update(counters)
+                    job.update({
+                        'tasks_ran': tasks_ran,
+                        'tasks_completed': tasks_completed,
+                        'tasks_failed': tasks_failed,
+                        'job_status': job_status,
+                        'completion_time': datetime.datetime.utcnow()
+                    })
+
+        return is_success, is_failed, pct_complete
+
+
+    def update_job_completed(self, job_uuid):
+
+        with self.lock:
+            self.jobs[job_uuid].update({
+                'tasks_ran': 0,
+                'tasks_completed': 0,
+                'tasks_failed': 0,
+                'job_status': 'COMPLETED',
+                'completion_time': datetime.datetime.utcnow()
+            })
+
+
+    def update_job_failed(self, job_uuid):
+
+        with self.lock:
+            job = self.jobs[job_uuid]
+            counters = self.counters[job_uuid]
+            tasks_failed = counters.get('tasks_failed', 0)
+            tasks_ran = counters.get('tasks_completed', 0) + tasks_failed
+
+            job['tasks_ran'] = tasks_ran
+            job['tasks_failed'] = tasks_failed
+
+            if job['task_count'] == tasks_ran:
+                job['job_status'] = 'FAILED'
+                job['completion_time'] = datetime.datetime.utcnow()
+
+
+    def get_job_status(self, job_uuid):
+
+        with self.lock:
+            job = self.jobs.get(job_uuid)
+
+            if job == None:
+                return None
+
+            job_dict = copy.deepcopy(job)
+            job_dict.pop('finalized', None)
+
+            if job_dict['job_status'] in ('PENDING', 'RUNNING'):
+                counters = self.counters[job_uuid]
+                job_dict.update(counters)
+                job_dict['tasks_completed'] = counters.get('tasks_completed', 0)
+                job_dict['tasks_failed'] = counters.get('tasks_failed', 0)
+                job_dict['tasks_ran'] = job_dict['tasks_completed'] + job_dict['tasks_failed']
+
+            return job_dict
+
+
+class LocalTaskManager:
+    """Class for creating and tracking tasks in memory, it has the same interface as TaskManager
+
+    executor = LocalExecutor which runs the task handler
+    app_engine_uri = task handler uri (e.g. /_run_task)
+    """
+    def __init__(self, executor, app_engine_uri):
+
+        self.executor = executor
+        self.app_engine_uri = app_engine_uri
+        self.tasks_per_shard = 1000
+
+        self.tasks = {} # (shard_uuid, task_uuid) -> task record
+        self.lock = threading.Lock()
+
+
+##################### API METHODS #################
+
+    def create_config_uuid_tasks(self, job_uuid, config_uuid, config_type, uris, uris_per_task=1, snapshot_id=None):
+
+        print('*** enter create_config_uuid_tasks ***')
+
+        if uris_per_task > 1:
+            uri_batches = self._batch_work_items(uris, uris_per_task)
+            return self._fan_out_tasks(job_uuid, config_uuid, config_type, 'uris', uri_batches, snapshot_id)
+
+        return self._fan_out_tasks(job_uuid, config_uuid, config_type, 'uri', uris, snapshot_id)
+
+
+    def create_tag_extract_tasks(self, job_uuid, config_uuid, config_type, tag_extract_list, snapshot_id=None):
+
+        print('*** enter create_tag_extract_tasks ***')
+
+        return self._fan_out_tasks(job_uuid, config_uuid, config_type, 'tag_extract', tag_extract_list, snapshot_id)
+
+
+    def create_entry_range_tasks(self, job_uuid, config_uuid, config_type, entry_ranges, snapshot_id=None):
+
+        print('*** enter create_entry_range_tasks ***')
+
+        return self._fan_out_tasks(job_uuid, config_uuid, config_type, 'entry_range', entry_ranges, snapshot_id)
+
+
+    def update_task_status(self, shard_uuid, task_uuid, status):
+
+        with self.lock:
+            task = self.tasks[(shard_uuid, task_uuid)]
+            task['status'] = status
+
+            if status == 'RUNNING':
+                task['start_time'] = datetime.datetime.utcnow()
+            else:
+                task['end_time'] = datetime.datetime.utcnow()
+
+
+    def update_uri_status(self, shard_uuid, task_uuid, uri_status):
+
+        with self.lock:
+            self.tasks[(shard_uuid, task_uuid)]['uri_status'] = uri_status
+
+
+################ INTERNAL PROCESSING METHODS #################
+
+    def _fan_out_tasks(self, job_uuid, config_uuid, config_type, payload_key, work_items, snapshot_id=None):
+
+        # the tasks of a shard are all recorded before any of them gets submitted, as in TaskManager
+        task_total = 0
+        work_iter = iter(work_items)
+
+        for shard_index in itertools.count():
+
+            shard_items = list(itertools.islice(work_iter, self.tasks_per_shard))
+
+            if len(shard_items) == 0:
+                break
+
+            shard_uuid = hashlib.md5((job_uuid + str(shard_index)).encode()).hexdigest()
+            payloads = []
+
+            for work_item in shard_items:
+                payload = {'job_uuid': job_uuid, 'shard_uuid': shard_uuid, 'task_uuid': uuid.uuid1().hex, 'config_uuid': config_uuid, \
+                           'config_type': config_type, payload_key: work_item}
+
+                if snapshot_id:
+                    payload['snapshot_id'] = snapshot_id
+
+                payloads.append(payload)
+
+            with self.lock:
+                for payload in payloads:
+                    self.tasks[(shard_uuid, payload['task_uuid'])] = {'status': 'PENDING', 'creation_time': datetime.datetime.utcnow()}
+
+            for payload in payloads:
+                self.executor.submit(self.app_engine_uri, payload)
+
+            task_total += len(payloads)
+
+        print('Created', task_total, 'local tasks')
+
+        return task_total
+
+
+    def _batch_work_items(self, work_items, batch_size):
+
+        work_iter = iter(work_items)
+
+        while True:
+            batch = list(itertools.islice(work_iter, batch_size))
+
+            if len(batch) == 0:
+                break
+
+            yield batch
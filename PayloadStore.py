@@ -0,0 +1,165 @@
+# Copyright 2020-2022 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os, json, copy, hashlib, tempfile, threading, configparser
+from collections import OrderedDict
+
+from google.api_core import exceptions
+
+import ClientRegistry as cr
+
+config = configparser.ConfigParser()
+config.read("tagengine.ini")
+PAYLOAD_STORE = config['DEFAULT'].get('PAYLOAD_STORE', 'GCS') # GCS or LOCAL
+PAYLOAD_BUCKET = config['DEFAULT'].get('PAYLOAD_BUCKET', config['DEFAULT'].get('TAG_ENGINE_PROJECT', '') + '-task-payloads')
+PAYLOAD_DIR = config['DEFAULT'].get('PAYLOAD_DIR', os.path.join(tempfile.gettempdir(), 'tag-engine-payloads'))
+PAYLOAD_OFFLOAD_SIZE = int(config['DEFAULT'].get('PAYLOAD_OFFLOAD_SIZE', 4096)) # bytes, larger payloads are passed by reference
+PAYLOAD_CACHE_SIZE = int(config['DEFAULT'].get('PAYLOAD_CACHE_SIZE', 1000)) # payloads per instance
+
+# per-instance LRU of the payloads read by the tasks, keyed by payload_ref
+payload_cache = OrderedDict()
+payload_cache_lock = threading.Lock()
+
+payload_store = None
+payload_store_lock = threading.Lock()
+
+
+def get_payload_store():
+
+    global payload_store
+
+    with payload_store_lock:
+        if payload_store == None:
+
+            if PAYLOAD_STORE == 'LOCAL':
+                payload_store = LocalPayloadStore(PAYLOAD_DIR)
+            elif PAYLOAD_STORE == 'GCS':
+                payload_store = GcsPayloadStore(PAYLOAD_BUCKET)
+            else:
+                raise ValueError('Unknown payload store: ' + PAYLOAD_STORE)
+
+    return payload_store
+
+
+def encode_payload(payload):
+
+    # the same payload always encodes to the same bytes, and so gets the same payload_ref
+    return json.dumps(payload, sort_keys=True, separators=(',', ':'), default=str).encode()
+
+
+class PayloadStore:
+    """Base class for the content-addressed stores which hold the task payloads which are too large to be passed inline
+
+    A payload is stored once under the sha256 of its encoding, the tasks and the task records carry only that payload_ref.
+    The backends implement _exists, _write and _read.
+    """
+
+    def put(self, payload):
+
+        data = encode_payload(payload)
+        payload_ref = hashlib.sha256(data).hexdigest()
+
+        if not self._exists(payload_ref):
+            self._write(payload_ref, data)
+
+        return payload_ref
+
+
+    def get(self, payload_ref):
+
+        with payload_cache_lock:
+            if payload_ref in payload_cache:
+                payload_cache.move_to_end(payload_ref)
+                return copy.deepcopy(payload_cache[payload_ref])
+
+        payload = json.loads(self._read(payload_ref))
+
+        with payload_cache_lock:
+            payload_cache[payload_ref] = payload
+
+            if len(payload_cache) > PAYLOAD_CACHE_SIZE:
+                payload_cache.popitem(last=False)
+
+        return copy.deepcopy(payload)
+
+
+class GcsPayloadStore(PayloadStore):
+    """Payload store which keeps the payloads as objects in a GCS bucket
+
+    bucket_name = the bucket which holds the payloads, under the payloads/ prefix
+    """
+    def __init__(self, bucket_name):
+
+        self.bucket = cr.get_client(cr.STORAGE).bucket(bucket_name)
+
+
+    def _exists(self, payload_ref):
+
+        # the write below is conditional on the object not existing, so no lookup is needed
+        return False
+
+
+    def _write(self, payload_ref, data):
+
+        blob = self.bucket.blob('payloads/' + payload_ref + '.json')
+
+        try:
+            blob.upload_from_string(data, content_type='application/json', if_generation_match=0)
+
+        except exceptions.PreconditionFailed:
+            # the payload has already been stored
+            pass
+
+
+    def _read(self, payload_ref):
+
+        return self.bucket.blob('payloads/' + payload_ref + '.json').download_as_bytes()
+
+
+class LocalPayloadStore(PayloadStore):
+    """Payload store which keeps the payloads as files in a local directory, for local runs and tests
+
+    directory = the directory which holds the payloads
+    """
+    def __init__(self, directory):
+
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+
+    def _exists(self, payload_ref):
+
+        return os.path.exists(self._path(payload_ref))
+
+
+    def _write(self, payload_ref, data):
+
+        # the file is renamed into place, so a reader never sees a partial payload
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+
+        os.replace(tmp_path, self._path(payload_ref))
+
+
+    def _read(self, payload_ref):
+
+        with open(self._path(payload_ref), 'rb') as f:
+            return f.read()
+
+
+    def _path(self, payload_ref):
+
+        return os.path.join(self.directory, payload_ref + '.json')
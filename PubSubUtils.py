@@ -12,26 +12,80 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import json, datetime
+import json, datetime, configparser, threading, time, itertools
 
 from google.cloud import pubsub
 from google.cloud.exceptions import NotFound
 
 import TagEngineUtils as te
 
+config = configparser.ConfigParser()
+config.read("tagengine.ini")
+PUBSUB_MAX_MESSAGES = int(config['DEFAULT'].get('PUBSUB_MAX_MESSAGES', 1000)) # messages per batch
+PUBSUB_MAX_BYTES = int(config['DEFAULT'].get('PUBSUB_MAX_BYTES', 1000000)) # bytes per batch
+PUBSUB_MAX_LATENCY = float(config['DEFAULT'].get('PUBSUB_MAX_LATENCY', 0.1)) # seconds
+PUBSUB_ORDERING = config['DEFAULT'].getboolean('PUBSUB_ORDERING', False) # orders the messages of an asset
+PUBSUB_FLUSH_TIMEOUT = int(config['DEFAULT'].get('PUBSUB_FLUSH_TIMEOUT', 60)) # seconds
+TAG_STREAM_SETTINGS_TTL = int(config['DEFAULT'].get('TAG_STREAM_SETTINGS_TTL', 300)) # seconds
+
+# the publisher batches the messages of all the requests handled by this instance
+publisher = None
+tag_stream_settings = None # (expiration_time, enabled, settings)
+publisher_lock = threading.Lock()
+
+
+def get_publisher():
+    
+    global publisher
+    
+    with publisher_lock:
+        if publisher == None:
+            batch_settings = pubsub.types.BatchSettings(max_messages=PUBSUB_MAX_MESSAGES, max_bytes=PUBSUB_MAX_BYTES, \
+                                                        max_latency=PUBSUB_MAX_LATENCY)
+            publisher_options = pubsub.types.PublisherOptions(enable_message_ordering=PUBSUB_ORDERING)
+            publisher = pubsub.PublisherClient(batch_settings=batch_settings, publisher_options=publisher_options)
+    
+    return publisher
+
+
+def get_tag_stream_settings():
+    
+    global tag_stream_settings
+    
+    with publisher_lock:
+        cached = tag_stream_settings
+    
+    if cached != None and cached[0] > time.time():
+        return cached[1], cached[2]
+    
+    store = te.TagEngineUtils()
+    enabled, settings = store.read_tag_stream_settings()
+    
+    with publisher_lock:
+        tag_stream_settings = (time.time() + TAG_STREAM_SETTINGS_TTL, enabled, settings)
+    
+    return enabled, settings
+
+
 class PubSubUtils:
     
     def __init__(self):
         
-        self.client = pubsub.PublisherClient()
+        self.client = get_publisher()
         
-        store = te.TagEngineUtils()
-        enabled, settings = store.read_tag_stream_settings()
+        enabled, settings = get_tag_stream_settings()
         
         self.enabled = enabled
         self.project_id = settings['pubsub_project']
         self.topic = settings['pubsub_topic']
         
+        # publish results of the messages published through this object, see flush
+        self.message_ids = itertools.count()
+        self.pending = set() # ids of the messages which are still being published
+        self.published = 0
+        self.lost = 0
+        self.condition = threading.Condition()
+        
         #print('project_id: ' + self.project_id)
         #print('topic: ' + self.topic)
         
@@ -53,11 +107,77 @@ class PubSubUtils:
         payload['tag'] = fields
         #print('payload: ' + str(payload))
         
-        json_payload = json.dumps(payload, indent=4, sort_keys=True, default=str)
+        json_payload = json.dumps(payload, separators=(',', ':'), default=str)
         #print('json_payload: ' + str(json_payload))
         
-        resp = self.client.publish(topic_name, json_payload.encode('utf-8'))
+        # the messages of an asset are delivered in publish order when ordering is enabled
+        if PUBSUB_ORDERING:
+            ordering_key = payload['asset_name']
+        else:
+            ordering_key = ''
+        
+        with self.condition:
+            message_id = next(self.message_ids)
+            self.pending.add(message_id)
+        
+        try:
+            future = self.client.publish(topic_name, json_payload.encode('utf-8'), ordering_key=ordering_key)
+        except Exception as e:
+            print('Error while publishing to tag stream:', e)
+            self._on_publish_done(None, message_id, topic_name, ordering_key)
+            return
+        
+        future.add_done_callback(lambda future: self._on_publish_done(future, message_id, topic_name, ordering_key))
+    
+    
+    def flush(self):
+        
+        # waits for the messages which are still being published, returns the number of messages which were lost
+        deadline = time.time() + PUBSUB_FLUSH_TIMEOUT
+        
+        with self.condition:
+            while len(self.pending) > 0 and time.time() < deadline:
+                self.condition.wait(deadline - time.time())
+            
+            # the messages which timed out are counted as lost, their callbacks are ignored if they arrive later
+            if len(self.pending) > 0:
+                print('Timed out while waiting for', len(self.pending), 'tag stream messages to be published')
+                self.lost += len(self.pending)
+                self.pending.clear()
+            
+            return self.lost
+    
+    
+    def get_counters(self):
+        
+        with self.condition:
+            return {'tag_stream_published': self.published, 'tag_stream_lost': self.lost}
+    
+    
+    def _on_publish_done(self, future, message_id, topic_name, ordering_key):
         
-        #print('pub/sub resp: ' + str(resp))
+        if future != None and future.exception() == None:
+            is_published = True
+        else:
+            is_published = False
+            
+            if future != None:
+                print('Error while publishing to tag stream:', future.exception())
+            
+            # the publisher pauses an ordering key after a failed publish
+            if ordering_key != '':
+                self.client.resume_publish(topic_name, ordering_key)
         
-        
\ No newline at end of file
+        with self.condition:
+            # the message timed out in flush and has already been counted as lost
+            if message_id not in self.pending:
+                return
+            
+            self.pending.remove(message_id)
+            
+            if is_published:
+                self.published += 1
+            else:
+                self.lost += 1
+            
+            self.condition.notify_all()
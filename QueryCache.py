@@ -0,0 +1,92 @@
+# Copyright 2020-2022 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib, configparser, threading, time
+from collections import OrderedDict
+
+config = configparser.ConfigParser()
+config.read("tagengine.ini")
+QUERY_CACHE_TTL = int(config['DEFAULT'].get('QUERY_CACHE_TTL', 0)) # seconds, 0 = no expiry within the job
+QUERY_CACHE_SIZE = int(config['DEFAULT'].get('QUERY_CACHE_SIZE', 10000)) # entries per instance
+
+# query results are shared by all the tasks of a job which run on this instance
+query_results = OrderedDict()
+query_results_lock = threading.Lock()
+
+
+class QueryCache:
+    """Class for caching the results of query expressions
+
+    The cache is content-addressed, the results are keyed by a hash of the final query string.
+    The entries are scoped to a job, so identical SQL runs once per job instead of once per asset,
+    and a later run of the same config always sees fresh results.
+
+    job_uuid = the job which owns the cached results
+    """
+    def __init__(self, job_uuid):
+
+        self.job_uuid = job_uuid
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, query_str, all_rows):
+
+        # all_rows is true when the caller needs every row (i.e. richtext fields), not only the first one
+        key = self._create_key(query_str, all_rows)
+
+        with query_results_lock:
+            entry = query_results.get(key)
+
+            if entry != None:
+                expiration_time, field_values = entry
+
+                if expiration_time == None or expiration_time > time.time():
+                    query_results.move_to_end(key)
+                    self.hits += 1
+                    return list(field_values)
+
+                del query_results[key]
+
+            self.misses += 1
+            return None
+
+
+    def put(self, query_str, all_rows, field_values):
+
+        key = self._create_key(query_str, all_rows)
+
+        if QUERY_CACHE_TTL > 0:
+            expiration_time = time.time() + QUERY_CACHE_TTL
+        else:
+            expiration_time = None
+
+        with query_results_lock:
+            query_results[key] = (expiration_time, list(field_values))
+            query_results.move_to_end(key)
+
+            if len(query_results) > QUERY_CACHE_SIZE:
+                query_results.popitem(last=False)
+
+
+    def get_counters(self):
+
+        with query_results_lock:
+            return {'query_cache_hits': self.hits, 'query_cache_misses': self.misses}
+
+
+    def _create_key(self, query_str, all_rows):
+
+        query_hash = hashlib.sha256(query_str.encode()).hexdigest()
+        return (self.job_uuid, all_rows, query_hash)
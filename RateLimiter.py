@@ -0,0 +1,131 @@
+# Copyright 2020-2022 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import configparser, random, threading, time
+from google.api_core import exceptions
+
+config = configparser.ConfigParser()
+config.read("tagengine.ini")
+
+# the write rate is per instance, size it to the Data Catalog write quota divided by the max number of instances
+DATACATALOG_WRITE_RATE = float(config['DEFAULT'].get('DATACATALOG_WRITE_RATE', 10)) # requests per second
+DATACATALOG_WRITE_BURST = int(config['DEFAULT'].get('DATACATALOG_WRITE_BURST', 20))
+WRITE_MAX_ATTEMPTS = int(config['DEFAULT'].get('WRITE_MAX_ATTEMPTS', 5))
+WRITE_RETRY_BUDGET = float(config['DEFAULT'].get('WRITE_RETRY_BUDGET', 0.2)) # retries per request
+
+
+class TokenBucket:
+    """Class for limiting the rate of requests made by the threads of an instance
+
+    rate = the number of requests per second
+    capacity = the number of requests which can be made in a burst
+    """
+    def __init__(self, rate, capacity):
+
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+
+    def acquire(self):
+
+        # blocks until a token is available
+        while True:
+
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait_time = (1 - self.tokens) / self.rate
+
+            time.sleep(wait_time)
+
+
+class RetryPolicy:
+    """Class for retrying requests which failed with a transient error
+
+    Only ResourceExhausted (429) and ServiceUnavailable (503) errors are retried, with exponential backoff and full jitter.
+    Every request adds budget_ratio to the retry budget and every retry spends one from it, so that a sustained outage
+    doesn't multiply the load on the service.
+
+    rate_limiter = optional TokenBucket which every attempt goes through
+    max_attempts = the max number of attempts per request, including the first one
+    budget_ratio = the number of retries allowed per request, on average
+    max_budget = the number of retries which can be made in a burst
+    """
+    retryable_errors = (exceptions.ResourceExhausted, exceptions.ServiceUnavailable)
+
+    def __init__(self, rate_limiter=None, max_attempts=5, initial_delay=1.0, max_delay=32.0, multiplier=2.0, budget_ratio=0.2, \
+                 max_budget=10):
+
+        self.rate_limiter = rate_limiter
+        self.max_attempts = max_attempts
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.budget_ratio = budget_ratio
+        self.max_budget = max_budget
+        self.budget = max_budget
+        self.lock = threading.Lock()
+
+
+    def call(self, func, *args, **kwargs):
+
+        # raises the last error when the request can't be retried anymore
+        self._deposit()
+
+        for attempt in range(self.max_attempts):
+
+            if self.rate_limiter != None:
+                self.rate_limiter.acquire()
+
+            try:
+                return func(*args, **kwargs)
+
+            except self.retryable_errors as e:
+
+                if attempt == self.max_attempts - 1 or self._withdraw() == False:
+                    raise
+
+                delay = random.uniform(0, min(self.max_delay, self.initial_delay * self.multiplier ** attempt))
+                print('Retrying request in {:.2f} seconds due to {}'.format(delay, e))
+                time.sleep(delay)
+
+
+    def _deposit(self):
+
+        with self.lock:
+            self.budget = min(self.budget + self.budget_ratio, self.max_budget)
+
+
+    def _withdraw(self):
+
+        with self.lock:
+            if self.budget < 1:
+                return False
+
+            self.budget -= 1
+            return True
+
+
+# shared by all the Data Catalog tag writes made from this instance
+datacatalog_write_limiter = TokenBucket(DATACATALOG_WRITE_RATE, DATACATALOG_WRITE_BURST)
+datacatalog_write_retry = RetryPolicy(datacatalog_write_limiter, max_attempts=WRITE_MAX_ATTEMPTS, budget_ratio=WRITE_RETRY_BUDGET)
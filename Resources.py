@@ -15,7 +15,20 @@
 from google.cloud import bigquery
 from google.cloud import storage
 from google.cloud import resourcemanager_v3
-import constants, configparser
+from google.api_core.exceptions import NotFound, TooManyRequests, InternalServerError, ServiceUnavailable
+from google.api_core import retry
+from concurrent.futures import ThreadPoolExecutor
+import constants, configparser, itertools
+import ClientRegistry as cr
+import re, fnmatch, functools
+
+config = configparser.ConfigParser()
+config.read("tagengine.ini")
+ENUMERATION_WORKERS = int(config['DEFAULT'].get('ENUMERATION_WORKERS', 16))
+
+# list calls which get throttled (429) or hit a transient error are retried with exponential backoff
+ENUMERATION_RETRY = retry.Retry(predicate=retry.if_exception_type(TooManyRequests, InternalServerError, ServiceUnavailable), \
+                                initial=1.0, maximum=60.0, multiplier=2.0, deadline=600.0)
 
 class Resources:
     
@@ -29,42 +42,65 @@ class Resources:
         #print('enter get_resources()')
         #print('included_uris: ' + included_uris)
         
+        # returns a generator, the resources are yielded as the list pages arrive so that 
+        # the caller can start creating tasks while the enumeration is still running
+        
         # find out what kind of resource we have
         included_uris_list = included_uris.split(',')
         resource_type = included_uris_list[0].strip().split('/')[0]
         #print("resource_type: " + resource_type)
     
         if resource_type == Resources.bigquery_resource:
-                    
-            included_resources = Resources.find_bq_resources(included_uris)
-            #print("included_resources: " + str(included_resources))
-        
-            if excluded_uris is None or excluded_uris == "" or excluded_uris.isspace():
-                return included_resources
-            else:
-                #print("excluded_uris: " + excluded_uris)
-                excluded_resources = Resources.find_bq_resources(excluded_uris)
-                #print("excluded_resources: " + str(excluded_resources))
-        
+            check_uri = Resources.check_bq_uri
+            included_resources = Resources.iter_bq_resources(included_uris)
+            exclusion_matcher = Resources.bq_exclusion_matcher
         
         elif resource_type == Resources.gcs_resource:
-            
-            included_resources = Resources.find_gcs_resources(included_uris)
-        
-            if excluded_uris is None or excluded_uris == "" or excluded_uris.isspace():
-                return included_resources
-            else:
-                #print("excluded_uris: " + excluded_uris)
-                excluded_resources = Resources.find_gcs_resources(excluded_uris)
-                #print("excluded_resources: " + str(excluded_resources))
+            check_uri = Resources.check_gcs_uri
+            included_resources = Resources.iter_gcs_resources(included_uris)
+            exclusion_matcher = Resources.gcs_exclusion_matcher
         
         else:
             print('Error: expected to get a bigquery or gcs resource type, but found this: ' + resource_type)
             return None
         
-        remaining_resources = included_resources.difference(excluded_resources)
+        # the uris are validated up front, so that an invalid uri fails the split before any task gets created,
+        # an invalid excluded uri fails it too, since the resources it was meant to exclude would otherwise get tagged
+        if excluded_uris is None or excluded_uris == "" or excluded_uris.isspace():
+            excluded_uris_list = []
+        else:
+            excluded_uris_list = excluded_uris.split(',')
+        
+        try:
+            for uri in included_uris_list + excluded_uris_list:
+                check_uri(uri)
+        
+        except ValueError as e:
+            print('Error:', e)
+            return None
+        
+        is_excluded = exclusion_matcher(excluded_uris)
         
-        return remaining_resources
+        # a single uri never yields the same resource twice, overlapping uris need to be de-duplicated
+        return Resources.filter_resources(included_resources, is_excluded, len(included_uris_list) > 1)
+    
+    
+    @staticmethod
+    def filter_resources(resources, is_excluded, dedupe):
+        
+        seen = set()
+        
+        for resource in resources:
+            
+            if is_excluded != None and is_excluded(resource):
+                continue
+            
+            if dedupe:
+                if resource in seen:
+                    continue
+                seen.add(resource)
+            
+            yield resource
 
 
     @staticmethod
@@ -72,26 +108,32 @@ class Resources:
         
         print('projects:', projects)
         
-        uris = []
+        # the datasets of every project, and then the tables of every dataset, are listed from a bounded thread pool
+        # executor.map returns the results in submission order, so the uris always come out in the same order
+        bq_client = cr.get_client(cr.BIGQUERY)
+        
+        def list_datasets(project):
+            print('project:', project)
+            return [(project, dataset.dataset_id) for dataset in bq_client.list_datasets(project=project, retry=ENUMERATION_RETRY)]
         
-        bq_client = bigquery.client.Client()
+        def list_tables(dataset):
+            project, dataset_id = dataset
+            print('dataset:', dataset_id)
+            return [table.full_table_id for table in bq_client.list_tables(project + '.' + dataset_id, retry=ENUMERATION_RETRY)]
         
-        for project in projects:
+        uris = []
+        
+        with ThreadPoolExecutor(max_workers=ENUMERATION_WORKERS) as executor:
             
-            print('project:', project)
-            datasets = list(bq_client.list_datasets(project=project))
+            datasets = list(itertools.chain.from_iterable(executor.map(list_datasets, projects)))
             
-            for dataset in datasets:
-                print('dataset:', dataset.dataset_id)
+            for (project, dataset_id), tables in zip(datasets, executor.map(list_tables, datasets)):
                 
-                formatted_dataset = Resources.format_dataset_resource(project + '.' + dataset.dataset_id)
+                formatted_dataset = Resources.format_dataset_resource(project + '.' + dataset_id)
                 uris.append(formatted_dataset)
                 
-                tables = bq_client.list_tables(project + '.' + dataset.dataset_id)
-                
-                for table in tables:
-                    
-                    formatted_table = Resources.format_table_resource(table.full_table_id)
+                for full_table_id in tables:
+                    formatted_table = Resources.format_table_resource(full_table_id)
                     uris.append(formatted_table)
                     
         return uris
@@ -102,12 +144,12 @@ class Resources:
 
         if folder.replace('folders/', '').isnumeric() == False:
             print('Error: The folder parameter must be a numeric value')
-            return
+            return None
         
         if 'folders/' not in folder: 
             folder = 'folders/' + folder
         
-        rm_client = resourcemanager_v3.ProjectsClient()
+        rm_client = cr.get_client(cr.RESOURCE_MANAGER)
 
         request = resourcemanager_v3.ListProjectsRequest(
             parent=folder,
@@ -150,41 +192,74 @@ class Resources:
         
         dataset_list = []
         
-        if dataset.endswith("*"):
-            datasets = list(bq_client.list_datasets())  
-
-            for ds in datasets:
-                if dataset[:-1] in ds.dataset_id:
+        # list_datasets can't filter on a name prefix, so the listed datasets are matched against the compiled pattern
+        if Resources.is_wildcard(dataset):
+            for ds in bq_client.list_datasets():
+                if Resources.dataset_matches(dataset, ds.dataset_id):
                     dataset_list.append(ds.dataset_id)
         else:
             dataset_list.append(dataset)
         
         return dataset_list
+    
+    
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def compile_pattern(expression):
+        
+        # compiles a wildcard expression into an anchored regex:
+        # * matches any sequence of characters, ? matches a single character and [seq] matches a character in seq
+        return re.compile(fnmatch.translate(expression))
+    
+    
+    @staticmethod
+    def is_wildcard(expression):
+        
+        return '*' in expression or '?' in expression or '[' in expression
+    
+    
+    @staticmethod
+    def literal_prefix(expression):
+        
+        # the part of the expression before the first wildcard, used to narrow down the listing calls
+        return re.split(r'[*?\[]', expression, 1)[0]
+    
+    
+    @staticmethod
+    def dataset_matches(dataset_expression, dataset_id):
+        
+        return Resources.compile_pattern(dataset_expression).match(dataset_id) != None
+    
+    
+    @staticmethod
+    def table_matches(table_expression, table_id):
+        
+        # table_id is the short table name, without the project and dataset 
+        return Resources.compile_pattern(table_expression).match(table_id) != None
         
     
     @staticmethod     
     def find_bq_resources(uris):
+        
+        return set(Resources.iter_bq_resources(uris))
+    
+    
+    @staticmethod     
+    def iter_bq_resources(uris):
        
         # @input uris: comma-separated list of uri representing a BQ resource
         # BQ resources are specified as:  
         # bigquery/project/<project>/dataset/<dataset>/<table>
         # wildcards are allowed in the table and dataset components of the uri 
-        resources = set()
-        table_resources = set() 
-        column_resources = set() 
-        
+        # yields the formatted dataset and table resources, list_datasets and list_tables are paged lazily
         uri_list = uris.split(",")
         
         for uri in uri_list: 
             print("uri: " + uri)
-            split_path = uri.strip().split("/")
-
-            if split_path[1] != "project":
-                print("Error: invalid URI " + path)
-                return None
+            split_path = Resources.check_bq_uri(uri)
             
             project_id = split_path[2]
-            bq_client = bigquery.client.Client(project=project_id)
+            bq_client = cr.get_client(cr.BIGQUERY, project=project_id)
             
             path_length = len(split_path)
             #print("path_length: " + str(path_length))
@@ -193,15 +268,9 @@ class Resources:
                 
                 print('uri ' + uri + ' is at the project level')
                 
-                datasets = list(bq_client.list_datasets())
-                
-                for dataset in datasets:
-                    tables = list(bq_client.list_tables(dataset.dataset_id))
-        
-                    for table in tables:
-                        table_resources.add(table.full_table_id)
-                
-                tag_type = constants.BQ_TABLE_TAG
+                for dataset in bq_client.list_datasets():
+                    for table in bq_client.list_tables(dataset.dataset_id):
+                        yield Resources.format_table_resource(table.full_table_id)
              
             if path_length > 4:
                
@@ -215,129 +284,169 @@ class Resources:
                     print("dataset_id: " + dataset_id)
                 
                     if path_length == 5: 
-                        tag_type = constants.BQ_DATASET_TAG
-                        dataset_resource = Resources.format_dataset_resource(dataset_id)
-                        resources.add(dataset_resource)
+                        yield Resources.format_dataset_resource(dataset_id)
                         continue
                 
                     table_expression = split_path[5]
                     print("table_expression: " + table_expression)
 
-                    if path_length != 6:
-                        print("Error. Invalid URI " + path)
-                        return None
-                    else:
-                        tag_type = constants.BQ_TABLE_TAG
-
-                    if table_expression == "*":
-                        #print("list tables in dataset")
-                        tables = list(bq_client.list_tables(bq_client.get_dataset(dataset_id)))
-            
-                        for table in tables:
-                            #print("full_table_id: " + str(table.full_table_id))
-                            table_resources.add(table.full_table_id)
-                    
-                    elif "*" in table_expression:
-                        #print("table expression contains wildcard")
-                        table_substrings = table_expression.split("*")
-                        tables = list(bq_client.list_tables(bq_client.get_dataset(dataset_id)))
-                    
-                        for table in tables:
-                            is_match = True
-                            for substring in table_substrings:
-                                if substring not in table.full_table_id:
-                                    is_match = False
-                                    break
+                    if Resources.is_wildcard(table_expression):
+                        table_pattern = Resources.compile_pattern(table_expression)
                         
-                            if is_match == True:
-                                table_resources.add(table.full_table_id)
+                        for table in bq_client.list_tables(dataset_id):
+                            if table_pattern.match(table.table_id):
+                                yield Resources.format_table_resource(table.full_table_id)
                 
                     else:
                         table_id = dataset_id + "." + table_expression
                 
                         try:
                             table = bq_client.get_table(table_id)
-                            table_resources.add(table.full_table_id)
+                            yield Resources.format_table_resource(table.full_table_id)
                     
                         except NotFound:
                             print("Error: " + table_id + " not found.")
+    
+    
+    @staticmethod
+    def bq_exclusion_matcher(excluded_uris):
+        
+        # precomputes the excluded uris into a matcher, so the excluded resources never have to be listed
+        # a project uri excludes all its tables, a dataset uri excludes the dataset resource 
+        # and a table uri excludes the matching tables 
+        if excluded_uris is None or excluded_uris == "" or excluded_uris.isspace():
+            return None
+        
+        patterns = []
+        
+        for uri in excluded_uris.split(","):
+            split_path = Resources.check_bq_uri(uri)
             
-                    
-            if tag_type == constants.BQ_TABLE_TAG:
-                for table in table_resources:
-                    formatted_table = Resources.format_table_resource(table)
-                    resources.add(formatted_table)
+            patterns.append((len(split_path), split_path[2], split_path[4] if len(split_path) > 4 else None, \
+                             split_path[5] if len(split_path) > 5 else None))
         
-        return resources      
+        def is_excluded(resource):
+            
+            # resource format: project/datasets/dataset or project/datasets/dataset/tables/table
+            split_resource = resource.split("/")
+            project_id = split_resource[0]
+            dataset_id = split_resource[2]
+            is_table = len(split_resource) == 5
+            
+            for path_length, project_expression, dataset_expression, table_expression in patterns:
+                
+                if project_id != project_expression:
+                    continue
+                
+                if path_length == 4:
+                    if is_table:
+                        return True
+                    continue
                 
+                if Resources.dataset_matches(dataset_expression, dataset_id) == False:
+                    continue
+                
+                if path_length == 5:
+                    if is_table == False:
+                        return True
+                    continue
+                
+                if is_table and Resources.table_matches(table_expression, split_resource[4]):
+                    return True
+            
+            return False
+        
+        return is_excluded
+                
+    
+    @staticmethod
+    def check_bq_uri(uri):
+        
+        # returns the components of a valid BQ uri, raises ValueError on an invalid one
+        split_path = uri.strip().split("/")
+        
+        if len(split_path) < 4 or len(split_path) > 6 or split_path[0] != Resources.bigquery_resource or split_path[1] != "project":
+            raise ValueError("invalid URI " + uri)
+        
+        return split_path
+    
+    
+    @staticmethod
+    def check_gcs_uri(uri):
+        
+        # returns the bucket name and object expression of a valid GCS uri, raises ValueError on an invalid one
+        # the 'gs://' prefix gets removed, examples: discovery-area/cities_311/*, discovery-area/cities_311/*.parquet 
+        # or discovery-area/austin_311_service_requests.parquet
+        split_uri = uri.strip()[5:].split('/', 1)
+        
+        if uri.strip().startswith('gs://') == False or len(split_uri) != 2 or split_uri[0] == '' or split_uri[1] == '':
+            raise ValueError('invalid uri provided: ' + uri)
+        
+        return split_uri
+    
+    
     @staticmethod     
     def find_gcs_resources(uris):
+        
+        return set(Resources.iter_gcs_resources(uris))
     
-        gcs_client = storage.Client()
-        resources = set()
+    
+    @staticmethod     
+    def iter_gcs_resources(uris):
+    
+        gcs_client = cr.get_client(cr.STORAGE)
         
         uris_list = uris.split(',')
         
         for uri in uris_list:
             
-            # remove the 'gs://' prefix from the uri
-            short_uri = uri[5:].strip()
-            #print('short_uri: ' + short_uri)
-            
-            split_uri = short_uri.split('/')
-            bucket_name = split_uri[0]
+            bucket_name, object_expression = Resources.check_gcs_uri(uri)
             #print('bucket_name: ' + bucket_name)
             
-            # uri contains a folder
-            # examples: discovery-area/cities_311/* or discovery-area/cities_311/austin_311_service_requests.parquet
-            if len(split_uri) > 2:
-                folder_start_index = len(bucket_name) + 1
-                #print('folder_start_index: ', folder_start_index)
+            # uri contains a wildcard, only the objects under its literal prefix get listed 
+            if Resources.is_wildcard(object_expression):
+                object_pattern = Resources.compile_pattern(object_expression)
+                prefix = Resources.literal_prefix(object_expression)
+                #print('prefix: ' + prefix)
                 
-                # uri points to a folder
-                if short_uri.endswith('/*'):    
-                    folder_end_index = short_uri.index('/*') 
-                    folder = short_uri[folder_start_index:folder_end_index]
-                    #print('folder: ' + folder)
-                    
-                    for blob in gcs_client.list_blobs(bucket_name, prefix=folder):
-                        if blob.name == folder + '/' or blob.name.endswith('/'):
-                            continue
-                        resources.add((bucket_name, blob.name))
-                        
-                # uri points to a specific file
-                # example: discovery-area/cities_311/austin_311_service_requests.parquet    
-                else:
-                    filename = short_uri[folder_start_index:]
-                    #print('filename: ' + filename) 
-                    bucket = gcs_client.get_bucket(bucket_name)
-                    blob = bucket.blob(filename)
-                    if blob.exists():
-                        resources.add((bucket_name, blob.name))
+                for blob in gcs_client.list_blobs(bucket_name, prefix=prefix):
+                    if blob.name.endswith('/'):
+                        continue
+                    if object_pattern.match(blob.name):
+                        yield (bucket_name, blob.name)
             
-            # uri does not contain a folder
-            # examples: discovery-area/* or discovery-area/austin_311_service_requests.parquet  
-            elif len(split_uri) == 2:    
-                
-                if short_uri.endswith('/*'):  
-                    for blob in gcs_client.list_blobs(bucket_name):
-                        if blob.name.endswith('/'):
-                            continue
-                        #print('blob: ' + str(blob.name))
-                        resources.add((bucket_name, blob.name))
-                else:
-                    file_index_start = short_uri.index('/') + 1 
-                    filename = short_uri[file_index_start:]
-                    #print('filename: ' + filename)
-                    bucket = gcs_client.get_bucket(bucket_name)
-                    blob = bucket.blob(filename)
-                    if blob.exists():
-                        if blob.name.endswith('/') == False:
-                            resources.add((bucket_name, blob.name))    
+            # uri points to a specific file
             else:
-                print('Error: invalid uri provided: ' + uri)
-                
-        return resources
+                bucket = gcs_client.get_bucket(bucket_name)
+                blob = bucket.blob(object_expression)
+                if blob.exists() and blob.name.endswith('/') == False:
+                    yield (bucket_name, blob.name)
+    
+    
+    @staticmethod
+    def gcs_exclusion_matcher(excluded_uris):
+        
+        # each excluded uri is compiled into a pattern on the object name, e.g. a folder uri excludes every object under the folder 
+        if excluded_uris is None or excluded_uris == "" or excluded_uris.isspace():
+            return None
+        
+        patterns = []
+        
+        for uri in excluded_uris.split(','):
+            bucket_name, object_expression = Resources.check_gcs_uri(uri)
+            patterns.append((bucket_name, Resources.compile_pattern(object_expression)))
+        
+        def is_excluded(resource):
+            
+            bucket_name, blob_name = resource
+            
+            for pattern_bucket, object_pattern in patterns:
+                if bucket_name == pattern_bucket and object_pattern.match(blob_name):
+                    return True
+            
+            return False
+        
+        return is_excluded
         
 if __name__ == '__main__':
     
@@ -14,19 +14,34 @@
 
 import uuid, pytz, os, requests
 import configparser, difflib, hashlib
+import threading, copy
+from collections import OrderedDict
 from datetime import datetime
 from datetime import timedelta
 import DataCatalogUtils as dc
 from google.cloud import bigquery
 from google.cloud import firestore
-from FakeDb import FakeDb
 import constants
+import ClientRegistry as cr
+import DocumentStore as ds
+
+config = configparser.ConfigParser()
+config.read("tagengine.ini")
+SNAPSHOT_CACHE_SIZE = int(config['DEFAULT'].get('SNAPSHOT_CACHE_SIZE', 100))
+
+# per-instance LRU of config snapshots, keyed by snapshot_id 
+snapshot_cache = OrderedDict()
+snapshot_cache_lock = threading.Lock()
 
 
 class TagEngineUtils:
     
     def __init__(self):
-        self.db = FakeDb()
+        self.db = ds.get_store(ds.CONFIG_STORE)
+        
+        # the config snapshots are written by _split_work and read by the tasks, which can run on any instance,
+        # so they're kept in the job store alongside the jobs and tasks
+        self.job_db = ds.get_store(ds.JOB_STORE)
         
         config = configparser.ConfigParser()
         config.read("tagengine.ini")
@@ -173,7 +188,7 @@ class TagEngineUtils:
         # list datasets and tables for chosen projects
         for project in included_bigquery_projects.split(','):
             project_id = project.strip()
-            bq_client = bigquery.Client(project=project_id)
+            bq_client = cr.get_client(cr.BIGQUERY, project=project_id)
             datasets = list(bq_client.list_datasets())
             
             total_tags = 0
@@ -347,7 +362,7 @@ class TagEngineUtils:
     def write_static_asset_config(self, config_status, fields, included_assets_uris, excluded_assets_uris,
                                   template_uuid, \
                                   refresh_mode, refresh_frequency, refresh_unit, tag_history, tag_stream,
-                                  overwrite=False):
+                                  overwrite=False, uris_per_task=1):
         """Wrapped"""
 
         # hash the included_assets_uris string
@@ -379,7 +394,8 @@ class TagEngineUtils:
                 'scheduling_status': 'PENDING',
                 'next_run': next_run,
                 'version': 1,
-                'overwrite': overwrite
+                'overwrite': overwrite,
+                'uris_per_task': uris_per_task
             })
 
         else:
@@ -401,13 +417,15 @@ class TagEngineUtils:
                 'tag_history': tag_history,
                 'tag_stream': tag_stream,
                 'version': 1,
-                'overwrite': overwrite
+                'overwrite': overwrite,
+                'uris_per_task': uris_per_task
             })
 
         return config_uuid, included_assets_uris_hash, doc_ref
 
     def write_static_asset_config_(self, config_status, fields, included_assets_uris, excluded_assets_uris, template_uuid, \
-                                  refresh_mode, refresh_frequency, refresh_unit, tag_history, tag_stream, overwrite=False):
+                                  refresh_mode, refresh_frequency, refresh_unit, tag_history, tag_stream, overwrite=False, \
+                                  uris_per_task=1):
         
         # hash the included_assets_uris string
         included_assets_uris_hash = hashlib.md5(included_assets_uris.encode()).hexdigest()
@@ -456,7 +474,8 @@ class TagEngineUtils:
                 'scheduling_status': 'PENDING',
                 'next_run': next_run,
                 'version': 1,
-                'overwrite': overwrite
+                'overwrite': overwrite,
+                'uris_per_task': uris_per_task
             })
             
         else:
@@ -478,14 +497,15 @@ class TagEngineUtils:
                 'tag_history': tag_history,
                 'tag_stream': tag_stream,
                 'version': 1,
-                'overwrite': overwrite
+                'overwrite': overwrite,
+                'uris_per_task': uris_per_task
             })
         
         return config_uuid, included_assets_uris_hash
     
     
     def write_dynamic_table_config(self, config_status, fields, included_tables_uris, excluded_tables_uris, template_uuid, refresh_mode,\
-                                   refresh_frequency, refresh_unit, tag_history, tag_stream):
+                                   refresh_frequency, refresh_unit, tag_history, tag_stream, uris_per_task=1):
         
         included_tables_uris_hash = hashlib.md5(included_tables_uris.encode()).hexdigest()
         
@@ -531,7 +551,8 @@ class TagEngineUtils:
                 'tag_stream': tag_stream,
                 'scheduling_status': 'PENDING',
                 'next_run': next_run,
-                'version': 1
+                'version': 1,
+                'uris_per_task': uris_per_task
             })
             
         else:
@@ -549,7 +570,8 @@ class TagEngineUtils:
                 'refresh_frequency': 0,
                 'tag_history': tag_history,
                 'tag_stream': tag_stream,
-                'version': 1
+                'version': 1,
+                'uris_per_task': uris_per_task
             })
         
         print('Created new dynamic table config.')
@@ -1216,6 +1238,51 @@ class TagEngineUtils:
         return config_result
         
     
+    def write_config_snapshot(self, job_uuid, config, template_config=None, template_fields=None):
+        
+        # a snapshot holds everything a task needs to know about the config for the life of a job,
+        # the tasks only carry the snapshot_id in their payload
+        snapshot_id = '{}_v{}'.format(job_uuid, config.get('version', 1))
+        
+        snapshot_ref = self.job_db.collection('config_snapshots').document(snapshot_id)
+        snapshot_ref.set({
+            'job_uuid': job_uuid,
+            'config': config,
+            'template_config': template_config,
+            'template_fields': template_fields,
+            'creation_time': datetime.utcnow()
+        })
+        
+        return snapshot_id
+        
+    
+    def read_config_snapshot(self, snapshot_id):
+        
+        # snapshots are immutable, so they are cached per instance without a TTL
+        with snapshot_cache_lock:
+            snapshot = snapshot_cache.get(snapshot_id)
+            
+            if snapshot != None:
+                snapshot_cache.move_to_end(snapshot_id)
+        
+        if snapshot == None:
+            doc = self.job_db.collection('config_snapshots').document(snapshot_id).get()
+            
+            if not doc.exists:
+                return None
+            
+            snapshot = doc.to_dict()
+            
+            with snapshot_cache_lock:
+                snapshot_cache[snapshot_id] = snapshot
+                
+                if len(snapshot_cache) > SNAPSHOT_CACHE_SIZE:
+                    snapshot_cache.popitem(last=False)
+        
+        # callers get their own copy, since the config and fields get modified while tags are applied
+        return copy.deepcopy(snapshot)
+        
+    
     def delete_config(self, config_uuid, config_type):
         
         coll_name = self.lookup_config_collection(config_type)
@@ -12,10 +12,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import uuid, hashlib, datetime, json, configparser, math
+import uuid, hashlib, datetime, json, configparser, math, time, itertools
+from concurrent.futures import ThreadPoolExecutor
 import constants
 from google.cloud import firestore
 from google.cloud import tasks_v2
+import ClientRegistry as cr
+import DocumentStore as ds
+import PayloadStore as ps
+
+config = configparser.ConfigParser()
+config.read("tagengine.ini")
+TASK_FANOUT_WORKERS = int(config['DEFAULT'].get('TASK_FANOUT_WORKERS', 20))
 
 
 class TaskManager:
@@ -26,115 +34,57 @@ class TaskManager:
     queue_name = Cloud Task queue (e.g. tag-engine-queue)
     app_engine_uri = task handler uri set inside the 
                      App Engine project hosting the cloud task queue
+    job_manager = JobManager which gets the outcome of the tasks that couldn't be submitted
     """
     def __init__(self,
                 tag_engine_project,
                 queue_region,
                 queue_name, 
-                app_engine_uri):
+                app_engine_uri,
+                job_manager=None):
 
         self.tag_engine_project = tag_engine_project
         self.queue_region = queue_region
         self.queue_name = queue_name
         self.app_engine_uri = app_engine_uri
+        self.job_manager = job_manager
 
-        self.db = firestore.Client()
+        self.db = ds.get_store(ds.JOB_STORE)
         self.tasks_per_shard = 1000
+        self.fanout_workers = TASK_FANOUT_WORKERS
+        
+        # one Cloud Tasks client for all the task submissions, it's safe to share across threads
+        self.client = cr.get_client(cr.CLOUD_TASKS)
+        self.parent = self.client.queue_path(self.tag_engine_project, self.queue_region, self.queue_name)
 
 ##################### API METHODS #################
         
-    def create_config_uuid_tasks(self, job_uuid, config_uuid, config_type, uris):
+    def create_config_uuid_tasks(self, job_uuid, config_uuid, config_type, uris, uris_per_task=1, snapshot_id=None):
         
         print('*** enter create_config_uuid_tasks ***')
         
-        # create shards of 1000 tasks
-        if len(uris) > self.tasks_per_shard:
-            shards = math.ceil(len(uris) / self.tasks_per_shard)
-        else:
-            shards = 1
-            
-        task_running_total = 0
-        task_counter = 0
-        
-        for shard_index in range(0, shards):
-            
-            shard_id_raw = job_uuid + str(shard_index)
-            shard_uuid = hashlib.md5(shard_id_raw.encode()).hexdigest()
-            self._create_shard(job_uuid, shard_uuid)
-
-            for uri_index, uri_val in enumerate(uris[task_running_total:], task_running_total):
-
-                # create the task
-                if isinstance(uri_val, str):
-                    task_id_raw = job_uuid + uri_val
-                    
-                if isinstance(uri_val, tuple):
-                    task_id_raw = job_uuid + ''.join(uri_val) # uri_val is a tuple when it contains a gcs path
-                
-                task_id = hashlib.md5(task_id_raw.encode()).hexdigest()
-            
-                task_uuid = self._record_config_uuid_task(job_uuid, shard_uuid, task_id, config_uuid, config_type, uri_val)
-                self._create_config_uuid_task(job_uuid, shard_uuid, task_uuid, task_id, config_uuid, config_type, uri_val)
-                
-                task_counter += 1
-                task_running_total += 1
-                
-                if task_counter == self.tasks_per_shard:
-                    self._update_shard_tasks(job_uuid, shard_uuid, task_counter)
-                    task_counter = 0
-                    break
+        if uris_per_task > 1:
+            # pack the uris into micro-batches, one batch per task
+            uri_batches = self._batch_work_items(uris, uris_per_task)
+            return self._fan_out_tasks(job_uuid, config_uuid, config_type, 'uris', uri_batches, snapshot_id)
         
-        # update shard with last task_counter
-        if task_counter > 0:    
-            self._update_shard_tasks(job_uuid, shard_uuid, task_counter)
+        return self._fan_out_tasks(job_uuid, config_uuid, config_type, 'uri', uris, snapshot_id)
 
     
-    def create_tag_extract_tasks(self, job_uuid, config_uuid, config_type, tag_extract_list):
+    def create_tag_extract_tasks(self, job_uuid, config_uuid, config_type, tag_extract_list, snapshot_id=None):
         
         print('*** enter create_tag_extract_tasks ***')
         #print('len(tag_extract_list): ', len(tag_extract_list))
         
-        # create shards of 5000 records
-        if len(tag_extract_list) > self.tasks_per_shard:
-            shards = math.ceil(len(tag_extract_list) / self.tasks_per_shard)
-        else:
-            shards = 1
-            
-        task_running_total = 0
-        task_counter = 0
-        
-        for shard_index in range(0, shards):
-            
-            shard_id_raw = job_uuid + str(shard_index)
-            shard_uuid = hashlib.md5(shard_id_raw.encode()).hexdigest()
-            self._create_shard(job_uuid, shard_uuid)
-
-            for extract_index, extract_val in enumerate(tag_extract_list[task_running_total:], task_running_total):
-                
-                print('task_running_total: ', task_running_total)
-                print('extract_index: ', extract_index)
-                print('extract_val: ', extract_val)
-                
-                # create the task
-                task_id_raw = job_uuid + ''.join(str(extract_val))
-                task_id = hashlib.md5(task_id_raw.encode()).hexdigest()
-                
-                print('task_id: ', task_id)
+        return self._fan_out_tasks(job_uuid, config_uuid, config_type, 'tag_extract', tag_extract_list, snapshot_id)
 
-                task_uuid = self._record_tag_extract_task(job_uuid, shard_uuid, task_id, config_uuid, config_type, extract_val)
-                self._create_tag_extract_task(job_uuid, shard_uuid, task_uuid, task_id, config_uuid, config_type, extract_val)
-                
-                task_counter += 1
-                task_running_total += 1
-                
-                if task_counter == self.tasks_per_shard:
-                    self._update_shard_tasks(job_uuid, shard_uuid, task_counter)
-                    task_counter = 0
-                    break
+         
+    def create_entry_range_tasks(self, job_uuid, config_uuid, config_type, entry_ranges, snapshot_id=None):
         
-        # update shard with last task_counter
-        if task_counter > 0:    
-            self._update_shard_tasks(job_uuid, shard_uuid, task_counter)
+        print('*** enter create_entry_range_tasks ***')
+        
+        # each task carries a byte range of a backup file instead of the entries themselves
+        return self._fan_out_tasks(job_uuid, config_uuid, config_type, 'entry_range', entry_ranges, snapshot_id)
 
          
     def update_task_status(self, shard_uuid, task_uuid, status):     
@@ -150,10 +100,131 @@ class TaskManager:
         if status == 'FAILED':
             self._set_task_failed(shard_uuid, task_uuid)
             self._set_rollup_tasks_failed(shard_uuid)
+    
+    
+    def update_uri_status(self, shard_uuid, task_uuid, uri_status):
+        
+        # records the outcome of each uri processed by a multi-uri task
+        # uri_status = list of {'uri': uri, 'status': COMPLETED or FAILED}
+        task_ref = self.db.collection('shards').document(shard_uuid).collection('tasks').document(task_uuid)
+        task_ref.set({'uri_status': uri_status}, merge=True)
 
 
 ################ INTERNAL PROCESSING METHODS #################
 
+    def _fan_out_tasks(self, job_uuid, config_uuid, config_type, payload_key, work_items, snapshot_id=None):
+        
+        # payload_key is 'uri', 'uris', 'tag_extract' or 'entry_range', depending on the config type
+        # snapshot_id references the config snapshot taken by _split_work, when there is one
+        # each shard of up to 1000 tasks is recorded in Firestore with batched writes,  
+        # and then submitted to Cloud Tasks from a bounded thread pool
+        start_time = time.time()
+        task_total = 0
+        work_iter = iter(work_items)
+        
+        with ThreadPoolExecutor(max_workers=self.fanout_workers) as executor:
+            
+            for shard_index in itertools.count():
+                
+                shard_items = list(itertools.islice(work_iter, self.tasks_per_shard))
+                
+                if len(shard_items) == 0:
+                    break
+                
+                shard_id_raw = job_uuid + str(shard_index)
+                shard_uuid = hashlib.md5(shard_id_raw.encode()).hexdigest()
+                self._create_shard(job_uuid, shard_uuid)
+                
+                tasks = []
+                offloaded = []
+                
+                for work_item in shard_items:
+                    task_id = self._create_task_id(job_uuid, payload_key, work_item)
+                    task_uuid = uuid.uuid1().hex
+                    
+                    payload = {'job_uuid': job_uuid, 'shard_uuid': shard_uuid, 'task_uuid': task_uuid, 'config_uuid': config_uuid, \
+                               'config_type': config_type}
+                    
+                    # large tag extracts are passed by reference, the task resolves the reference from the payload store
+                    if payload_key == 'tag_extract' and len(ps.encode_payload(work_item)) > ps.PAYLOAD_OFFLOAD_SIZE:
+                        offloaded.append((payload, work_item))
+                    else:
+                        payload[payload_key] = work_item
+                    
+                    if snapshot_id:
+                        payload['snapshot_id'] = snapshot_id
+                    
+                    tasks.append((task_id, payload))
+                
+                if len(offloaded) > 0:
+                    payload_refs = executor.map(self._offload_payload, [work_item for payload, work_item in offloaded])
+                    
+                    for (payload, work_item), payload_ref in zip(offloaded, payload_refs):
+                        
+                        # the payload store couldn't be written to, the tag extract is passed inline as before
+                        if payload_ref == None:
+                            payload['tag_extract'] = work_item
+                        else:
+                            payload['tag_extract_ref'] = payload_ref
+                
+                self._record_tasks(tasks)
+                
+                # set the shard's task count before any of its tasks can run
+                self._update_shard_tasks(job_uuid, shard_uuid, len(tasks))
+                
+                results = list(executor.map(self._create_task, tasks))
+                task_total += len(tasks)
+                
+                print('shard', shard_index, 'created', results.count(True), 'of', len(tasks), 'tasks')
+        
+        elapsed = time.time() - start_time
+        
+        if elapsed > 0:
+            print('Created', task_total, 'tasks in', round(elapsed, 2), 'seconds (' + str(round(task_total / elapsed, 2)), 'tasks/sec)')
+        
+        return task_total
+        
+    
+    def _batch_work_items(self, work_items, batch_size):
+        
+        work_iter = iter(work_items)
+        
+        while True:
+            batch = list(itertools.islice(work_iter, batch_size))
+            
+            if len(batch) == 0:
+                break
+                
+            yield batch
+    
+    
+    def _offload_payload(self, work_item):
+        
+        try:
+            return ps.get_payload_store().put(work_item)
+        
+        except Exception as e:
+            print('Error: could not write the payload to the payload store. Error: ', e)
+            return None
+    
+    
+    def _create_task_id(self, job_uuid, payload_key, work_item):
+        
+        if payload_key == 'tag_extract' or payload_key == 'entry_range':
+            task_id_raw = job_uuid + ''.join(str(work_item))
+        
+        elif payload_key == 'uris':
+            task_id_raw = job_uuid + ''.join(uri if isinstance(uri, str) else ''.join(uri) for uri in work_item)
+        
+        elif isinstance(work_item, str):
+            task_id_raw = job_uuid + work_item
+            
+        else:
+            task_id_raw = job_uuid + ''.join(work_item) # uri is a tuple when it contains a gcs path
+        
+        return hashlib.md5(task_id_raw.encode()).hexdigest()
+        
+        
     def _create_shard(self, job_uuid, shard_uuid):
         
         print('*** _create_shard ***')
@@ -178,67 +249,48 @@ class TaskManager:
         self.db.collection('shards').document(shard_uuid).update({'task_count': task_counter});
         
 
-    def _record_config_uuid_task(self, job_uuid, shard_uuid, task_id, config_uuid, config_type, uri):
-        
-        #print('*** _record_config_uuid_task ***')
-        
-        task_uuid = uuid.uuid1().hex
-        
-        task_ref = self.db.collection('shards').document(shard_uuid).collection('tasks').document(task_uuid)
-
-        task_ref.set({
-            'task_uuid': task_uuid,     # task identifier in Firestore
-            'task_id': task_id,         # cloud task identifier, based on uri
-            'shard_uuid': shard_uuid,   # shard which this task belongs to
-            'job_uuid': job_uuid,
-            'config_uuid': config_uuid,
-            'config_type': config_type,
-            'uri': uri,
-            'status':  'PENDING',
-            'creation_time': datetime.datetime.utcnow()
-        })
+    def _record_tasks(self, tasks):
         
-        #print('created task record ' + task_uuid + ' in shard ' + shard_uuid)
-         
-        return task_uuid    
-    
-    
-    def _record_tag_extract_task(self, job_uuid, shard_uuid, task_id, config_uuid, config_type, extract):
+        #print('*** _record_tasks ***')
         
-        print('*** _record_task ***')
+        batch = self.db.batch()
+        batch_size = 0
         
-        task_uuid = uuid.uuid1().hex
+        for task_id, payload in tasks:
+            
+            task_ref = self.db.collection('shards').document(payload['shard_uuid']).collection('tasks').document(payload['task_uuid'])
+            
+            task_record = {
+                'task_id': task_id,         # cloud task identifier, based on uri or tag extract
+                'status':  'PENDING',
+                'creation_time': datetime.datetime.utcnow()
+            }
+            
+            # task_uuid, shard_uuid, job_uuid, config_uuid, config_type and uri or tag_extract
+            task_record.update(payload)
+            
+            batch.set(task_ref, task_record)
+            batch_size += 1
+            
+            # Firestore allows at most 500 writes per batch
+            if batch_size == 500:
+                batch.commit()
+                batch = self.db.batch()
+                batch_size = 0
         
-        task_ref = self.db.collection('shards').document(shard_uuid).collection('tasks').document(task_uuid)
-
-        task_ref.set({
-            'task_uuid': task_uuid,     # task identifier in Firestore
-            'task_id': task_id,         # cloud task identifier, based on uri
-            'shard_uuid': shard_uuid,   # shard which this task belongs to
-            'job_uuid': job_uuid,
-            'config_uuid': config_uuid,
-            'config_type': config_type,
-            'tag_extract': extract,
-            'status':  'PENDING',
-            'creation_time': datetime.datetime.utcnow()
-        })
+        if batch_size > 0:
+            batch.commit()
         
-        #print('created task record ' + task_uuid + ' in shard ' + shard_uuid)
-         
-        return task_uuid
+        #print('recorded ' + str(len(tasks)) + ' tasks')
     
     
-    def _create_config_uuid_task(self, job_uuid, shard_uuid, task_uuid, task_id, config_uuid, config_type, uri):
+    def _create_task(self, task_tuple):
         
-        print('*** enter _create_config_uuid_task ***')
- 
+        task_id, payload = task_tuple
         success = True
         
-        client = tasks_v2.CloudTasksClient()
-        parent = client.queue_path(self.tag_engine_project, self.queue_region, self.queue_name)
-        
         task = {
-            'name': parent + '/tasks/' + task_id,
+            'name': self.parent + '/tasks/' + task_id,
             'app_engine_http_request': {  
                 'http_method':  tasks_v2.HttpMethod.POST,
                 'relative_uri': self.app_engine_uri
@@ -246,57 +298,20 @@ class TaskManager:
         }
         
         task['app_engine_http_request']['headers'] = {'Content-type': 'application/json'}
-        payload = {'job_uuid': job_uuid, 'shard_uuid': shard_uuid, 'task_uuid': task_uuid, 'config_uuid': config_uuid, 'config_type': config_type, 'uri': uri}
-        #print('payload: ' + str(payload))
-        
-        payload_utf8 = json.dumps(payload).encode()
-        task['app_engine_http_request']['body'] = payload_utf8
+        task['app_engine_http_request']['body'] = json.dumps(payload).encode()
         #print('task: ', task)
 
         try:
-            task = client.create_task(parent=parent, task=task)
+            task = self.client.create_task(parent=self.parent, task=task)
         
         except Exception as e:
-            print('Error: could not create task for uri ', uri, '. Error: ', e)
-            self._set_task_failed(shard_uuid, task_uuid)
-            success = False
+            print('Error: could not create task for task_uuid ', payload['task_uuid'], '. Error: ', e)
+            self._set_task_failed(payload['shard_uuid'], payload['task_uuid'])
+            
+            # the task will never run, so its outcome is recorded here for the job to reach its task count
+            if self.job_manager != None:
+                self.job_manager.record_task_outcome(payload['job_uuid'], 'FAILED')
             
-        return success
-                  
-        
-    def _create_tag_extract_task(self, job_uuid, shard_uuid, task_uuid, task_id, config_uuid, config_type, extract):
-        
-        print('*** enter _create_tag_extract_task ***')
- 
-        success = True
-        
-        client = tasks_v2.CloudTasksClient()
-        parent = client.queue_path(self.tag_engine_project, self.queue_region, self.queue_name)
-        
-        task = {
-            'name': parent + '/tasks/' + task_id,
-            'app_engine_http_request': {  
-                'http_method':  tasks_v2.HttpMethod.POST,
-                'relative_uri': self.app_engine_uri
-            }
-        }
-        
-        task['app_engine_http_request']['headers'] = {'Content-type': 'application/json'}
-        
-        payload = {'job_uuid': job_uuid, 'shard_uuid': shard_uuid, 'task_uuid': task_uuid, 'config_uuid': config_uuid, \
-                   'config_type': config_type, 'tag_extract': extract}
-                
-        payload_utf8 = json.dumps(payload).encode()
-        task['app_engine_http_request']['body'] = payload_utf8
-
-        #print('task: ', task)
-
-        try:
-            task = client.create_task(parent=parent, task=task)
-        
-        except Exception as e:
-            print('Error: could not create task for task_uuid ', task_uuid, '. Error: ', e)
-            self._set_task_failed(shard_uuid, task_uuid)
             success = False
             
         return success
@@ -14,6 +14,7 @@
 
 SUCCESS = 0
 ERROR = -1
+SKIPPED = 1 # tag write skipped because the tag is unchanged
 TAG_CREATED = 'TAG_CREATED'
 TAG_UPDATED = 'TAG_UPDATED'
 BQ_DATASET_TAG = 1
@@ -64,6 +64,31 @@ resource "google_project_iam_member" "data_catalog_viewer_binding" {
   depends_on = [google_project_service.bigquery_project]
 }
 
+# Task payload bucket, holds the tag extracts which are too large to be passed inline to the tasks (see PAYLOAD_BUCKET in tagengine.ini)
+resource "google_storage_bucket" "task_payloads" {
+  name = "${var.tag_engine_project}-task-payloads"
+  location = var.app_engine_subregion
+  project = var.tag_engine_project
+  uniform_bucket_level_access = true
+
+  lifecycle_rule {
+    condition {
+      age = var.task_payload_retention_days
+    }
+    action {
+      type = "Delete"
+    }
+  }
+  
+  depends_on = [google_project_service.tag_engine_project]
+}
+
+resource "google_storage_bucket_iam_member" "task_payloads_object_admin_binding" {
+  bucket = google_storage_bucket.task_payloads.name
+  role   = "roles/storage.objectAdmin"
+  member = "serviceAccount:${var.tag_engine_project}@appspot.gserviceaccount.com"
+}
+
 # Cloud task queues
 resource "google_cloud_tasks_queue" "injector_queue" {
   name = "tag-engine-injector-queue"
@@ -26,4 +26,7 @@ variable "gcp_services_bigquery" {
 	default = ["iam.googleapis.com", "cloudresourcemanager.googleapis.com"]
 }
 
-
+variable "task_payload_retention_days" {
+	type = number
+	default = 7
+}
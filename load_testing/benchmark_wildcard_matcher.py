@@ -0,0 +1,66 @@
+import sys
+import time
+import random
+import string
+
+sys.path.append('..')
+from Resources import Resources
+
+
+def substring_match(table_expression, full_table_id):
+
+    # the matching logic which find_bq_resources used before the compiled patterns
+    table_substrings = table_expression.split("*")
+
+    is_match = True
+    for substring in table_substrings:
+        if substring not in full_table_id:
+            is_match = False
+            break
+
+    return is_match
+
+
+def generate_tables(project, dataset, num_tables):
+
+    prefixes = ['sales', 'orders', 'customers', 'events', 'staging_sales', 'sales_archive']
+
+    tables = []
+
+    for i in range(num_tables):
+        suffix = ''.join(random.choices(string.ascii_lowercase, k=6))
+        table_id = random.choice(prefixes) + '_' + suffix + '_' + str(i)
+        tables.append((project + ':' + dataset + '.' + table_id, table_id))
+
+    return tables
+
+
+def run_benchmark(table_expression, tables):
+
+    start_time = time.time()
+    substring_matches = [full_table_id for full_table_id, table_id in tables if substring_match(table_expression, full_table_id)]
+    substring_time = time.time() - start_time
+
+    start_time = time.time()
+    table_pattern = Resources.compile_pattern(table_expression)
+    pattern_matches = [full_table_id for full_table_id, table_id in tables if table_pattern.match(table_id)]
+    pattern_time = time.time() - start_time
+
+    print('table expression: ' + table_expression)
+    print('substring loop: {} matches in {:.3f} secs'.format(len(substring_matches), substring_time))
+    print('compiled pattern: {} matches in {:.3f} secs'.format(len(pattern_matches), pattern_time))
+    print('speedup: {:.2f}x'.format(substring_time / pattern_time))
+    print('')
+
+
+if __name__ == '__main__':
+
+    project = 'warehouse-337221'
+    dataset = 'sales_dataset'
+    num_tables = 100000
+
+    random.seed(42)
+    tables = generate_tables(project, dataset, num_tables)
+
+    for table_expression in ['sales_*', '*_archive_*', 'orders_*_1*', '*']:
+        run_benchmark(table_expression, tables)
@@ -13,7 +13,7 @@
 # limitations under the License.
 
 from flask import Flask, render_template, request, redirect, url_for, jsonify, json
-import datetime, configparser
+import datetime, configparser, copy
 from google.cloud import firestore
 import DataCatalogUtils as dc
 import TagEngineUtils as te
@@ -24,6 +24,8 @@ import constants
 
 import JobManager as jobm
 import TaskManager as taskm
+import LocalExecutor as localx
+import PayloadStore as ps
 import BigQueryUtils as bq
 
 from google.cloud import tasks_v2
@@ -32,13 +34,22 @@ import datetime, time
 
 config = configparser.ConfigParser()
 config.read("tagengine.ini")
+EXECUTION_MODE = config['DEFAULT'].get('EXECUTION_MODE', 'CLOUD_TASKS') # CLOUD_TASKS or LOCAL
+RESTORE_ENTRIES_PER_TASK = int(config['DEFAULT'].get('RESTORE_ENTRIES_PER_TASK', 50)) # backup file entries per restore task
+EXPORT_URIS_PER_TASK = int(config['DEFAULT'].get('EXPORT_URIS_PER_TASK', 10)) # uris per export task, when the config doesn't set uris_per_task
 
 app = Flask(__name__)
 teu = te.TagEngineUtils()
 
 # handles create requests from API and on-demand update requests from API (i.e. config contains refresh_mode = ON_DEMAND) 
-jm = jobm.JobManager(config['DEFAULT']['TAG_ENGINE_PROJECT'], config['DEFAULT']['QUEUE_REGION'], config['DEFAULT']['INJECTOR_QUEUE'], "/_split_work")
-tm = taskm.TaskManager(config['DEFAULT']['TAG_ENGINE_PROJECT'], config['DEFAULT']['QUEUE_REGION'], config['DEFAULT']['WORK_QUEUE'], "/_run_task")
+if EXECUTION_MODE == 'LOCAL':
+    # the jobs and tasks are tracked in memory and run in-process, the handlers get registered below split_work and run_task
+    local_executor = localx.LocalExecutor()
+    jm = localx.LocalJobManager(local_executor, "/_split_work")
+    tm = localx.LocalTaskManager(local_executor, "/_run_task")
+else:
+    jm = jobm.JobManager(config['DEFAULT']['TAG_ENGINE_PROJECT'], config['DEFAULT']['QUEUE_REGION'], config['DEFAULT']['INJECTOR_QUEUE'], "/_split_work")
+    tm = taskm.TaskManager(config['DEFAULT']['TAG_ENGINE_PROJECT'], config['DEFAULT']['QUEUE_REGION'], config['DEFAULT']['WORK_QUEUE'], "/_run_task", jm)
 
 ##################### UI METHODS #################
 
@@ -326,6 +337,9 @@ def search_tag_template():
     template_region = request.form['template_region']
     
     dcu = dc.DataCatalogUtils(template_id, template_project, template_region)
+    
+    # the user is (re)loading the template, don't serve them a stale copy from the cache
+    dc.DataCatalogUtils.invalidate_template_cache(dcu.template_path)
     fields = dcu.get_template()
     
     #print("fields: " + str(fields))
@@ -1666,6 +1680,21 @@ def get_refresh_parameters(json):
     return refresh_mode, refresh_frequency, refresh_unit
 
 
+def get_uris_per_task(json):
+    
+    # optional setting, packs multiple uris into each task of the job
+    uris_per_task = 1
+    
+    if 'uris_per_task' in json:
+        
+        try:
+            uris_per_task = max(int(json['uris_per_task']), 1)
+        except ValueError:
+            print("uris_per_task must be a positive integer, defaulting to 1.")
+        
+    return uris_per_task
+
+
 def check_template_parameters(request_name, json_request):
 
     valid_parameters = True
@@ -1760,10 +1789,12 @@ def dynamic_table_tags():
     else:
         tag_stream = None
     
+    uris_per_task = get_uris_per_task(json)
+    
     config_uuid, included_tables_uris_hash = teu.write_dynamic_table_config('PENDING', fields, included_tables_uris, excluded_tables_uris, \
                                                                      template_uuid,\
                                                                      refresh_mode, refresh_frequency, refresh_unit, \
-                                                                     tag_history, tag_stream)                                                      
+                                                                     tag_history, tag_stream, uris_per_task)                                                      
 
     if isinstance(config_uuid, str): 
         job_uuid = jm.create_job(config_uuid, 'DYNAMIC_TABLE_TAG')
@@ -1931,11 +1962,13 @@ def static_asset_tags():
     print('Getting refresh paramenters')
     refresh_mode, refresh_frequency, refresh_unit = get_refresh_parameters(json)
     
+    uris_per_task = get_uris_per_task(json)
+    
     # since we are creating a new config, we are overwriting any previously created tags
     overwrite = True
     config_uuid, included_assets_uris_hash, data = teu.write_static_asset_config('PENDING', fields, included_assets_uris, excluded_assets_uris, template_uuid,\
                                                             refresh_mode, refresh_frequency, refresh_unit, \
-                                                            tag_history, tag_stream, overwrite)
+                                                            tag_history, tag_stream, overwrite, uris_per_task)
 
     resp = run_sync_task(config_uuid, 'STATIC_ASSET_TAG', json, confs, data)
 
@@ -2736,6 +2769,15 @@ def _split_work():
     json = request.get_json(force=True)
     #print('json: ', json)
     
+    success = split_work(json)
+    
+    resp = jsonify(success=success)
+    return resp
+
+
+def split_work(json):
+    
+    # splits a job into tasks, called by the /_split_work handler or by the local executor
     job_uuid = json['job_uuid']
     config_uuid = json['config_uuid']
     config_type = json['config_type']
@@ -2745,28 +2787,39 @@ def _split_work():
     print('config: ', config)
     
     if config == {}:
-       resp = jsonify(success=False)
-       return resp 
+       return False 
+    
+    # the config doesn't change for the life of the job, the tasks read it from this snapshot
+    snapshot_id = snapshot_config(job_uuid, config, config_type)
+    success = True
     
     # dynamic table and dynamic column and sensitive column configs
     if 'included_tables_uris' in config:
-        uris = list(res.Resources.get_resources(config.get('included_tables_uris'), config.get('excluded_tables_uris', None)))
+        uris = res.Resources.get_resources(config.get('included_tables_uris'), config.get('excluded_tables_uris', None))
+        uris_per_task = config.get('uris_per_task', 1)
         
-        print('inside _split_work() uris: ', uris)
+        if uris is None:
+            finalize_config(job_uuid, config_uuid, config_type, False)
+            return False
         
-        jm.record_num_tasks(job_uuid, len(uris))
+        # the uris are streamed into the fan-out, so the tasks get created while the enumeration is running
         jm.update_job_running(job_uuid) 
-        tm.create_config_uuid_tasks(job_uuid, config_uuid, config_type, uris)
+        teu.update_config_status(config_uuid, config_type, 'RUNNING')
+        success = fan_out(job_uuid, config_uuid, config_type, tm.create_config_uuid_tasks, uris, uris_per_task, snapshot_id)
     
     # static asset config and glossary asset config    
     if 'included_assets_uris' in config:
-        uris = list(res.Resources.get_resources(config.get('included_assets_uris'), config.get('excluded_assets_uris', None)))
+        uris = res.Resources.get_resources(config.get('included_assets_uris'), config.get('excluded_assets_uris', None))
+        uris_per_task = config.get('uris_per_task', 1)
         
-        print('inside _split_work() uris: ', uris)
+        if uris is None:
+            finalize_config(job_uuid, config_uuid, config_type, False)
+            return False
         
-        jm.record_num_tasks(job_uuid, len(uris))
+        # the uris are streamed into the fan-out, so the tasks get created while the enumeration is running
         jm.update_job_running(job_uuid) 
-        tm.create_config_uuid_tasks(job_uuid, config_uuid, config_type, uris)
+        teu.update_config_status(config_uuid, config_type, 'RUNNING')
+        success = fan_out(job_uuid, config_uuid, config_type, tm.create_config_uuid_tasks, uris, uris_per_task, snapshot_id)
     
     # export tag config
     if config_type == 'EXPORT_TAG':
@@ -2786,50 +2839,55 @@ def _split_work():
         else:
             uris = res.Resources.get_resources_by_project(config['source_projects'])
         
-        print('Info: Number of uris:', uris)
+        if uris is None:
+            finalize_config(job_uuid, config_uuid, config_type, False)
+            return False
+        
+        print('Info: Number of uris:', len(uris))
         print('Info: uris:', uris)
         
-        jm.record_num_tasks(job_uuid, len(uris))
+        # each export task loads the tags of its uris into the report tables with one load job per table
+        uris_per_task = config.get('uris_per_task', EXPORT_URIS_PER_TASK)
+        
         jm.update_job_running(job_uuid) 
-        tm.create_config_uuid_tasks(job_uuid, config_uuid, config_type, uris)
+        teu.update_config_status(config_uuid, config_type, 'RUNNING')
+        success = fan_out(job_uuid, config_uuid, config_type, tm.create_config_uuid_tasks, uris, uris_per_task, snapshot_id)
     
-    # import or restore tag configs
-    if config_type == 'IMPORT_TAG' or config_type == 'RESTORE_TAG':
-                    
-        if config_type == 'IMPORT_TAG':
-            csv_files = list(res.Resources.get_resources(config.get('metadata_import_location'), None))
-            #print('csv_files: ', csv_files)
+    # import tag config
+    if config_type == 'IMPORT_TAG':
         
-            extracted_tags = []
+        csv_files = res.Resources.get_resources(config.get('metadata_import_location'), None)
         
-            for csv_file in csv_files:
-                extracted_tags.extend(cp.CsvParser.extract_tags(csv_file))
+        if csv_files is None:
+            finalize_config(job_uuid, config_uuid, config_type, False)
+            return False
+        
+        # the rows are streamed from the CSV files into the fan-out, so the files are never held in memory
+        extracted_tags = cp.CsvParser.iter_tags(csv_files)
+        
+        jm.update_job_running(job_uuid) 
+        teu.update_config_status(config_uuid, config_type, 'RUNNING')
+        success = fan_out(job_uuid, config_uuid, config_type, tm.create_tag_extract_tasks, extracted_tags, snapshot_id)
     
-        if config_type == 'RESTORE_TAG':
-            bkp_files = list(res.Resources.get_resources(config.get('metadata_export_location'), None))
+    # restore tag config
+    if config_type == 'RESTORE_TAG':
+        
+        bkp_files = res.Resources.get_resources(config.get('metadata_export_location'), None)
         
-            #print('bkp_files: ', bkp_files)
-            extracted_tags = []
+        if bkp_files is None:
+            finalize_config(job_uuid, config_uuid, config_type, False)
+            return False
         
-            for bkp_file in bkp_files:
-                extracted_tags.append(bfp.BackupFileParser.extract_tags(config.get('source_template_id'), config.get('source_template_project'), \
-                                                                        bkp_file))
-             
-        # no tags were extracted from the CSV files
-        if extracted_tags == [[]]:
-           resp = jsonify(success=False)
-           return resp
+        # the backup files are split into ranges of entries, each task reads its own range from GCS
+        entry_ranges = (entry_range for bkp_file in bkp_files for entry_range in \
+                        bfp.BackupFileParser.iter_entry_ranges(config.get('source_template_id'), config.get('source_template_project'), \
+                                                               bkp_file, RESTORE_ENTRIES_PER_TASK))
         
-        jm.record_num_tasks(job_uuid, len(extracted_tags))
         jm.update_job_running(job_uuid) 
-        tm.create_tag_extract_tasks(job_uuid, config_uuid, config_type, extracted_tags)
+        teu.update_config_status(config_uuid, config_type, 'RUNNING')
+        success = fan_out(job_uuid, config_uuid, config_type, tm.create_entry_range_tasks, entry_ranges, snapshot_id)
     
-
-    # update the status of the config, no matter which config type is running
-    teu.update_config_status(config_uuid, config_type, 'RUNNING')
-    
-    resp = jsonify(success=True)
-    return resp
+    return success
 
 
 def run_sync_task(config_uuid, config_type, json_data, template_conf, confs):
@@ -2850,7 +2908,7 @@ def run_sync_task(config_uuid, config_type, json_data, template_conf, confs):
         tag_extract = None
 
     # retrieve the config
-    config = confs.get()
+    config = confs.get().to_dict()
     #config = teu.read_config(config_uuid, config_type)
     print('config: ', config)
 
@@ -2892,7 +2950,7 @@ def run_sync_task(config_uuid, config_type, json_data, template_conf, confs):
                 "message": "Request JSON is missing some required template_uuid parameter",
             }
             return response
-        template_config = template_conf.get()
+        template_config = template_conf.get().to_dict()
         #template_config = teu.read_tag_template_config(config['template_uuid'])
         dcu = dc.DataCatalogUtils(template_config['template_id'], template_config['template_project'],
                                   template_config['template_region'])
@@ -2937,41 +2995,215 @@ def run_sync_task(config_uuid, config_type, json_data, template_conf, confs):
     if config_type == 'RESTORE_TAG':
         creation_status = dcu.apply_restore_config(config['config_uuid'], tag_extract, \
                                                    config['tag_history'], config['tag_stream'], config['overwrite'])
+    
+    if dcu.flush_tag_history() == False:
+        creation_status = constants.ERROR
+    
+    if dcu.flush_tag_stream() > 0:
+        creation_status = constants.ERROR
+    
+    if dcu.flush_export() == False:
+        creation_status = constants.ERROR
 
     return creation_status
 
 
+def fan_out(job_uuid, config_uuid, config_type, create_tasks, work_items, *args):
+    
+    # creates the tasks from a stream of work items and records the task count, returns False if the enumeration failed
+    enumeration_errors = []
+    num_tasks = create_tasks(job_uuid, config_uuid, config_type, guard_enumeration(job_uuid, work_items, enumeration_errors), *args)
+    
+    print('inside _split_work() num_tasks: ', num_tasks)
+    
+    # the failed enumeration is counted as a failed task, so that the job fails once the tasks created before the error have run
+    if len(enumeration_errors) > 0:
+        jm.record_task_outcome(job_uuid, 'FAILED')
+        num_tasks += 1
+    
+    record_num_tasks(job_uuid, config_uuid, config_type, num_tasks)
+    
+    return len(enumeration_errors) == 0
+
+
+def guard_enumeration(job_uuid, work_items, enumeration_errors):
+    
+    # ends the stream on an enumeration error, the work items yielded up to that point still get their tasks
+    try:
+        yield from work_items
+    
+    except Exception as e:
+        print('Error occurred while enumerating the work items of job', job_uuid, '. Error:', e)
+        enumeration_errors.append(e)
+
+
+def record_num_tasks(job_uuid, config_uuid, config_type, num_tasks):
+    
+    # no task will ever complete a job which has none, so it gets finalized here
+    if num_tasks == 0:
+        jm.record_num_tasks(job_uuid, num_tasks)
+        jm.update_job_completed(job_uuid)
+        finalize_config(job_uuid, config_uuid, config_type, True)
+        return
+    
+    jm.record_num_tasks(job_uuid, num_tasks)
+    
+    # the tasks run while the uris are still being enumerated, if they have all finished by now, 
+    # none of them could complete the job because the task count wasn't known yet
+    is_success, is_failed, pct_complete = jm.calculate_job_completion(job_uuid)
+    
+    if pct_complete == 100 and (is_success or is_failed):
+        finalize_config(job_uuid, config_uuid, config_type, is_success)
+
+
+def finalize_config(job_uuid, config_uuid, config_type, is_success):
+    
+    if is_success:
+        teu.update_config_status(config_uuid, config_type, 'ACTIVE')
+        teu.update_scheduling_status(config_uuid, config_type, 'READY')
+        teu.update_overwrite_flag(config_uuid, config_type)
+    else:
+        teu.update_config_status(config_uuid, config_type, 'ERROR')
+        jm.update_job_failed(job_uuid)
+
+
+def snapshot_config(job_uuid, config, config_type):
+    
+    # resolves the template coordinates and parses the template fields once per job,
+    # so that the tasks don't need to read the config and template on every run
+    # the template is read rather than taken from the cache, so that a new job always sees the current fields
+    template_config = None
+    template_fields = None
+    
+    if config_type == 'IMPORT_TAG':
+        if 'template_id' in config and 'template_project' in config and 'template_region' in config:
+            template_config = {'template_id': config['template_id'], 'template_project': config['template_project'], \
+                               'template_region': config['template_region']}
+    
+    elif config_type == 'RESTORE_TAG':
+        if 'target_template_id' in config and 'target_template_project' in config and 'target_template_region' in config:
+            template_config = {'template_id': config['target_template_id'], 'template_project': config['target_template_project'], \
+                               'template_region': config['target_template_region']}
+    
+    elif config_type != 'EXPORT_TAG' and 'template_uuid' in config:
+        template_config = teu.read_tag_template_config(config['template_uuid'])
+    
+    if template_config:
+        try:
+            dcu = dc.DataCatalogUtils(template_config['template_id'], template_config['template_project'], template_config['template_region'])
+            template_fields = dcu.get_template_fields(refresh=True)
+        except Exception as e:
+            # the tasks fall back to reading the template themselves 
+            print('Error occurred while reading the tag template for the config snapshot. Error: ', e)
+    
+    return teu.write_config_snapshot(job_uuid, config, template_config, template_fields)
+
+
+def apply_config(dcu, config, config_type, uri, tag_extract):
+    
+    # runs the config against a single uri or tag extract
+    # the fields get copied, because the apply methods store the computed tag values in them 
+    creation_status = constants.ERROR
+    fields = copy.deepcopy(config.get('fields'))
+    
+    if config_type == 'DYNAMIC_TABLE_TAG':
+        creation_status = dcu.apply_dynamic_table_config(fields, uri, config['config_uuid'], \
+                                                         config['template_uuid'], config['tag_history'], \
+                                                         config['tag_stream'])                                               
+    if config_type == 'DYNAMIC_COLUMN_TAG':
+        creation_status = dcu.apply_dynamic_column_config(fields, config['included_columns_query'], uri, config['config_uuid'], \
+                                                          config['template_uuid'], config['tag_history'], \
+                                                          config['tag_stream'])
+    if config_type == 'STATIC_ASSET_TAG':
+        creation_status = dcu.apply_static_asset_config(fields, uri, config['config_uuid'], \
+                                                        config['template_uuid'], config['tag_history'], \
+                                                        config['tag_stream'], config['overwrite'])                                                   
+    if config_type == 'ENTRY':
+        creation_status = dcu.apply_entry_config(fields, uri, config['config_uuid'], \
+                                                 config['template_uuid'], config['tag_history'], \
+                                                 config['tag_stream']) 
+    if config_type == 'GLOSSARY_ASSET_TAG':
+        creation_status = dcu.apply_glossary_asset_config(fields, config['mapping_table'], uri, config['config_uuid'], \
+                                                    config['template_uuid'], config['tag_history'], \
+                                                    config['tag_stream'], config['overwrite'])
+    if config_type == 'SENSITIVE_COLUMN_TAG':
+        creation_status = dcu.apply_sensitive_column_config(fields, config['dlp_dataset'], config['infotype_selection_table'], \
+                                                            config['infotype_classification_table'], uri, config['create_policy_tags'], \
+                                                            config['taxonomy_id'], config['config_uuid'], \
+                                                            config['template_uuid'], config['tag_history'], \
+                                                            config['tag_stream'], config['overwrite'])
+    if config_type == 'EXPORT_TAG':
+        creation_status = dcu.apply_export_config(config['config_uuid'], config['target_project'], config['target_dataset'], config['target_region'], uri)
+    
+    if config_type == 'IMPORT_TAG':
+        creation_status = dcu.apply_import_config(config['config_uuid'], tag_extract, \
+                                                  config['tag_history'], config['tag_stream'], config['overwrite'])
+    if config_type == 'RESTORE_TAG':
+        creation_status = dcu.apply_restore_config(config['config_uuid'], tag_extract, \
+                                                   config['tag_history'], config['tag_stream'], config['overwrite'])
+    
+    return creation_status
+    
+
 @app.route("/_run_task", methods=['POST'])
 def _run_task():
     
     print('*** enter _run_task ***')
     
+    json = request.get_json(force=True)
+    
+    response, status_code = run_task(json)
+    
+    return jsonify(response), status_code
+
+
+def run_task(json):
+    
+    # runs one task, called by the /_run_task handler or by the local executor
     creation_status = constants.ERROR
     
-    json = request.get_json(force=True)
     job_uuid = json['job_uuid']
     config_uuid = json['config_uuid']
     config_type = json['config_type']
     shard_uuid = json['shard_uuid']
     task_uuid = json['task_uuid']
     
-    if 'uri' in json:
-        uri = json['uri']
+    # a task carries either a single uri, a micro-batch of uris, or a tag extract
+    if 'uris' in json:
+        uris = json['uris']
+    elif 'uri' in json:
+        uris = [json['uri']]
     else:
-        uri = None
-        #print('uri: ', uri)
+        uris = [None]
+        #print('uris: ', uris)
         
     if 'tag_extract' in json:
         tag_extract = json['tag_extract']
         #print('tag_extract: ', tag_extact)
+    elif 'tag_extract_ref' in json:
+        tag_extract = ps.get_payload_store().get(json['tag_extract_ref'])
     else:
         tag_extract = None
         
     
     tm.update_task_status(shard_uuid, task_uuid, 'RUNNING')
     
-    # retrieve the config 
-    config = teu.read_config(config_uuid, config_type)
+    # retrieve the config, from the job's snapshot when the task carries one 
+    snapshot = None
+    
+    if 'snapshot_id' in json:
+        snapshot = teu.read_config_snapshot(json['snapshot_id'])
+        
+        # the config may have changed since the job was split, so the task fails rather than running with the current one
+        if snapshot == None:
+            print('Error: config snapshot', json['snapshot_id'], 'not found')
+            return complete_task(job_uuid, config_uuid, config_type, shard_uuid, task_uuid, constants.ERROR, {})
+    
+    if snapshot:
+        config = snapshot['config']
+    else:
+        config = teu.read_config(config_uuid, config_type)
+    
     print('config: ', config)
       
     if config_type == 'EXPORT_TAG':
@@ -2984,7 +3216,7 @@ def _run_task():
                     "status": "error",
                     "message": "Request JSON is missing required template parameters",
             }
-            return jsonify(response), 400
+            return response, 400
         
         dcu = dc.DataCatalogUtils(config['template_id'], config['template_project'], config['template_region'])
     
@@ -2995,13 +3227,13 @@ def _run_task():
                     "status": "error",
                     "message": "Request JSON is missing some required target tag template parameters",
             }
-            return jsonify(response), 400
+            return response, 400
         if 'source_template_id' not in config or 'source_template_project' not in config or 'source_template_region' not in config:
             response = {
                     "status": "error",
                     "message": "Request JSON is missing some required source tag template parameters",
             }
-            return jsonify(response), 400
+            return response, 400
         
         dcu = dc.DataCatalogUtils(config['target_template_id'], config['target_template_project'], config['target_template_region'])
     else:
@@ -3010,72 +3242,106 @@ def _run_task():
                     "status": "error",
                     "message": "Request JSON is missing some required template_uuid parameter",
             }
-            return jsonify(response), 400
+            return response, 400
+            
+        if snapshot and snapshot['template_config']:
+            template_config = snapshot['template_config']
+        else:
+            template_config = teu.read_tag_template_config(config['template_uuid'])
             
-        template_config = teu.read_tag_template_config(config['template_uuid'])
         dcu = dc.DataCatalogUtils(template_config['template_id'], template_config['template_project'], template_config['template_region'])
+    
+    # restore tasks carry a byte range of a backup file, the entries in the range are read by the task
+    if 'entry_range' in json:
+        tag_extract = bfp.BackupFileParser.read_entry_range(config['source_template_id'], config['source_template_project'], \
+                                                            json['entry_range'])
+    
+    if snapshot and snapshot['template_fields']:
+        dcu.use_template_fields(snapshot['template_fields'])
+    
+    if config_type == 'DYNAMIC_TABLE_TAG' or config_type == 'DYNAMIC_COLUMN_TAG':
+        dcu.enable_query_cache(job_uuid)
             
     
-    if config_type == 'DYNAMIC_TABLE_TAG':
-        creation_status = dcu.apply_dynamic_table_config(config['fields'], uri, config['config_uuid'], \
-                                                         config['template_uuid'], config['tag_history'], \
-                                                         config['tag_stream'])                                               
-    if config_type == 'DYNAMIC_COLUMN_TAG':
-        creation_status = dcu.apply_dynamic_column_config(config['fields'], config['included_columns_query'], uri, config['config_uuid'], \
-                                                          config['template_uuid'], config['tag_history'], \
-                                                          config['tag_stream'])
-    if config_type == 'STATIC_ASSET_TAG':
-        creation_status = dcu.apply_static_asset_config(config['fields'], uri, config['config_uuid'], \
-                                                        config['template_uuid'], config['tag_history'], \
-                                                        config['tag_stream'], config['overwrite'])                                                   
-    if config_type == 'ENTRY':
-        creation_status = dcu.apply_entry_config(config['fields'], uri, config['config_uuid'], \
-                                                 config['template_uuid'], config['tag_history'], \
-                                                 config['tag_stream']) 
-    if config_type == 'GLOSSARY_ASSET_TAG':
-        creation_status = dcu.apply_glossary_asset_config(config['fields'], config['mapping_table'], uri, config['config_uuid'], \
-                                                    config['template_uuid'], config['tag_history'], \
-                                                    config['tag_stream'], config['overwrite'])
-    if config_type == 'SENSITIVE_COLUMN_TAG':
-        creation_status = dcu.apply_sensitive_column_config(config['fields'], config['dlp_dataset'], config['infotype_selection_table'], \
-                                                            config['infotype_classification_table'], uri, config['create_policy_tags'], \
-                                                            config['taxonomy_id'], config['config_uuid'], \
-                                                            config['template_uuid'], config['tag_history'], \
-                                                            config['tag_stream'], config['overwrite'])
-    if config_type == 'EXPORT_TAG':
-        creation_status = dcu.apply_export_config(config['config_uuid'], config['target_project'], config['target_dataset'], config['target_region'], uri)
+    if len(uris) == 1:
+        creation_status = apply_config(dcu, config, config_type, uris[0], tag_extract)
     
-    if config_type == 'IMPORT_TAG':
-        creation_status = dcu.apply_import_config(config['config_uuid'], tag_extract, \
-                                                  config['tag_history'], config['tag_stream'], config['overwrite'])
-    if config_type == 'RESTORE_TAG':
-        creation_status = dcu.apply_restore_config(config['config_uuid'], tag_extract, \
-                                                   config['tag_history'], config['tag_stream'], config['overwrite'])
+    else:
+        # multi-uri task, the clients held by dcu are shared by all the uris in the batch
+        creation_status = constants.SUCCESS
+        uri_status = []
+        
+        for uri in uris:
+            
+            try:
+                uri_creation_status = apply_config(dcu, config, config_type, uri, tag_extract)
+            except Exception as e:
+                print('Error occurred while processing uri ', uri, '. Error: ', e)
+                uri_creation_status = constants.ERROR
+            
+            if uri_creation_status == constants.SUCCESS:
+                status = 'COMPLETED'
+            else:
+                status = 'FAILED'
+                creation_status = constants.ERROR
+            
+            if isinstance(uri, str):
+                uri_status.append({'uri': uri, 'status': status})
+            else:
+                uri_status.append({'uri': '/'.join(uri), 'status': status}) # gcs path
+        
+        tm.update_uri_status(shard_uuid, task_uuid, uri_status)
+    
+    if dcu.flush_tag_history() == False:
+        creation_status = constants.ERROR
+    
+    # lost tag stream messages fail the task and are counted on the job
+    if dcu.flush_tag_stream() > 0:
+        creation_status = constants.ERROR
+    
+    # the exported tags of all the task's uris are loaded together
+    if dcu.flush_export() == False:
+        creation_status = constants.ERROR
                                               
+    return complete_task(job_uuid, config_uuid, config_type, shard_uuid, task_uuid, creation_status, dcu.get_counters())
+
+
+def complete_task(job_uuid, config_uuid, config_type, shard_uuid, task_uuid, creation_status, counters):
+    
     if creation_status == constants.SUCCESS:
-        tm.update_task_status(shard_uuid, task_uuid, 'COMPLETED')
+        task_status = 'COMPLETED'
     else:
-        tm.update_task_status(shard_uuid, task_uuid, 'FAILED')
+        task_status = 'FAILED'
+    
+    # the task's statistics need to be recorded before its outcome, so that they're included in the job's final counts
+    jm.record_counters(job_uuid, counters)
     
-    # fan-in
+    tm.update_task_status(shard_uuid, task_uuid, task_status)
+    jm.record_task_outcome(job_uuid, task_status)
+    
+    # fan-in, is_success or is_failed is only set for the task which finished the job
     is_success, is_failed, pct_complete = jm.calculate_job_completion(job_uuid)
         
     if pct_complete == 100 and is_success:
-        teu.update_config_status(config_uuid, config_type, 'ACTIVE')
-        teu.update_scheduling_status(config_uuid, config_type, 'READY')
-        teu.update_overwrite_flag(config_uuid, config_type)
-        resp = jsonify(success=True)
+        finalize_config(job_uuid, config_uuid, config_type, is_success)
+        resp = {'success': True}
     elif pct_complete == 100 and is_failed:
-        teu.update_config_status(config_uuid, config_type, 'ERROR')
-        jm.update_job_failed(job_uuid)
-        resp = jsonify(success=False)
-    else:
+        finalize_config(job_uuid, config_uuid, config_type, is_success)
+        resp = {'success': False}
+    elif pct_complete < 100:
         teu.update_config_status(config_uuid, config_type, 'PROCESSING: {}% complete'.format(pct_complete))
-        resp = jsonify(success=True)
+        resp = {'success': True}
+    else:
+        # another task has already finished the job
+        resp = {'success': (creation_status == constants.SUCCESS)}
     
-    return resp
+    return resp, 200
 #[END _run_task]
 
+if EXECUTION_MODE == 'LOCAL':
+    local_executor.register_handler("/_split_work", split_work)
+    local_executor.register_handler("/_run_task", run_task)
+
 ####################### VERSION METHOD ####################################  
     
 @app.route("/version", methods=['GET'])
@@ -0,0 +1,6 @@
+import os, sys
+
+# the Tag Engine modules live at the root of the repo, and read tagengine.ini from the working directory
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+os.chdir(ROOT_DIR)
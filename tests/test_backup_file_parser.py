@@ -0,0 +1,29 @@
+import pytest
+
+pytest.importorskip('google.cloud.storage')
+pytest.importorskip('jsonlines')
+exceptions = pytest.importorskip('google.api_core.exceptions')
+
+import BackupFileParser as bfp
+
+
+class MissingBlobBucket:
+
+    def get_blob(self, filename):
+        return None
+
+
+class MissingBlobClient:
+
+    def bucket(self, bucket_name):
+        return MissingBlobBucket()
+
+
+def test_missing_backup_file_raises_not_found(monkeypatch):
+
+    monkeypatch.setattr(bfp.cr, 'get_client', lambda service, project=None, location=None: MissingBlobClient())
+
+    entry_ranges = bfp.BackupFileParser.iter_entry_ranges('data_governance', 'tag-engine', ('backups', 'export.jsonl'), 100)
+
+    with pytest.raises(exceptions.NotFound, match='gs://backups/export.jsonl'):
+        next(entry_ranges)
@@ -0,0 +1,210 @@
+import datetime
+
+import pytest
+
+firestore = pytest.importorskip('google.cloud.firestore')
+exceptions = pytest.importorskip('google.api_core.exceptions')
+
+import DocumentStore as ds
+
+
+# every test runs against both backends, so that they can't drift apart
+@pytest.fixture(params=['MEMORY', 'SQLITE'])
+def store(request, tmp_path):
+
+    if request.param == 'MEMORY':
+        return ds.MemoryStore()
+
+    return ds.SqliteStore(str(tmp_path / 'tagengine.db'))
+
+
+def test_set_and_get(store):
+
+    doc_ref = store.collection('configs').document('c1')
+    doc_ref.set({'config_status': 'ACTIVE', 'fields': [{'field_id': 'f1'}]})
+
+    doc = doc_ref.get()
+
+    assert doc.exists
+    assert doc.id == 'c1'
+    assert doc.to_dict() == {'config_status': 'ACTIVE', 'fields': [{'field_id': 'f1'}]}
+    assert doc.get('config_status') == 'ACTIVE'
+    assert store.collection('configs').document('c2').get().exists == False
+
+
+def test_set_replaces_and_merge_merges(store):
+
+    doc_ref = store.collection('configs').document('c1')
+    doc_ref.set({'a': 1, 'nested': {'x': 1, 'y': 2}})
+
+    doc_ref.set({'nested': {'y': 3}, 'b': 2}, merge=True)
+    assert doc_ref.get().to_dict() == {'a': 1, 'b': 2, 'nested': {'x': 1, 'y': 3}}
+
+    doc_ref.set({'c': 3})
+    assert doc_ref.get().to_dict() == {'c': 3}
+
+
+def test_update_dotted_field_paths(store):
+
+    doc_ref = store.collection('jobs').document('j1')
+    doc_ref.set({'status': 'PENDING', 'counts': {'ran': 0, 'failed': 0}})
+
+    doc_ref.update({'status': 'RUNNING', 'counts.ran': 5, 'stats.elapsed': 1.5})
+
+    assert doc_ref.get().to_dict() == {'status': 'RUNNING', 'counts': {'ran': 5, 'failed': 0}, 'stats': {'elapsed': 1.5}}
+
+
+def test_update_missing_document_raises_not_found(store):
+
+    doc_ref = store.collection('jobs').document('missing')
+
+    with pytest.raises(exceptions.NotFound):
+        doc_ref.update({'status': 'RUNNING'})
+
+    assert doc_ref.get().exists == False
+
+
+def test_create_existing_document_raises_conflict(store):
+
+    doc_ref = store.collection('jobs').document('j1')
+    doc_ref.create({'status': 'PENDING'})
+
+    with pytest.raises(exceptions.Conflict):
+        doc_ref.create({'status': 'RUNNING'})
+
+    assert doc_ref.get().to_dict() == {'status': 'PENDING'}
+
+
+def test_increment(store):
+
+    doc_ref = store.collection('jobs').document('j1').collection('counters').document('0')
+
+    doc_ref.set({'tasks_completed': firestore.Increment(1)}, merge=True)
+    doc_ref.set({'tasks_completed': firestore.Increment(2), 'tasks_failed': firestore.Increment(1)}, merge=True)
+    doc_ref.update({'tasks_failed': firestore.Increment(-1), 'stats.rows': firestore.Increment(10)})
+
+    assert doc_ref.get().to_dict() == {'tasks_completed': 3, 'tasks_failed': 0, 'stats': {'rows': 10}}
+
+
+def test_delete(store):
+
+    doc_ref = store.collection('configs').document('c1')
+    doc_ref.set({'a': 1})
+    doc_ref.delete()
+
+    assert doc_ref.get().exists == False
+    assert store.collection('configs').get() == []
+
+
+def test_add(store):
+
+    write_time, doc_ref = store.collection('logs').add({'msg': 'hello'})
+
+    assert isinstance(write_time, datetime.datetime)
+    assert doc_ref.get().to_dict() == {'msg': 'hello'}
+
+
+def test_subcollections_are_separate(store):
+
+    shard_ref = store.collection('shards').document('s1')
+    shard_ref.set({'tasks_ran': 0})
+    shard_ref.collection('tasks').document('t1').set({'status': 'PENDING'})
+
+    assert [doc.id for doc in store.collection('shards').stream()] == ['s1']
+    assert [doc.id for doc in store.collection('shards/s1/tasks').stream()] == ['t1']
+    assert store.document('shards', 's1', 'tasks', 't1').get().to_dict() == {'status': 'PENDING'}
+
+
+def test_batch_commits_all_writes(store):
+
+    configs = store.collection('configs')
+
+    batch = store.batch()
+    batch.set(configs.document('c1'), {'a': 1})
+    batch.create(configs.document('c2'), {'a': 2})
+    batch.update(configs.document('c1'), {'b': 1})
+    batch.commit()
+
+    assert configs.document('c1').get().to_dict() == {'a': 1, 'b': 1}
+    assert configs.document('c2').get().to_dict() == {'a': 2}
+
+
+def test_batch_is_atomic(store):
+
+    configs = store.collection('configs')
+    configs.document('c1').set({'a': 1})
+
+    batch = store.batch()
+    batch.set(configs.document('c2'), {'a': 2})
+    batch.update(configs.document('c1'), {'a': 10})
+    batch.update(configs.document('missing'), {'a': 3})
+
+    with pytest.raises(exceptions.NotFound):
+        batch.commit()
+
+    assert configs.document('c1').get().to_dict() == {'a': 1}
+    assert configs.document('c2').get().exists == False
+
+
+@pytest.fixture
+def configs(store):
+
+    configs = store.collection('configs')
+    configs.document('c1').set({'status': 'ACTIVE', 'priority': 3, 'tags': ['pii'], 'meta': {'owner': 'a'}})
+    configs.document('c2').set({'status': 'ACTIVE', 'priority': 1, 'tags': ['pii', 'finance'], 'meta': {'owner': 'b'}})
+    configs.document('c3').set({'status': 'INACTIVE', 'priority': 2, 'tags': []})
+    configs.document('c4').set({'status': 'ACTIVE', 'priority': 'high'})
+
+    return configs
+
+
+def query_ids(query):
+
+    return [doc.id for doc in query.stream()]
+
+
+def test_where_equality(configs):
+
+    assert query_ids(configs.where('status', '==', 'ACTIVE')) == ['c1', 'c2', 'c4']
+    assert query_ids(configs.where('status', '==', 'ACTIVE').where('priority', '==', 1)) == ['c2']
+    assert query_ids(configs.where('meta.owner', '==', 'b')) == ['c2']
+    assert query_ids(configs.where('status', '==', 'DELETED')) == []
+
+
+def test_where_operators(configs):
+
+    assert query_ids(configs.where('priority', '>', 1)) == ['c1', 'c3']
+    assert query_ids(configs.where('priority', '<=', 2)) == ['c2', 'c3']
+    assert query_ids(configs.where('status', '!=', 'ACTIVE')) == ['c3']
+    assert query_ids(configs.where('priority', 'in', [1, 2])) == ['c2', 'c3']
+    assert query_ids(configs.where('priority', 'not-in', [1, 2])) == ['c1', 'c4']
+    assert query_ids(configs.where('tags', 'array_contains', 'finance')) == ['c2']
+    assert query_ids(configs.where('tags', 'array_contains_any', ['pii', 'hr'])) == ['c1', 'c2']
+    assert query_ids(configs.where('meta.owner', '>=', 'a')) == ['c1', 'c2']
+
+
+def test_where_unsupported_operator(configs):
+
+    with pytest.raises(ValueError):
+        configs.where('status', 'like', 'ACT%')
+
+
+def test_order_by_and_limit(configs):
+
+    # the documents without the field are left out, and the values of different types are ordered by type
+    assert query_ids(configs.order_by('priority')) == ['c2', 'c3', 'c1', 'c4']
+    assert query_ids(configs.order_by('priority', direction='DESCENDING')) == ['c4', 'c1', 'c3', 'c2']
+    assert query_ids(configs.order_by('meta.owner')) == ['c1', 'c2']
+    assert query_ids(configs.where('status', '==', 'ACTIVE').order_by('priority').limit(2)) == ['c2', 'c1']
+    assert query_ids(configs.limit(1)) == ['c1']
+
+
+def test_timestamps_are_returned_in_utc(store):
+
+    doc_ref = store.collection('jobs').document('j1')
+    doc_ref.set({'creation_time': datetime.datetime(2022, 1, 1, 12, 0, 0)})
+
+    creation_time = doc_ref.get().get('creation_time')
+
+    assert creation_time == datetime.datetime(2022, 1, 1, 12, 0, 0, tzinfo=datetime.timezone.utc)
+    assert query_ids(store.collection('jobs').where('creation_time', '<', datetime.datetime(2023, 1, 1))) == ['j1']
@@ -0,0 +1,133 @@
+import sqlite3
+
+import pytest
+
+pytest.importorskip('google.cloud.datacatalog')
+pytest.importorskip('google.cloud.bigquery')
+pytest.importorskip('pandas')
+
+import DataCatalogUtils as dc
+
+
+class SqliteQueryJob:
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def result(self):
+        return self.rows
+
+
+class SqliteBqClient:
+
+    # stands in for bigquery.Client, runs the queries against an in-memory sqlite database
+    # whose rows can be read by position (run_query) and by name (run_fused_chunk)
+    def __init__(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('create table sales (region text, amount real, closed integer)')
+        self.conn.executemany('insert into sales values (?, ?, ?)', [('west', 10.5, 1), ('east', 99.0, 0), ('north', 42.0, 1)])
+        self.queries = []
+
+    def query(self, query_str):
+        self.queries.append(query_str)
+        return SqliteQueryJob(self.conn.execute(query_str).fetchall())
+
+
+class ErrorStore:
+
+    def __init__(self):
+        self.errors = []
+
+    def write_tag_value_error(self, msg):
+        self.errors.append(msg)
+
+
+def make_dcu():
+
+    dcu = object.__new__(dc.DataCatalogUtils)
+    dcu.query_cache = None
+
+    return dcu
+
+
+def test_is_fusable():
+
+    assert dc.DataCatalogUtils.is_fusable('select count(*) from sales')
+    assert dc.DataCatalogUtils.is_fusable('  with t as (select 1 as x) select x from t;')
+    assert dc.DataCatalogUtils.is_fusable('(select max(amount) from sales)')
+
+    # an order by inside a subquery, a literal or a comment doesn't order the expression itself
+    assert dc.DataCatalogUtils.is_fusable('select region from (select * from sales order by amount) limit 1')
+    assert dc.DataCatalogUtils.is_fusable("select 'order by' from sales")
+    assert dc.DataCatalogUtils.is_fusable('select region from sales -- order by amount')
+    assert dc.DataCatalogUtils.is_fusable('select `order`, by from sales')
+
+    assert dc.DataCatalogUtils.is_fusable('select region from sales order by amount desc') == False
+    assert dc.DataCatalogUtils.is_fusable('SELECT region FROM sales ORDER\n BY amount') == False
+    assert dc.DataCatalogUtils.is_fusable('((select region from sales order by amount))') == False
+    assert dc.DataCatalogUtils.is_fusable('(select region from sales) union all (select region from sales) order by 1') == False
+    assert dc.DataCatalogUtils.is_fusable('select 1; select 2') == False
+    assert dc.DataCatalogUtils.is_fusable('declare x int64 default 1') == False
+
+
+def test_top_level_words():
+
+    assert dc.DataCatalogUtils.top_level_words('SELECT max(amount) FROM sales') == ['select', 'max', 'from', 'sales']
+    assert dc.DataCatalogUtils.top_level_words("select 'a (b' from t /* ) order by */") == ['select', 'from', 't']
+    assert dc.DataCatalogUtils.top_level_words('(select 1)') == []
+
+
+def test_fused_and_per_field_queries_return_the_same_values():
+
+    query_strs = ['select count(*) from sales',
+                  'select max(amount) from sales',
+                  'select region from sales order by amount desc',
+                  'select region from sales order by region',
+                  "select 'west' in (select region from sales)",
+                  'select region from sales where amount > 1000',
+                  'select sum(closed) from sales']
+    fields = [{'field_type': 'double'}, {'field_type': 'double'}, {'field_type': 'string'}, {'field_type': 'string'},
+              {'field_type': 'bool'}, {'field_type': 'string'}, {'field_type': 'double'}]
+
+    dcu = make_dcu()
+    bq_client = SqliteBqClient()
+
+    fused_values = dcu.run_fused_query(bq_client, fields, query_strs, False)
+
+    # the ordered expressions and the expression without a result aren't taken from the fused query
+    assert sorted(fused_values.keys()) == [0, 1, 4, 6]
+    assert len(bq_client.queries) == 1
+
+    for index, query_str in enumerate(query_strs):
+
+        per_field_values, per_field_error = dcu.run_query(bq_client, query_str, fields[index]['field_type'], False, ErrorStore())
+
+        if index in fused_values:
+            assert fused_values[index] == per_field_values
+
+        assert per_field_error == False
+
+    assert dcu.run_query(bq_client, query_strs[2], 'string', False, ErrorStore())[0] == ['east']
+    assert dcu.run_query(bq_client, query_strs[3], 'string', False, ErrorStore())[0] == ['east']
+
+
+def test_failed_fused_query_is_bisected():
+
+    query_strs = ['select count(*) from sales',
+                  'select max(amount) from sales',
+                  'select region, amount from sales',
+                  'select min(amount) from sales',
+                  'select sum(closed) from sales']
+    fields = [{'field_type': 'double'}] * len(query_strs)
+
+    dcu = make_dcu()
+    bq_client = SqliteBqClient()
+
+    fused_values = dcu.run_fused_query(bq_client, fields, query_strs, False)
+
+    # only the expression which returns two columns is left for run_query
+    assert fused_values == {0: [3], 1: [99.0], 3: [10.5], 4: [2]}
+
+    # the fused query, its two halves and the two halves of the half with the bad expression
+    assert len(bq_client.queries) == 5
@@ -0,0 +1,181 @@
+import pytest
+
+import QueryCache as qc
+
+
+@pytest.fixture(autouse=True)
+def query_results(monkeypatch):
+
+    # every test starts with an empty process-wide cache and the default settings
+    monkeypatch.setattr(qc, 'query_results', qc.OrderedDict())
+    monkeypatch.setattr(qc, 'QUERY_CACHE_TTL', 0)
+    monkeypatch.setattr(qc, 'QUERY_CACHE_SIZE', 10000)
+
+    return qc.query_results
+
+
+def test_get_and_put():
+
+    cache = qc.QueryCache('j1')
+
+    assert cache.get('select 1', False) == None
+
+    cache.put('select 1', False, [1])
+
+    assert cache.get('select 1', False) == [1]
+    assert cache.get('select 2', False) == None
+
+
+def test_cached_values_are_copies():
+
+    cache = qc.QueryCache('j1')
+    field_values = ['a']
+    cache.put('select 1', False, field_values)
+
+    field_values.append('b')
+    cache.get('select 1', False).append('c')
+
+    assert cache.get('select 1', False) == ['a']
+
+
+def test_entries_are_keyed_by_job_and_all_rows():
+
+    qc.QueryCache('j1').put('select region from sales', False, ['west'])
+
+    assert qc.QueryCache('j1').get('select region from sales', False) == ['west']
+    assert qc.QueryCache('j2').get('select region from sales', False) == None
+
+    # the first row of a query doesn't answer for all of its rows
+    assert qc.QueryCache('j1').get('select region from sales', True) == None
+
+    qc.QueryCache('j1').put('select region from sales', True, ['west', 'east'])
+
+    assert qc.QueryCache('j1').get('select region from sales', False) == ['west']
+    assert qc.QueryCache('j1').get('select region from sales', True) == ['west', 'east']
+
+
+def test_lru_eviction(monkeypatch):
+
+    monkeypatch.setattr(qc, 'QUERY_CACHE_SIZE', 2)
+    cache = qc.QueryCache('j1')
+
+    cache.put('select 1', False, [1])
+    cache.put('select 2', False, [2])
+
+    # reading an entry makes it the most recently used one
+    assert cache.get('select 1', False) == [1]
+
+    cache.put('select 3', False, [3])
+
+    assert cache.get('select 2', False) == None
+    assert cache.get('select 1', False) == [1]
+    assert cache.get('select 3', False) == [3]
+    assert len(qc.query_results) == 2
+
+
+def test_ttl_expiry(monkeypatch):
+
+    now = [1000.0]
+    monkeypatch.setattr(qc.time, 'time', lambda: now[0])
+    monkeypatch.setattr(qc, 'QUERY_CACHE_TTL', 60)
+
+    cache = qc.QueryCache('j1')
+    cache.put('select 1', False, [1])
+
+    now[0] += 59
+    assert cache.get('select 1', False) == [1]
+
+    now[0] += 1
+    assert cache.get('select 1', False) == None
+
+    # the expired entry is dropped
+    assert len(qc.query_results) == 0
+
+
+def test_no_expiry_without_ttl(monkeypatch):
+
+    now = [1000.0]
+    monkeypatch.setattr(qc.time, 'time', lambda: now[0])
+
+    cache = qc.QueryCache('j1')
+    cache.put('select 1', False, [1])
+
+    now[0] += 365 * 24 * 3600
+    assert cache.get('select 1', False) == [1]
+
+
+def test_counters():
+
+    cache = qc.QueryCache('j1')
+
+    cache.get('select 1', False)
+    cache.put('select 1', False, [1])
+    cache.get('select 1', False)
+    cache.get('select 1', False)
+
+    assert cache.get_counters() == {'query_cache_hits': 2, 'query_cache_misses': 1}
+
+    # the counters belong to the QueryCache object, i.e. to a task, the entries are shared
+    other_cache = qc.QueryCache('j1')
+    other_cache.get('select 1', False)
+
+    assert other_cache.get_counters() == {'query_cache_hits': 1, 'query_cache_misses': 0}
+    assert cache.get_counters() == {'query_cache_hits': 2, 'query_cache_misses': 1}
+
+
+class ListQueryJob:
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def result(self):
+        return self.rows
+
+
+class ListBqClient:
+
+    # stands in for bigquery.Client, returns the rows given for a query string or raises its error
+    def __init__(self, results):
+        self.results = results
+        self.queries = []
+
+    def query(self, query_str):
+        self.queries.append(query_str)
+        result = self.results[query_str]
+
+        if isinstance(result, Exception):
+            raise result
+
+        return ListQueryJob(result)
+
+
+class ErrorStore:
+
+    def __init__(self):
+        self.errors = []
+
+    def write_tag_value_error(self, msg):
+        self.errors.append(msg)
+
+
+def test_run_query_only_caches_non_empty_results_without_errors():
+
+    pytest.importorskip('google.cloud.datacatalog')
+    pytest.importorskip('google.cloud.bigquery')
+    pytest.importorskip('pandas')
+
+    import DataCatalogUtils as dc
+
+    dcu = object.__new__(dc.DataCatalogUtils)
+    dcu.query_cache = qc.QueryCache('j1')
+
+    bq_client = ListBqClient({'select 1': [(1,)], 'select nothing': [], 'select error': ValueError('invalid query')})
+
+    for i in range(2):
+        assert dcu.run_query(bq_client, 'select 1', 'double', False, ErrorStore()) == ([1], False)
+        assert dcu.run_query(bq_client, 'select nothing', 'string', False, ErrorStore()) == ([], False)
+        assert dcu.run_query(bq_client, 'select error', 'string', False, ErrorStore()) == ([], True)
+
+    # the empty result and the error aren't cached, so they run again
+    assert bq_client.queries == ['select 1', 'select nothing', 'select error', 'select nothing', 'select error']
+    assert dcu.query_cache.get_counters() == {'query_cache_hits': 1, 'query_cache_misses': 5}
@@ -0,0 +1,180 @@
+import pytest
+
+exceptions = pytest.importorskip('google.api_core.exceptions')
+
+import RateLimiter as rl
+
+
+class FakeClock:
+
+    # replaces time.monotonic and time.sleep, sleeping moves the clock forward
+    def __init__(self):
+        self.now = 100.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+
+    clock = FakeClock()
+    monkeypatch.setattr(rl.time, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(rl.time, 'sleep', clock.sleep)
+
+    # the backoff returns the upper bound of the jitter, so that the delays can be checked
+    monkeypatch.setattr(rl.random, 'uniform', lambda low, high: high)
+
+    return clock
+
+
+class FlakyRequest:
+
+    # fails with the given errors, one per call, then succeeds
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self, value):
+        self.calls += 1
+
+        if self.errors:
+            raise self.errors.pop(0)
+
+        return value
+
+
+def test_token_bucket_allows_a_burst_then_waits_for_the_refill(clock):
+
+    bucket = rl.TokenBucket(rate=2, capacity=3)
+
+    for i in range(3):
+        bucket.acquire()
+
+    assert clock.sleeps == []
+
+    bucket.acquire()
+
+    assert clock.sleeps == [0.5]
+
+
+def test_token_bucket_refills_up_to_its_capacity(clock):
+
+    bucket = rl.TokenBucket(rate=2, capacity=3)
+
+    for i in range(3):
+        bucket.acquire()
+
+    # a long pause only refills the bucket up to its capacity
+    clock.now += 60
+
+    for i in range(3):
+        bucket.acquire()
+
+    assert clock.sleeps == []
+
+    bucket.acquire()
+
+    assert clock.sleeps == [0.5]
+
+
+def test_token_bucket_partial_refill(clock):
+
+    bucket = rl.TokenBucket(rate=4, capacity=1)
+    bucket.acquire()
+
+    clock.now += 0.125
+    bucket.acquire()
+
+    assert clock.sleeps == [0.125]
+
+
+def test_retry_policy_retries_transient_errors(clock):
+
+    policy = rl.RetryPolicy(initial_delay=1.0, multiplier=2.0)
+    request = FlakyRequest([exceptions.ResourceExhausted('quota'), exceptions.ServiceUnavailable('unavailable')])
+
+    assert policy.call(request, 'tag') == 'tag'
+    assert request.calls == 3
+    assert clock.sleeps == [1.0, 2.0]
+
+
+def test_retry_policy_fails_immediately_on_other_errors(clock):
+
+    policy = rl.RetryPolicy()
+    request = FlakyRequest([exceptions.BadRequest('invalid tag')])
+
+    with pytest.raises(exceptions.BadRequest):
+        policy.call(request, 'tag')
+
+    assert request.calls == 1
+    assert clock.sleeps == []
+
+
+def test_retry_policy_max_attempts(clock):
+
+    policy = rl.RetryPolicy(max_attempts=3, initial_delay=1.0, max_delay=1.5, multiplier=2.0)
+    request = FlakyRequest([exceptions.ResourceExhausted('quota')] * 5)
+
+    with pytest.raises(exceptions.ResourceExhausted):
+        policy.call(request, 'tag')
+
+    assert request.calls == 3
+
+    # the delay is capped at max_delay
+    assert clock.sleeps == [1.0, 1.5]
+
+
+def test_retry_policy_goes_through_the_rate_limiter(clock):
+
+    bucket = rl.TokenBucket(rate=1, capacity=1)
+    policy = rl.RetryPolicy(rate_limiter=bucket, initial_delay=0.25)
+    request = FlakyRequest([exceptions.ServiceUnavailable('unavailable')])
+
+    assert policy.call(request, 'tag') == 'tag'
+
+    # the retry waits for the backoff, then for the rest of the token
+    assert clock.sleeps == [0.25, 0.75]
+
+
+def test_retry_budget_is_spent_and_refilled(clock):
+
+    policy = rl.RetryPolicy(max_attempts=10, budget_ratio=0.5, max_budget=2)
+
+    # the budget starts full, one request uses it up
+    request = FlakyRequest([exceptions.ResourceExhausted('quota')] * 2)
+    assert policy.call(request, 'tag') == 'tag'
+    assert request.calls == 3
+    assert policy.budget == 0
+
+    # without budget, the request fails on its first transient error
+    request = FlakyRequest([exceptions.ResourceExhausted('quota')] * 2)
+
+    with pytest.raises(exceptions.ResourceExhausted):
+        policy.call(request, 'tag')
+
+    assert request.calls == 1
+
+    # every request deposits budget_ratio, two requests pay for one retry
+    assert policy.budget == 0.5
+    assert policy.call(FlakyRequest([]), 'tag') == 'tag'
+
+    request = FlakyRequest([exceptions.ResourceExhausted('quota')])
+    assert policy.call(request, 'tag') == 'tag'
+    assert request.calls == 2
+    assert policy.budget == 0.5
+
+
+def test_retry_budget_is_capped(clock):
+
+    policy = rl.RetryPolicy(budget_ratio=0.5, max_budget=2)
+
+    for i in range(10):
+        policy.call(FlakyRequest([]), 'tag')
+
+    assert policy.budget == 2
@@ -0,0 +1,158 @@
+import pytest
+
+pytest.importorskip('google.cloud.bigquery')
+pytest.importorskip('google.cloud.storage')
+pytest.importorskip('google.cloud.resourcemanager_v3')
+
+from Resources import Resources
+
+
+def test_compile_pattern_is_anchored():
+
+    pattern = Resources.compile_pattern('sales_*')
+
+    assert pattern.match('sales_q1')
+    assert pattern.match('sales_')
+    assert pattern.match('staging_sales_q1') == None
+    assert pattern.match('sales') == None
+
+
+def test_compile_pattern_matches_the_whole_name():
+
+    assert Resources.compile_pattern('*_archive').match('sales_archive_2021') == None
+    assert Resources.compile_pattern('*_archive').match('sales_archive')
+    assert Resources.compile_pattern('*_archive_*').match('sales_archive_2021')
+    assert Resources.compile_pattern('*_archive_*').match('archive_2021') == None
+
+
+def test_compile_pattern_glob_syntax():
+
+    assert Resources.compile_pattern('sales_202?').match('sales_2021')
+    assert Resources.compile_pattern('sales_202?').match('sales_20210') == None
+    assert Resources.compile_pattern('sales_[ab]*').match('sales_b_q1')
+    assert Resources.compile_pattern('sales_[ab]*').match('sales_c_q1') == None
+
+    # the dots in table and object names are literals
+    assert Resources.compile_pattern('*.csv').match('data/2021.csv')
+    assert Resources.compile_pattern('*.csv').match('data/2021_csv') == None
+
+
+def test_is_wildcard_and_literal_prefix():
+
+    assert Resources.is_wildcard('sales_*')
+    assert Resources.is_wildcard('sales_202?')
+    assert Resources.is_wildcard('sales_[ab]')
+    assert Resources.is_wildcard('sales') == False
+
+    assert Resources.literal_prefix('cities_311/*.parquet') == 'cities_311/'
+    assert Resources.literal_prefix('cities_?11/*') == 'cities_'
+    assert Resources.literal_prefix('*') == ''
+
+
+def test_table_and_dataset_matches():
+
+    assert Resources.table_matches('sales_*', 'sales_q1')
+    assert Resources.table_matches('sales_*', 'staging_sales_q1') == False
+
+    # an expression without a wildcard only matches the name itself
+    assert Resources.table_matches('sales', 'sales')
+    assert Resources.table_matches('sales', 'sales_q1') == False
+
+    assert Resources.dataset_matches('sales*', 'sales_dataset')
+    assert Resources.dataset_matches('sales*', 'staging_sales') == False
+
+
+def test_bq_exclusion_matcher_without_exclusions():
+
+    assert Resources.bq_exclusion_matcher(None) == None
+    assert Resources.bq_exclusion_matcher('') == None
+    assert Resources.bq_exclusion_matcher('  ') == None
+
+
+def test_bq_exclusion_matcher_project_uri_excludes_its_tables():
+
+    is_excluded = Resources.bq_exclusion_matcher('bigquery/project/warehouse/dataset')
+
+    assert is_excluded('warehouse/datasets/sales/tables/orders')
+    assert is_excluded('warehouse/datasets/sales') == False
+    assert is_excluded('other/datasets/sales/tables/orders') == False
+
+
+def test_bq_exclusion_matcher_dataset_uri_excludes_the_dataset():
+
+    is_excluded = Resources.bq_exclusion_matcher('bigquery/project/warehouse/dataset/staging*')
+
+    assert is_excluded('warehouse/datasets/staging_sales')
+    assert is_excluded('warehouse/datasets/sales_staging') == False
+    assert is_excluded('warehouse/datasets/staging_sales/tables/orders') == False
+
+
+def test_bq_exclusion_matcher_table_uri_excludes_the_matching_tables():
+
+    is_excluded = Resources.bq_exclusion_matcher('bigquery/project/warehouse/dataset/sales/*_archive_*, '
+                                                 'bigquery/project/warehouse/dataset/*/tmp')
+
+    assert is_excluded('warehouse/datasets/sales/tables/orders_archive_2021')
+    assert is_excluded('warehouse/datasets/sales/tables/orders_archive') == False
+    assert is_excluded('warehouse/datasets/sales/tables/orders') == False
+    assert is_excluded('warehouse/datasets/sales') == False
+
+    assert is_excluded('warehouse/datasets/finance/tables/tmp')
+    assert is_excluded('warehouse/datasets/finance/tables/tmp_1') == False
+    assert is_excluded('other/datasets/finance/tables/tmp') == False
+
+
+def test_gcs_exclusion_matcher():
+
+    assert Resources.gcs_exclusion_matcher(None) == None
+
+    is_excluded = Resources.gcs_exclusion_matcher('gs://discovery-area/cities_311/*, gs://discovery-area/*.csv, '
+                                                  'gs://discovery-area/austin.parquet')
+
+    # a folder uri excludes every object under the folder, the subfolders included
+    assert is_excluded(('discovery-area', 'cities_311/austin.parquet'))
+    assert is_excluded(('discovery-area', 'cities_311/2021/austin.parquet'))
+    assert is_excluded(('discovery-area', 'cities_312/austin.parquet')) == False
+
+    assert is_excluded(('discovery-area', 'exports/austin.csv'))
+    assert is_excluded(('discovery-area', 'austin.parquet'))
+    assert is_excluded(('discovery-area', 'exports/austin.parquet')) == False
+    assert is_excluded(('other-bucket', 'cities_311/austin.parquet')) == False
+
+
+def test_filter_resources():
+
+    resources = ['p/datasets/a', 'p/datasets/b', 'p/datasets/a', 'p/datasets/c']
+    is_excluded = lambda resource: resource == 'p/datasets/b'
+
+    assert list(Resources.filter_resources(resources, is_excluded, True)) == ['p/datasets/a', 'p/datasets/c']
+    assert list(Resources.filter_resources(resources, None, False)) == resources
+
+
+def test_check_uris():
+
+    assert Resources.check_bq_uri(' bigquery/project/warehouse/dataset/sales/*') == ['bigquery', 'project', 'warehouse', 'dataset', 'sales', '*']
+    assert Resources.check_gcs_uri(' gs://discovery-area/cities_311/*') == ['discovery-area', 'cities_311/*']
+
+    for uri in ['bigquery/projects/warehouse/dataset', 'bigquery/project/warehouse', 'bigquery/project/warehouse/dataset/sales/orders/x', \
+                'gs://discovery-area/cities_311/*']:
+        with pytest.raises(ValueError):
+            Resources.check_bq_uri(uri)
+
+    for uri in ['gs://discovery-area', 'gs://discovery-area/', 'gs:///cities_311/*', 'bigquery/project/warehouse/dataset']:
+        with pytest.raises(ValueError):
+            Resources.check_gcs_uri(uri)
+
+
+def test_invalid_excluded_uri_fails_get_resources():
+
+    # the resources are listed lazily, so nothing gets listed before the uris are validated
+    assert Resources.get_resources('bigquery/project/warehouse/dataset/sales/*', 'bigquery/projects/warehouse/dataset/sales/tmp') == None
+    assert Resources.get_resources('gs://discovery-area/cities_311/*', 'gs://discovery-area') == None
+    assert Resources.get_resources('bigquery/projects/warehouse/dataset/sales/*', None) == None
+
+    with pytest.raises(ValueError):
+        Resources.bq_exclusion_matcher('bigquery/project/warehouse/dataset/sales/tmp, bigquery/project')
+
+    with pytest.raises(ValueError):
+        Resources.gcs_exclusion_matcher('gs://discovery-area')
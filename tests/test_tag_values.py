@@ -0,0 +1,190 @@
+import datetime, threading
+
+import pytest
+
+datacatalog = pytest.importorskip('google.cloud.datacatalog')
+pytest.importorskip('google.cloud.bigquery')
+pytest.importorskip('pandas')
+
+import DataCatalogUtils as dc
+
+TEMPLATE = 'projects/tag-engine/locations/us-central1/tagTemplates/data_governance'
+PARENT = 'projects/warehouse/locations/us/entryGroups/@bigquery/entries/sales'
+
+
+def make_tag(column='', template=TEMPLATE, name=None, **fields):
+
+    tag = datacatalog.Tag()
+    tag.template = template
+    tag.column = column
+
+    if name != None:
+        tag.name = name
+
+    for field_id, (kind, value) in fields.items():
+
+        tag_field = datacatalog.TagField()
+
+        if kind == 'enum':
+            tag_field.enum_value.display_name = value
+        elif kind == 'timestamp':
+            tag_field.timestamp_value = value
+        elif kind != None:
+            setattr(tag_field, kind + '_value', value)
+
+        tag.fields[field_id] = tag_field
+
+    return tag
+
+
+def make_dcu(*existing_tags):
+
+    # the tags which are on the entry are indexed up front, so that get_tag_index doesn't call list_tags
+    dcu = object.__new__(dc.DataCatalogUtils)
+    dcu.template_project = 'tag-engine'
+    dcu.template_region = 'us-central1'
+    dcu.template_id = 'data_governance'
+    dcu.tag_index = {PARENT: {}}
+    dcu.write_counters = {'tags_created': 0, 'tags_updated': 0, 'tags_skipped': 0}
+    dcu.write_counters_lock = threading.Lock()
+
+    for tag in existing_tags:
+        dcu.index_tag(PARENT, tag)
+
+    return dcu
+
+
+def test_get_tag_values():
+
+    timestamp = datetime.datetime(2022, 9, 14, 18, 24, 31, 615000, tzinfo=datetime.timezone.utc)
+    tag = make_tag(data_domain=('enum', 'FINANCE'), sensitive=('bool', True), row_count=('double', 42.0), \
+                   owner=('string', 'finance-team'), notes=('richtext', '<b>hello</b>'), last_modified=('timestamp', timestamp), \
+                   empty=(None, None))
+
+    assert dc.DataCatalogUtils.get_tag_values(tag) == {
+        'data_domain': ('enum_value', 'FINANCE'),
+        'sensitive': ('bool_value', True),
+        'row_count': ('double_value', 42.0),
+        'owner': ('string_value', 'finance-team'),
+        'notes': ('richtext_value', '<b>hello</b>'),
+        'last_modified': ('timestamp_value', (1663179871, 615000000)),
+        'empty': (None, None),
+    }
+
+
+def test_get_tag_values_keeps_the_type():
+
+    # a false bool and a zero double are values, not missing fields
+    assert dc.DataCatalogUtils.get_tag_values(make_tag(flag=('bool', False))) == {'flag': ('bool_value', False)}
+    assert dc.DataCatalogUtils.get_tag_values(make_tag(flag=('double', 0.0))) == {'flag': ('double_value', 0.0)}
+    assert dc.DataCatalogUtils.get_tag_values(make_tag(flag=('bool', False))) != \
+           dc.DataCatalogUtils.get_tag_values(make_tag(flag=(None, None)))
+    assert dc.DataCatalogUtils.get_tag_values(make_tag(flag=('string', 'x'))) != \
+           dc.DataCatalogUtils.get_tag_values(make_tag(flag=('richtext', 'x')))
+
+
+def test_unchanged_tag_is_skipped():
+
+    timestamp = datetime.datetime(2022, 9, 14, 18, 24, 31, 615000, tzinfo=datetime.timezone.utc)
+    fields = {'data_domain': ('enum', 'FINANCE'), 'sensitive': ('bool', False), 'row_count': ('double', 42.0), \
+              'last_modified': ('timestamp', timestamp)}
+
+    dcu = make_dcu(make_tag(name=PARENT + '/tags/t1', **fields))
+
+    assert dcu.check_if_unchanged(PARENT, make_tag(**fields))
+    assert dcu.write_counters['tags_skipped'] == 1
+
+
+@pytest.mark.parametrize('changed_field', [
+    {'data_domain': ('enum', 'HR')},
+    {'sensitive': ('bool', True)},
+    {'row_count': ('double', 42.5)},
+    # the same second, a different nanosecond
+    {'last_modified': ('timestamp', datetime.datetime(2022, 9, 14, 18, 24, 31, 615001, tzinfo=datetime.timezone.utc))},
+    {'last_modified': ('timestamp', datetime.datetime(2022, 9, 14, 18, 24, 32, 615000, tzinfo=datetime.timezone.utc))},
+    {'sensitive': (None, None)},
+])
+def test_changed_tag_is_written(changed_field):
+
+    timestamp = datetime.datetime(2022, 9, 14, 18, 24, 31, 615000, tzinfo=datetime.timezone.utc)
+    fields = {'data_domain': ('enum', 'FINANCE'), 'sensitive': ('bool', False), 'row_count': ('double', 42.0), \
+              'last_modified': ('timestamp', timestamp)}
+
+    dcu = make_dcu(make_tag(name=PARENT + '/tags/t1', **fields))
+
+    assert dcu.check_if_unchanged(PARENT, make_tag(**dict(fields, **changed_field))) == False
+    assert dcu.write_counters['tags_skipped'] == 0
+
+
+def test_missing_and_extra_fields_are_changes():
+
+    dcu = make_dcu(make_tag(name=PARENT + '/tags/t1', data_domain=('enum', 'FINANCE'), sensitive=('bool', True)))
+
+    assert dcu.check_if_unchanged(PARENT, make_tag(data_domain=('enum', 'FINANCE'))) == False
+    assert dcu.check_if_unchanged(PARENT, make_tag(data_domain=('enum', 'FINANCE'), sensitive=('bool', True), \
+                                                   owner=('string', 'finance-team'))) == False
+
+
+def test_tag_without_an_existing_tag_is_written():
+
+    dcu = make_dcu(make_tag(name=PARENT + '/tags/t1', template=TEMPLATE.replace('data_governance', 'data_quality'), \
+                            score=('double', 1.0)))
+
+    assert dcu.check_if_unchanged(PARENT, make_tag(score=('double', 1.0))) == False
+
+
+def test_column_tags_are_matched_by_the_lowercase_column():
+
+    # the column tags are stored with the column in lower case
+    dcu = make_dcu(make_tag(column='order_id', name=PARENT + '/tags/t1', sensitive=('bool', True)), \
+                   make_tag(column='amount', name=PARENT + '/tags/t2', sensitive=('bool', False)))
+
+    assert dcu.check_if_unchanged(PARENT, make_tag(column='ORDER_ID', sensitive=('bool', True)))
+    assert dcu.check_if_unchanged(PARENT, make_tag(column='Amount', sensitive=('bool', False)))
+    assert dcu.check_if_unchanged(PARENT, make_tag(column='Amount', sensitive=('bool', True))) == False
+
+    # a table tag doesn't match a column tag
+    assert dcu.check_if_unchanged(PARENT, make_tag(sensitive=('bool', True))) == False
+
+
+class ExportCatalogClient:
+
+    # stands in for the Data Catalog client, every entry has the given tags
+    def __init__(self, tags):
+        self.tags = tags
+
+    def lookup_entry(self, request):
+        return datacatalog.Entry(name=PARENT)
+
+    def list_tags(self, parent, timeout):
+        return self.tags
+
+
+def test_export_rows_go_to_the_report_table_of_each_tag():
+
+    dcu = make_dcu()
+    dcu.export_columns = {}
+    dcu.client = ExportCatalogClient([make_tag(name=PARENT + '/tags/t1', sensitive=('bool', True)), \
+                                      make_tag(column='order_id', name=PARENT + '/tags/t2', sensitive=('bool', False)), \
+                                      make_tag(column='amount', name=PARENT + '/tags/t3', sensitive=('bool', True)), \
+                                      make_tag(name=PARENT + '/tags/t4', row_count=('double', 3.0))])
+
+    assert dcu.apply_export_config('c1', 'reports', 'catalog', 'us', 'warehouse/datasets/sales/tables/orders') == dc.constants.SUCCESS
+    assert dcu.apply_export_config('c1', 'reports', 'catalog', 'us', 'warehouse/datasets/sales') == dc.constants.SUCCESS
+
+    table_columns = dcu.export_columns[('reports', 'catalog', 'us', 'catalog_report_table_tags')]
+    column_columns = dcu.export_columns[('reports', 'catalog', 'us', 'catalog_report_column_tags')]
+    dataset_columns = dcu.export_columns[('reports', 'catalog', 'us', 'catalog_report_dataset_tags')]
+
+    assert table_columns['table'] == ['orders', 'orders']
+    assert table_columns['tag_field'] == ['sensitive', 'row_count']
+
+    # the column tags of the dataset's entry are reported with its table, which is None for a dataset uri
+    assert column_columns['table'] == ['orders', 'orders', None, None]
+    assert column_columns['column'] == ['order_id', 'amount', 'order_id', 'amount']
+    assert column_columns['tag_value'] == ['false', 'true', 'false', 'true']
+
+    # a table tag after a column tag on a dataset uri still goes to the dataset report table
+    assert dataset_columns['tag_field'] == ['sensitive', 'row_count']
+    assert dataset_columns['tag_value'] == ['true', '3.0']
+    assert 'table' not in dataset_columns